@@ -0,0 +1,83 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+# Sets Codex up in a temporary configuration directory, with calibre_stand_in.py in place of calibre, so the conversion pipeline can be benchmarked on any platform.
+# Call setup() before importing any other Codex module.
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+
+source_path = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+sys.path.insert(0, source_path)
+
+import application
+
+def setup(latency=0.0, output_lines=0, workers=1, server_mode='off', batch_size=1):
+    base_directory = tempfile.mkdtemp(prefix='codex-benchmark-')
+    application.application_path = source_path
+    application.config_directory = os.path.join(base_directory, 'config')
+    application.user_documents_path = os.path.join(base_directory, 'documents')
+    application.working_path = application.user_documents_path
+    application.config_file = os.path.join(application.config_directory, '{0}.ini'.format(application.internal_name))
+    os.makedirs(application.config_directory)
+    os.makedirs(application.user_documents_path)
+
+    import log
+    log.setup(gui=False)
+    import config
+    config.setup()
+    application.config['use_calibre_stand_in'] = True
+    application.config['calibre_server_mode'] = server_mode
+    application.config['conversion_workers'] = workers
+    application.config['import_batch_size'] = batch_size
+    application.config['conversion_cache_size'] = 0
+    application.config['filename_template'] = os.path.join('$author', '$title')
+    application.config['output_directory'] = os.path.join(base_directory, 'output')
+    import i18n
+    i18n.install_translations()
+
+    # The stand-in is a separate process, so its behaviour is set through the environment
+    os.environ['CODEX_STAND_IN_LATENCY'] = str(latency)
+    os.environ['CODEX_STAND_IN_OUTPUT_LINES'] = str(output_lines)
+
+    import calibre
+    import conversion
+    calibre.ensure_setup()
+    conversion.signal_dispatcher = conversion.dispatch_signal_directly
+    return base_directory
+
+def set_latency(latency):
+    os.environ['CODEX_STAND_IN_LATENCY'] = str(latency)
+
+def create_books(directory, count, extensions=('azw', 'mobi', 'epub')):
+    # Creates files the stand-in will read an author and title from, cycling through the given extensions
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, 'Author {0} - Title {0}.{1}'.format(index, extensions[index % len(extensions)]))
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('Book {0}\n'.format(index))
+        paths.append(path)
+    return paths
+
+def reset_conversion_state():
+    # Mirrors gui.conversion_pipeline.cleanup, which can't be imported without wx
+    import conversion
+    conversion.stop_conversion.clear()
+    conversion.clear_skip_requests()
+    conversion.conversion_queue.clear()
+    conversion.converted_files = []
+    conversion.failed_conversions = []
+    conversion.remove_drm_only = False
+    conversion.resume_batch_id = None
+    conversion.no_drm = False
+
+def teardown(base_directory):
+    import calibre
+    calibre.shutdown_servers()
+    shutil.rmtree(base_directory, ignore_errors=True)
@@ -0,0 +1,175 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+# Writes synthetic MOBI and AZW files for testing and benchmarking kindle_metadata, as real Kindle books can't be shared.
+# Files are valid PDB databases with a PalmDOC header, a MOBI header, EXTH metadata and filler text records, and can also be generated encrypted, malformed or as TPZ (Topaz) files.
+# The layout is written out here independently of kindle_metadata, so the parser is checked against the format rather than against itself.
+#
+# Usage: python benchmarks/kindle_corpus.py directory count [--seed 1] [--records 8] [--exth-padding 0] [--malformed 0.05]
+
+import argparse
+import os
+import os.path
+import random
+import struct
+import sys
+import zlib
+
+PDB_HEADER = struct.Struct('>32sHHIIIIII4s4sIIH')
+PDB_RECORD_INFO = struct.Struct('>II')
+PALMDOC_HEADER = struct.Struct('>HHIHHHH')
+MOBI_HEADER_LENGTH = 232
+EXTH_RECORD_HEADER = struct.Struct('>II')
+# Seconds between the Palm epoch (1904) and the Unix epoch, which PDB dates are counted from
+PALM_EPOCH_OFFSET = 2082844800
+PALMDOC_COMPRESSION = 2
+MOBI_TYPE_BOOK = 2
+MOBI_HAS_EXTH = 0x40
+ENCRYPTION_MOBIPOCKET = 2
+ENCODINGS = {65001: 'utf-8', 1252: 'cp1252'}
+
+TITLES = ['The Left Hand of Darkness', 'Cien años de soledad', 'Les Misérables', 'Война и мир', '吾輩は猫である', 'Ο Κόσμος της Σοφίας', 'Æsop’s Fables', 'ﬁnding the ﬂow', 'البحث عن الزمن المفقود', 'Die Verwandlung']
+AUTHORS = ['Ursula K. Le Guin', 'Gabriel García Márquez', 'Victor Hugo', 'Лев Толстой', '夏目漱石', 'Jostein Gaarder', 'Æsop', 'Zoë Brontë', 'نجيب محفوظ', 'Franz Kafka']
+# Ways a file can be broken, one of which is picked at random for each malformed file
+MALFORMED_VARIANTS = ['truncated', 'bad_record_table', 'bad_exth', 'empty', 'tpz']
+
+class Book(object):
+    # The metadata written into a generated file, which a correct parser should read back
+    def __init__(self, title, authors, asin, encrypted=False):
+        self.title = title
+        self.authors = authors
+        self.asin = asin
+        self.encrypted = encrypted
+
+def exth_record(record_type, data):
+    return EXTH_RECORD_HEADER.pack(record_type, EXTH_RECORD_HEADER.size + len(data)) + data
+
+def build_exth(book, encoding, padding=0):
+    records = [exth_record(100, author.encode(encoding, errors='replace')) for author in book.authors]
+    records.append(exth_record(113, book.asin.encode('ascii')))
+    records.append(exth_record(503, book.title.encode(encoding, errors='replace')))
+    records.append(exth_record(524, b'en'))
+    records.append(exth_record(201, struct.pack('>I', 0)))
+    if book.encrypted:
+        records.append(exth_record(208, b'\x00' * 16))
+        records.append(exth_record(401, struct.pack('>I', 0)))
+    if padding > 0:
+        # Unnamed records, as some files carry large amounts of metadata the parser has to skip over
+        records.append(exth_record(65000, b'\x20' * padding))
+    body = b''.join(records)
+    length = 12 + len(body)
+    exth = b'EXTH' + struct.pack('>II', length, len(records)) + body
+    return exth + b'\x00' * (-len(exth) % 4)
+
+def build_record_zero(book, text_length, text_record_count, text_record_size, encoding_code, exth_padding):
+    encoding = ENCODINGS[encoding_code]
+    exth = build_exth(book, encoding, exth_padding)
+    full_name = book.title.encode(encoding, errors='replace')
+    full_name_offset = 16 + MOBI_HEADER_LENGTH + len(exth)
+    encryption = ENCRYPTION_MOBIPOCKET if book.encrypted else 0
+
+    palmdoc = PALMDOC_HEADER.pack(PALMDOC_COMPRESSION, 0, text_length, text_record_count, text_record_size, encryption, 0)
+    mobi = bytearray(MOBI_HEADER_LENGTH)
+    struct.pack_into('>4sIIIII', mobi, 0, b'MOBI', MOBI_HEADER_LENGTH, MOBI_TYPE_BOOK, encoding_code, zlib.crc32(book.asin.encode('ascii')), 6)
+    # Offsets are relative to the start of record zero, which the MOBI header begins 16 bytes into
+    struct.pack_into('>I', mobi, 80 - 16, text_record_count + 1)
+    struct.pack_into('>II', mobi, 84 - 16, full_name_offset, len(full_name))
+    struct.pack_into('>I', mobi, 92 - 16, 9)
+    struct.pack_into('>I', mobi, 108 - 16, 0xffffffff)
+    struct.pack_into('>I', mobi, 128 - 16, MOBI_HAS_EXTH)
+    return palmdoc + bytes(mobi) + exth + full_name + b'\x00\x00'
+
+def build_pdb(name, records, type=b'BOOK', creator=b'MOBI'):
+    header_size = PDB_HEADER.size + (PDB_RECORD_INFO.size * len(records)) + 2
+    now = PALM_EPOCH_OFFSET + 1420070400
+    header = PDB_HEADER.pack(name[:31], 0, 0, now, now, 0, 0, 0, 0, type, creator, len(records) * 2 - 1, 0, len(records))
+    record_info = []
+    offset = header_size
+    for index, record in enumerate(records):
+        record_info.append(PDB_RECORD_INFO.pack(offset, index * 2))
+        offset += len(record)
+    return header + b''.join(record_info) + b'\x00\x00' + b''.join(records)
+
+def build_mobi(book, text_record_count=8, text_record_size=256, encoding_code=65001, exth_padding=0):
+    text_records = [bytes([65 + (index % 26)]) * text_record_size for index in range(text_record_count)]
+    record_zero = build_record_zero(book, text_record_count * text_record_size, text_record_count, text_record_size, encoding_code, exth_padding)
+    name = book.title.encode('ascii', errors='replace').replace(b' ', b'_')
+    return build_pdb(name, [record_zero] + text_records + [b'\xe9\x8e\r\n'])
+
+def build_malformed(variant, book, **kwargs):
+    data = build_mobi(book, **kwargs)
+    if variant == 'truncated':
+        # Cut off part way through record zero
+        return data[:PDB_HEADER.size + 40]
+    elif variant == 'bad_record_table':
+        # The first record claims to start past the end of the file
+        data = bytearray(data)
+        struct.pack_into('>I', data, PDB_HEADER.size, len(data) + 1000)
+        return bytes(data)
+    elif variant == 'bad_exth':
+        # The first EXTH record claims to be longer than record zero
+        data = bytearray(data)
+        record_zero_offset = struct.unpack_from('>I', data, PDB_HEADER.size)[0]
+        exth_offset = record_zero_offset + 16 + MOBI_HEADER_LENGTH
+        struct.pack_into('>I', data, exth_offset + 12 + 4, 0x7fffffff)
+        return bytes(data)
+    elif variant == 'empty':
+        return b''
+    elif variant == 'tpz':
+        return b'TPZ0' + bytes(index % 256 for index in range(252))
+    raise ValueError(variant)
+
+def random_book(rng, index, encrypted_share=0.5):
+    author_count = 1 + (rng.random() < 0.2)
+    authors = rng.sample(AUTHORS, author_count)
+    title = '{0} {1}'.format(rng.choice(TITLES), index)
+    asin = 'B0{0:08d}'.format(index)
+    return Book(title, authors, asin, encrypted=rng.random() < encrypted_share)
+
+def generate_corpus(directory, count, seed=1, text_record_count=8, text_record_size=256, exth_padding=0, malformed_share=0.0, cp1252_share=0.1):
+    '''
+    Writes count files into directory, named like the Kindle app names its downloads.
+    Returns a dictionary mapping each path to the Book written into it, or to the name of the malformed variant it is.
+    The same seed always produces the same corpus.
+    '''
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    corpus = {}
+    for index in range(count):
+        book = random_book(rng, index)
+        path = os.path.join(directory, '{0}_EBOK.azw'.format(book.asin))
+        if rng.random() < malformed_share:
+            variant = rng.choice(MALFORMED_VARIANTS)
+            data = build_malformed(variant, book, text_record_count=text_record_count, text_record_size=text_record_size)
+            corpus[path] = variant
+        else:
+            encoding_code = 1252 if rng.random() < cp1252_share else 65001
+            data = build_mobi(book, text_record_count, text_record_size, encoding_code, exth_padding)
+            if encoding_code == 1252:
+                # Characters cp1252 can't represent are written as question marks
+                book.title = book.title.encode('cp1252', errors='replace').decode('cp1252')
+                book.authors = [author.encode('cp1252', errors='replace').decode('cp1252') for author in book.authors]
+            corpus[path] = book
+        with open(path, 'wb') as f:
+            f.write(data)
+    return corpus
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic MOBI/AZW files for testing and benchmarking.')
+    parser.add_argument('directory')
+    parser.add_argument('count', type=int)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--records', type=int, default=8, help='the number of text records in each file')
+    parser.add_argument('--record-size', dest='record_size', type=int, default=256)
+    parser.add_argument('--exth-padding', dest='exth_padding', type=int, default=0, help='bytes of extra EXTH data in each file')
+    parser.add_argument('--malformed', type=float, default=0.0, help='the share of files which are malformed or TPZ')
+    args = parser.parse_args()
+    corpus = generate_corpus(args.directory, args.count, args.seed, args.records, args.record_size, args.exth_padding, args.malformed)
+    malformed_count = len([value for value in corpus.values() if not isinstance(value, Book)])
+    print('Wrote {0} files ({1} malformed) to {2}'.format(len(corpus), malformed_count, args.directory))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
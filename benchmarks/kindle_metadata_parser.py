@@ -0,0 +1,141 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+# Benchmarks kindle_metadata.get_title_and_author_from_kindle_file over a corpus written by kindle_corpus.py.
+# Each size is read twice: first with the files evicted from the page cache (cold), then again straight away (warm).
+# Measures files per second, and bytes read from storage per file where /proc/self/io is available.
+# Every result is checked against the metadata the corpus was written with, so a faster parser can't pass by being wrong.
+# Results are appended to benchmarks/kindle_metadata_parser_results.jsonl, which git ignores, unless --results names another file.
+#
+# Usage: python benchmarks/kindle_metadata_parser.py [--sizes 10 1000 100000] [--directory path] [--malformed 0.05]
+
+import argparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, 'src')))
+
+import kindle_corpus
+import kindle_metadata
+import results
+
+SIZES = [10, 1000, 100000]
+PROC_IO_PATH = '/proc/self/io'
+
+def can_evict():
+    return hasattr(os, 'posix_fadvise') and hasattr(os, 'POSIX_FADV_DONTNEED')
+
+def evict(paths):
+    # Only clean pages are dropped, so anything still waiting to be written is flushed first
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+def get_bytes_read():
+    # Bytes this process has caused to be fetched from storage, or None where the kernel doesn't report it
+    try:
+        with open(PROC_IO_PATH) as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                if key == 'read_bytes':
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+def check_result(path, expected, result):
+    # Returns a description of what went wrong, or None if the parser read the file correctly
+    if not isinstance(expected, kindle_corpus.Book):
+        if not isinstance(result, kindle_metadata.KindleMetadataError):
+            return '{0}: {1} file was parsed as {2!r}'.format(path, expected, result)
+        return None
+    if isinstance(result, kindle_metadata.KindleMetadataError):
+        return '{0}: raised {1!r}'.format(path, result)
+    expected_metadata = {'title': expected.title, 'author': ' & '.join(expected.authors)}
+    if result != expected_metadata:
+        return '{0}: expected {1!r}, got {2!r}'.format(path, expected_metadata, result)
+    return None
+
+def read_files(paths):
+    metadata = []
+    for path in paths:
+        try:
+            metadata.append(kindle_metadata.get_title_and_author_from_kindle_file(path))
+        except kindle_metadata.KindleMetadataError as e:
+            metadata.append(e)
+    return metadata
+
+def run_pass(paths, corpus):
+    # Returns (files per second, bytes read per file) for one read of every path
+    bytes_before = get_bytes_read()
+    start = time.perf_counter()
+    metadata = read_files(paths)
+    elapsed = time.perf_counter() - start
+    bytes_after = get_bytes_read()
+
+    problems = [problem for problem in (check_result(path, corpus[path], result) for path, result in zip(paths, metadata)) if problem is not None]
+    if problems:
+        raise RuntimeError('{0} of {1} files were read incorrectly, including {2}'.format(len(problems), len(paths), problems[0]))
+    bytes_read = None
+    if bytes_before is not None and bytes_after is not None:
+        bytes_read = (bytes_after - bytes_before) / len(paths)
+    return len(paths) / elapsed, bytes_read
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark reading titles and authors from Kindle files.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES, help='numbers of files to read')
+    parser.add_argument('--directory', help='where to write the corpus, which should be on the kind of disk being measured (defaults to a temporary directory)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--records', type=int, default=8, help='the number of text records in each file')
+    parser.add_argument('--record-size', dest='record_size', type=int, default=256)
+    parser.add_argument('--exth-padding', dest='exth_padding', type=int, default=0, help='bytes of extra EXTH data in each file')
+    parser.add_argument('--malformed', type=float, default=0.05, help='the share of files which are malformed or TPZ')
+    parser.add_argument('--results', default=results.get_default_path('kindle_metadata_parser'), help='the file results are appended to')
+    parser.add_argument('--threshold', type=float, default=0.1, help='the fractional slowdown counted as a regression')
+    parser.add_argument('--fail-on-regression', dest='fail_on_regression', action='store_true', default=False)
+    args = parser.parse_args()
+
+    settings = {'sizes': args.sizes, 'seed': args.seed, 'records': args.records, 'record_size': args.record_size, 'exth_padding': args.exth_padding, 'malformed': args.malformed, 'platform': sys.platform}
+    directory = args.directory or tempfile.mkdtemp(prefix='codex-kindle-corpus-')
+    try:
+        # One corpus serves every size, as each size reads the first files of it
+        corpus = kindle_corpus.generate_corpus(directory, max(args.sizes), args.seed, args.records, args.record_size, args.exth_padding, args.malformed)
+        all_paths = list(corpus)
+        benchmarks = {'cold_files_per_second': {}, 'warm_files_per_second': {}, 'cold_bytes_read_per_file': {}, 'warm_bytes_read_per_file': {}}
+        if not can_evict():
+            print('Files cannot be evicted from the page cache on this platform, so cold results are unavailable')
+        for size in args.sizes:
+            paths = all_paths[:size]
+            cold_rate = cold_bytes = None
+            if can_evict():
+                evict(paths)
+                cold_rate, cold_bytes = run_pass(paths, corpus)
+            else:
+                # Still read everything once, so the warm pass really is warm
+                read_files(paths)
+            warm_rate, warm_bytes = run_pass(paths, corpus)
+            benchmarks['cold_files_per_second'][str(size)] = cold_rate
+            benchmarks['cold_bytes_read_per_file'][str(size)] = cold_bytes
+            benchmarks['warm_files_per_second'][str(size)] = warm_rate
+            benchmarks['warm_bytes_read_per_file'][str(size)] = warm_bytes
+    finally:
+        if args.directory is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    regressions = results.record(args.results, settings, benchmarks, args.threshold, higher_is_better=('cold_files_per_second', 'warm_files_per_second'))
+    if regressions and args.fail_on_regression:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
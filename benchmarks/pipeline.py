@@ -0,0 +1,135 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+# Benchmarks the conversion pipeline's orchestration using calibre_stand_in.py, so calibre isn't needed and results are reproducible.
+# Measures per-book overhead, the cost of adding files to the queue, how quickly a batch stops when cancelled and the cost of resetting the calibre library.
+# Each run is appended to a results file, and compared against the last run with the same settings so that regressions stand out.
+#
+# Usage: python benchmarks/pipeline.py [--sizes 10 100] [--workers 2] [--server-mode calibre] [--fail-on-regression]
+
+import argparse
+import os.path
+import sys
+import threading
+import time
+
+import environment
+import results
+
+# Queue sizes for the add benchmark, which is cheap enough to run at much larger sizes than a full conversion
+QUEUE_SIZES = [1000, 10000, 100000]
+# Latency given to the stand-in while measuring cancellation, so there's always a command to interrupt
+CANCELLATION_LATENCY = 2.0
+
+def benchmark_per_book_overhead(base_directory, sizes):
+    import conversion
+    results = {}
+    for size in sizes:
+        environment.reset_conversion_state()
+        for path in environment.create_books(os.path.join(base_directory, 'books_{0}'.format(size)), size):
+            conversion.add_path(path)
+        start = time.perf_counter()
+        worker = conversion.ConversionWorker()
+        worker.start()
+        worker.join()
+        elapsed = time.perf_counter() - start
+        if len(conversion.converted_files) != size:
+            raise RuntimeError('Only {0} of {1} books were converted'.format(len(conversion.converted_files), size))
+        results[str(size)] = elapsed / size
+    environment.reset_conversion_state()
+    return results
+
+def benchmark_queue_add(sizes):
+    import conversion
+    results = {}
+    for size in sizes:
+        environment.reset_conversion_state()
+        paths = [os.path.join('books', 'Author {0} - Title {0}.azw'.format(index)) for index in range(size)]
+        start = time.perf_counter()
+        for path in paths:
+            conversion.add_path(path, check_exists=False)
+        results[str(size)] = time.perf_counter() - start
+    environment.reset_conversion_state()
+    return results
+
+def benchmark_cancellation(base_directory):
+    # Returns the time from cancelling a batch to its worker finishing, while a command is running
+    import conversion
+    from signals import conversion_started
+    environment.reset_conversion_state()
+    for path in environment.create_books(os.path.join(base_directory, 'cancellation'), 10):
+        conversion.add_path(path)
+    started = threading.Event()
+    def onConversionStarted(sender, **kwargs):
+        started.set()
+    conversion_started.connect(onConversionStarted)
+
+    environment.set_latency(CANCELLATION_LATENCY)
+    try:
+        worker = conversion.ConversionWorker()
+        worker.start()
+        started.wait()
+        # Give the first command time to start
+        time.sleep(CANCELLATION_LATENCY / 4)
+        start = time.perf_counter()
+        conversion.stop_conversion.set()
+        worker.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        conversion_started.disconnect(onConversionStarted)
+        environment.set_latency(0)
+        environment.reset_conversion_state()
+    return {'seconds': elapsed}
+
+def benchmark_library_reset(sizes):
+    # Fills the library with dummy books, then times emptying it and replacing its database, as happens after every batch
+    import calibre
+    library_environment = calibre.default_environment
+    results = {}
+    for size in sizes:
+        for index in range(size):
+            book_directory = os.path.join(library_environment.library_path, 'Author {0}'.format(index), 'Title {0} ({0})'.format(index))
+            os.makedirs(book_directory, exist_ok=True)
+            with open(os.path.join(book_directory, 'Title {0}.azw'.format(index)), 'w') as f:
+                f.write('Book {0}\n'.format(index))
+        start = time.perf_counter()
+        calibre.empty_library(library_environment)
+        calibre.reset_library_db(library_environment)
+        results[str(size)] = time.perf_counter() - start
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Codex conversion pipeline against stand-in calibre executables.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 50], help='numbers of books to convert')
+    parser.add_argument('--queue-sizes', dest='queue_sizes', nargs='+', type=int, default=QUEUE_SIZES, help='numbers of files to add to the queue')
+    parser.add_argument('--library-sizes', dest='library_sizes', nargs='+', type=int, default=[10, 100, 1000], help='numbers of books in the library when it is reset')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=1)
+    parser.add_argument('--server-mode', dest='server_mode', choices=['off', 'calibre'], default='off', help='calibre runs jobs through the stand-in server')
+    parser.add_argument('--output-lines', dest='output_lines', type=int, default=0, help='extra lines of output the stand-in writes for each file')
+    parser.add_argument('--results', default=results.get_default_path('pipeline'), help='the file results are appended to')
+    parser.add_argument('--threshold', type=float, default=0.1, help='the fractional slowdown counted as a regression')
+    parser.add_argument('--fail-on-regression', dest='fail_on_regression', action='store_true', default=False)
+    args = parser.parse_args()
+
+    settings = {'sizes': args.sizes, 'queue_sizes': args.queue_sizes, 'library_sizes': args.library_sizes, 'workers': args.workers, 'batch_size': args.batch_size, 'server_mode': args.server_mode, 'output_lines': args.output_lines, 'platform': sys.platform}
+    base_directory = environment.setup(output_lines=args.output_lines, workers=args.workers, server_mode=args.server_mode, batch_size=args.batch_size)
+    try:
+        benchmarks = {
+            'per_book_overhead': benchmark_per_book_overhead(base_directory, args.sizes),
+            'queue_add': benchmark_queue_add(args.queue_sizes),
+            'cancellation_latency': benchmark_cancellation(base_directory),
+            'library_reset': benchmark_library_reset(args.library_sizes),
+        }
+    finally:
+        environment.teardown(base_directory)
+
+    regressions = results.record(args.results, settings, benchmarks, args.threshold)
+    if regressions and args.fail_on_regression:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
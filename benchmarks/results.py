@@ -0,0 +1,68 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+# Records benchmark results as JSON lines, and compares each run against the last one recorded with the same settings so that regressions stand out.
+
+import json
+import os.path
+import platform
+import subprocess
+import time
+
+results_directory = os.path.dirname(os.path.abspath(__file__))
+
+def get_default_path(name):
+    return os.path.join(results_directory, '{0}_results.jsonl'.format(name))
+
+def get_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=results_directory, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_previous_result(path, settings):
+    # Returns the most recent result recorded with the same settings, or None
+    previous = None
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                result = json.loads(line)
+                if result['settings'] == settings:
+                    previous = result
+    except OSError:
+        pass
+    return previous
+
+def compare(previous, current, threshold, higher_is_better=()):
+    '''
+    Prints each measurement alongside the last recorded one, returning the names of those which got worse by more than threshold.
+    Measurements are taken to be times, where lower is better, unless their benchmark is listed in higher_is_better.
+    '''
+    regressions = []
+    for benchmark, measurements in sorted(current['benchmarks'].items()):
+        for key, value in sorted(measurements.items()):
+            name = '{0} [{1}]'.format(benchmark, key)
+            old_value = None
+            if previous is not None:
+                old_value = previous['benchmarks'].get(benchmark, {}).get(key)
+            if value is None or old_value is None or old_value == 0:
+                print('{0}: {1}'.format(name, 'unavailable' if value is None else '{0:.6f}'.format(value)))
+                continue
+            change = (value - old_value) / old_value
+            worse = -change if benchmark in higher_is_better else change
+            marker = ''
+            if worse > threshold:
+                marker = '  REGRESSION'
+                regressions.append(name)
+            print('{0}: {1:.6f} (was {2:.6f}, {3:+.1%}){4}'.format(name, value, old_value, change, marker))
+    return regressions
+
+def record(path, settings, benchmarks, threshold, higher_is_better=()):
+    # Appends a run to the results file after comparing it with the previous one, returning any regressions
+    result = {'time': time.time(), 'revision': get_revision(), 'python': platform.python_version(), 'settings': settings, 'benchmarks': benchmarks}
+    regressions = compare(load_previous_result(path, settings), result, threshold, higher_is_better)
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(result) + '\n')
+    return regressions
@@ -2,7 +2,8 @@
 # Copyright (C) 2015 James Scholes
 # This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
 # See the file LICENSE.txt for more details.
-import codecs
+import collections
+import io
 import json
 import os
 import os.path
@@ -10,11 +11,13 @@ import re
 import shlex
 import shutil
 import subprocess
-import tempfile
+import sys
 import threading
+import time
 
 import application
 import conversion
+import events
 
 class InitialisationError(Exception):
     # Raised when, for whatever reason, we can't set up the required calibre directories
@@ -36,11 +39,31 @@ class InvalidCalibreOptionError(Exception):
     # Raised if the user has configured extra ebook-convert options which are not valid
     pass
 
+class ServerCrashedError(Exception):
+    # Raised if a calibre server process exits or stops responding while running a job
+    pass
+
+class BatchAttributionError(Exception):
+    # Raised if the output of a batched calibredb add can't be reliably matched up with the files in the batch
+    pass
+
 book_id_re = re.compile(r'\nAdded book ids: ([0-9]+)\n')
+book_ids_re = re.compile(r'\nAdded book ids: ([0-9, ]+)\n')
+# DeDRM announces each file it processes, which lets us split batched output into per-file sections
+# ebook-convert reports progress on lines such as "34% Running transforms on e-book..."
+progress_re = re.compile(r'^\s*([0-9]{1,3})% (.*)$')
+dedrm_file_re = re.compile(r'^DeDRM v[0-9.]+: Trying to decrypt (.+?)\s*$', re.MULTILINE)
 drm_removal_error = 'Ultimately failed to decrypt'
 invalid_option_error = 'error: no such option'
 no_drm = 'DRM free perhaps?'
 kfx_plugin_filename = 'KFX Input.zip'
+# Only the last lines of a command's output are kept, unless the command needs to parse all of it
+output_tail_lines = 200
+output_tail_line_length = 4096
+output_markers = [invalid_option_error, drm_removal_error, no_drm]
+# How many times, and how often, deleting a library database is tried before giving up
+database_removal_attempts = 20
+database_removal_delay = 0.1
 # Qt outputs a warning to stdout if we're on Windows 10
 qt_warnings = [
     'Qt: Untested Windows version 10.0 detected!\n',
@@ -60,6 +83,10 @@ calibre_database_path = os.path.join(calibre_library_path, 'metadata.db')
 dedrm_plugin_path = os.path.join(calibre_base_path, 'DeDRM_plugin.zip')
 kfx_plugin_path = os.path.join(calibre_base_path, kfx_plugin_filename)
 
+calibre_workers_path = os.path.join(application.config_directory, 'calibre_workers')
+calibre_server_script_path = os.path.join(application.application_path, 'calibre_server.py')
+calibre_stand_in_script_path = os.path.join(application.application_path, 'calibre_stand_in.py')
+
 calibre_paths = [
     {'base': 'calibre_config', 'path': calibre_config_path},
     {'base': 'calibre_library', 'path': calibre_library_path},
@@ -67,6 +94,61 @@ calibre_paths = [
     {'base': None, 'path': calibre_temp_path},
 ]
 
+
+
+class CalibreEnvironment(object):
+    # A set of calibre config, library, cache and temp directories which commands can be run against.
+    # Each conversion worker gets its own so that parallel calibredb invocations never share a metadata.db
+    def __init__(self, config_path, library_path, cache_path, temp_path):
+        self.config_path = config_path
+        self.library_path = library_path
+        self.cache_path = cache_path
+        self.temp_path = temp_path
+        self.database_path = os.path.join(library_path, 'metadata.db')
+
+    def get_environment_variables(self):
+        environment = os.environ.copy()
+        environment['CALIBRE_CONFIG_DIRECTORY'] = self.config_path
+        environment['CALIBRE_TEMP_DIR'] = self.temp_path
+        environment['CALIBRE_CACHE_DIRECTORY'] = self.cache_path
+        environment['CALIBRE_OVERRIDE_DATABASE_PATH'] = self.database_path
+        environment['CALIBRE_OVERRIDE_LANG'] = 'en'
+        return environment
+
+    def setup(self):
+        # Worker libraries are cloned from calibre_base, but the config is cloned from the main config directory so that plug-ins installed by setup() are available to every worker
+        if not os.path.exists(self.library_path):
+            initialise_calibre_directory(self.library_path, calibre_paths[1]['base'])
+        else:
+            empty_library(self)
+            reset_library_db(self)
+        if os.path.exists(self.config_path):
+            shutil.rmtree(self.config_path)
+        try:
+            shutil.copytree(calibre_config_path, self.config_path)
+        except shutil.Error:
+            application.logger.exception('Error occured while copying calibre config to {0}'.format(self.config_path))
+            raise InitialisationError
+        for path in (self.cache_path, self.temp_path):
+            try:
+                os.makedirs(path)
+            except FileExistsError:
+                pass
+
+
+
+default_environment = CalibreEnvironment(calibre_config_path, calibre_library_path, calibre_cache_path, calibre_temp_path)
+
+def get_worker_environment(index):
+    # Worker 0 always uses the main calibre directories
+    if index == 0:
+        return default_environment
+    worker_path = os.path.join(calibre_workers_path, str(index))
+    environment = CalibreEnvironment(os.path.join(worker_path, 'calibre_config'), os.path.join(worker_path, 'calibre_library'), os.path.join(worker_path, 'calibre_cache'), os.path.join(worker_path, 'calibre_temp'))
+    environment.setup()
+    application.logger.info('Calibre worker {0} initialised in: {1}'.format(index, worker_path))
+    return environment
+
 def initialise_calibre_directory(destination, base):
     source = os.path.abspath(os.path.join(calibre_base_path, base))
     try:
@@ -110,84 +192,238 @@ def set_calibre_environment_variables():
 def setup():
     setup_calibre_directories()
     set_calibre_environment_variables()
+    plugin_paths = []
     if not os.path.exists(os.path.join(calibre_config_path, 'plugins', 'DeDRM')):
-        CalibreCustomizeAddPlugin(dedrm_plugin_path)
+        plugin_paths.append(dedrm_plugin_path)
     if not os.path.exists(os.path.join(calibre_config_path, 'plugins', kfx_plugin_filename)):
-        CalibreCustomizeAddPlugin(kfx_plugin_path)
-
-def calibre_executable_path(name):
-    return os.path.join(calibre_path, '{0}.exe'.format(name))
-
-def reset_library_db():
-    try:
-        os.remove(calibre_database_path)
-    except OSError as WindowsError:
-        reset_library_db()
+        plugin_paths.append(kfx_plugin_path)
+    # Conversions and worker environments copied from the default config both need the plug-ins, so setup isn't complete until they're installed.
+    # They're installed one at a time, as each installation rewrites calibre's plug-in configuration
+    for plugin_path in plugin_paths:
+        command = CalibreCustomizeAddPlugin(plugin_path)
+        command.completed.wait()
+        command.process_output()
+
+setup_complete = False
+setup_lock = threading.Lock()
+
+def ensure_setup():
+    # Runs setup the first time calibre is actually needed, rather than on every launch.  If setup is already running in the background, this waits for it to finish
+    global setup_complete
+    with setup_lock:
+        if not setup_complete:
+            try:
+                setup()
+            except (ExecutableNotFoundError, CommandError, InvalidCalibreOptionError):
+                # Installing plug-ins failed.  Raised as an InitialisationError so that whatever needed calibre can report it, rather than the error killing a worker thread
+                application.logger.exception('Unable to install calibre plug-ins')
+                raise InitialisationError
+            setup_complete = True
+
+class BackgroundSetup(threading.Thread):
+    # Prepares calibre while the user is still choosing files, so the first conversion doesn't have to wait for it
+    def __init__(self, *args, **kwargs):
+        super(BackgroundSetup, self).__init__(*args, **kwargs)
+        self.daemon = True
 
-    shutil.copy(os.path.join(calibre_base_path, calibre_paths[1]['base'], 'metadata.db'), calibre_library_path)
+    def run(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            ensure_setup()
+        except InitialisationError:
+            # Setup is tried again by the first conversion, which reports the error to the user
+            application.logger.exception('Unable to set up calibre in the background')
+            return
+        application.logger.info('Calibre set up in the background in {0:.4f} seconds'.format(time.perf_counter() - start))
+
+def setup_in_background():
+    thread = BackgroundSetup()
+    thread.start()
+    return thread
 
-def empty_library():
+def calibre_executable_path(name):
+    if sys.platform == 'win32':
+        name = '{0}.exe'.format(name)
+    return os.path.join(calibre_path, name)
+
+def get_executable_command(executable):
+    # With use_calibre_stand_in set, calibre_stand_in.py runs in place of each calibre executable, so the pipeline can be tested and benchmarked without calibre
+    if application.config['use_calibre_stand_in']:
+        return [sys.executable, calibre_stand_in_script_path, os.path.splitext(os.path.basename(executable))[0]]
+    return [executable]
+
+def get_process_environment(environment):
+    # Only pass an explicit environment for worker directories, so the default case inherits the variables set by set_calibre_environment_variables()
+    if environment is default_environment:
+        return None
+    return environment.get_environment_variables()
+
+def get_startup_info():
+    # Hiding console windows only applies on Windows
+    if not hasattr(subprocess, 'STARTUPINFO'):
+        return None
+    si = subprocess.STARTUPINFO()
+    si.dwFlags = subprocess.STARTF_USESHOWWINDOW
+    si.wShowWindow = subprocess.SW_HIDE
+    return si
+
+def get_server_command():
+    if application.config['use_calibre_stand_in']:
+        return [sys.executable, calibre_stand_in_script_path]
+    return [calibre_executable_path('calibre-debug'), '-e', calibre_server_script_path]
+
+server_pool = None
+server_pool_lock = threading.Lock()
+
+def get_server_pool():
+    global server_pool
+    if application.config['calibre_server_mode'] == 'off':
+        return None
+    with server_pool_lock:
+        if server_pool is None:
+            server_pool = CalibreServerPool(application.config['calibre_server_max_jobs'])
+        return server_pool
+
+def start_servers(environments):
+    pool = get_server_pool()
+    if pool is None:
+        return
+    for environment in environments:
+        try:
+            pool.prestart(environment)
+        except OSError:
+            application.logger.exception('Unable to start calibre server')
+
+def shutdown_servers():
+    global server_pool
+    with server_pool_lock:
+        if server_pool is not None:
+            server_pool.shutdown()
+            server_pool = None
+
+def reset_library_db(environment=default_environment):
+    # calibre may hold the database open for a moment after a command finishes, which stops it being deleted on Windows
+    for attempt in range(database_removal_attempts):
+        try:
+            os.remove(environment.database_path)
+            break
+        except FileNotFoundError:
+            break
+        except OSError:
+            if attempt == database_removal_attempts - 1:
+                raise
+            time.sleep(database_removal_delay)
+
+    shutil.copy(os.path.join(calibre_base_path, calibre_paths[1]['base'], 'metadata.db'), environment.library_path)
+
+def empty_library(environment=default_environment):
     def on_error(exc):
         raise exc
 
-    for root, dirs, files in os.walk(calibre_library_path, topdown=False, onerror=on_error):
+    for root, dirs, files in os.walk(environment.library_path, topdown=False, onerror=on_error):
         for name in files:
             os.remove(os.path.join(root, name))
         for name in dirs:
             os.rmdir(os.path.join(root, name))
 
-    shutil.copy(os.path.join(calibre_base_path, calibre_paths[1]['base'], 'metadata.db'), calibre_library_path)
+    shutil.copy(os.path.join(calibre_base_path, calibre_paths[1]['base'], 'metadata.db'), environment.library_path)
 
-def cleanup_temp_files():
-    for file in os.listdir(calibre_temp_path):
-        os.remove(os.path.join(calibre_temp_path, file))
+def cleanup_temp_files(environment=default_environment):
+    for file in os.listdir(environment.temp_path):
+        os.remove(os.path.join(environment.temp_path, file))
 
 
 
 class BaseCommand(object):
-    def __init__(self, *args, **kwargs):
+    # Whether the command may be run by a persistent calibre server, if they're enabled
+    use_server = True
+    # Whether self.stdout should hold the full output, rather than just its tail
+    keep_output = False
+
+    def __init__(self, *args, environment=default_environment, progress_callback=None, **kwargs):
         self.returncode = None
         self.stdout = None
+        self.environment = environment
+        self.progress_callback = progress_callback
+        # How long the command took to run, in seconds, once it has completed
+        self.duration = None
+        self.start_time = time.monotonic()
         self.command_args.insert(0, self.executable)
         try:
-            self.buffer = tempfile.NamedTemporaryFile(dir=calibre_temp_path)
             application.logger.debug('Running command: {0}'.format(subprocess.list2cmdline(self.command_args)))
-            si = subprocess.STARTUPINFO()
-            si.dwFlags = subprocess.STARTF_USESHOWWINDOW
-            si.wShowWindow = subprocess.SW_HIDE
-            self.process = subprocess.Popen(self.command_args, stdout=self.buffer, stderr=subprocess.STDOUT, startupinfo=si)
-        except WindowsError:
+            pool = get_server_pool() if self.use_server else None
+            if pool is not None:
+                command_name = os.path.splitext(os.path.basename(self.executable))[0]
+                self.process = ServerJob(pool, environment, command_name, self.command_args[1:])
+            else:
+                self.process = subprocess.Popen(get_executable_command(self.executable) + self.command_args[1:], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, startupinfo=get_startup_info(), env=get_process_environment(environment))
+        except OSError:
             raise ExecutableNotFoundError
 
+        self.cancelled = False
+        self.markers = set()
+        self.output_tail = collections.deque(maxlen=output_tail_lines)
+        self.completed = events.WakeableEvent()
+        self.waiter = threading.Thread(target=self.wait_for_process)
+        self.waiter.daemon = True
+        self.waiter.start()
+
     def log_error(self):
-        application.logger.error('Error while running command: {0}\nReturn code: {1}\n{2}'.format(subprocess.list2cmdline(self.command_args), self.return_code, self.stdout))
+        application.logger.error('Error while running command: {0}\nReturn code: {1}\nLast {2} lines of output:\n{3}'.format(subprocess.list2cmdline(self.command_args), self.return_code, len(self.output_tail), self.get_output_tail()))
 
     def cancel(self):
+        self.cancelled = True
         self.process.kill()
-        self.buffer.close()
         application.logger.debug('Process {0} with PID {1} terminated'.format(self.executable, self.process.pid))
 
-    def has_completed(self):
-        if self.process.poll() is not None:
-            self.return_code = self.process.returncode
-            self.buffer.seek(0)
-            # Avoid invalid start bytes and other errors that aren't critical by using a StreamReader
-            utf8_reader = codecs.getreader('utf-8')
-            self.stdout = utf8_reader(self.buffer, errors='replace').read()
-            self.buffer.close()
-
-            for warning in qt_warnings:
-                if warning in self.stdout:
-                    application.logger.debug(r'Stripped Qt warning from output: {0}'.format(warning.strip('\n')))
-                    self.stdout = self.stdout.replace(warning, '')
-
-            application.logger.debug('Command output:\n{0}'.format(self.stdout))
-            return True
+    def get_output_lines(self):
+        if isinstance(self.process, ServerJob):
+            return self.process.get_output_lines()
+        # Avoid invalid start bytes and other errors that aren't critical by replacing them
+        return io.TextIOWrapper(self.process.stdout, encoding='utf-8', errors='replace')
+
+    def wait_for_process(self):
+        # Runs on the waiter thread, reading output as it's produced until the process exits
+        # Error markers are picked out line by line, so that only a bounded tail of the output needs to be kept in memory
+        lines = [] if self.keep_output else None
+        for line in self.get_output_lines():
+            if line in qt_warnings:
+                application.logger.debug(r'Stripped Qt warning from output: {0}'.format(line.strip('\n')))
+                continue
+            for marker in output_markers:
+                if marker in line:
+                    self.markers.add(marker)
+            if self.progress_callback is not None:
+                progress_found = progress_re.match(line)
+                if progress_found:
+                    self.progress_callback(int(progress_found.group(1)), progress_found.group(2).strip())
+            if lines is not None:
+                lines.append(line)
+            if len(line) > output_tail_line_length:
+                line = line[:output_tail_line_length] + '...\n'
+            self.output_tail.append(line)
+        self.process.wait()
+        self.duration = time.monotonic() - self.start_time
+        self.return_code = self.process.returncode
+        if self.cancelled:
+            self.completed.set()
+            return
+
+        if lines is not None:
+            self.stdout = ''.join(lines)
         else:
-            return False
+            self.stdout = ''.join(self.output_tail)
+        self.completed.set()
+
+    def get_output_tail(self):
+        return ''.join(self.output_tail)
+
+    def has_completed(self):
+        return self.completed.is_set()
 
     def process_output(self):
-        if invalid_option_error in self.stdout:
+        application.logger.debug('Command output (last {0} lines):\n{1}'.format(len(self.output_tail), self.get_output_tail()))
+        if invalid_option_error in self.markers:
             self.log_error()
             raise InvalidCalibreOptionError
 
@@ -203,20 +439,23 @@ class BaseCommand(object):
 
 
 class CalibredbAdd(BaseCommand):
-    def __init__(self, path, *args, **kwargs):
+    keep_output = True
+
+    def __init__(self, path, *args, environment=default_environment, **kwargs):
         self.executable = calibre_executable_path('calibredb')
         self.path = path
-        self.command_args = ['add', '--library-path', calibre_library_path, '--duplicates', self.path]
-        super(CalibredbAdd, self).__init__(*args, **kwargs)
+        self.command_args = ['add', '--library-path', environment.library_path, '--duplicates', self.path]
+        super(CalibredbAdd, self).__init__(*args, environment=environment, **kwargs)
 
     def _process_output(self):
         # First, make sure the DRM removal didn't fail, but only if we're not converting
         # If the DRM couldn't be removed, conversion will fail anyway.  This avoids false positives on PDFs
-        if drm_removal_error in self.stdout and conversion.remove_drm_only:
+        if drm_removal_error in self.markers and conversion.remove_drm_only:
             self.log_error()
             raise DRMRemovalError
 
-        if conversion.remove_drm_only and no_drm in self.stdout:
+        self.drm_free = no_drm in self.markers
+        if conversion.remove_drm_only and self.drm_free:
             conversion.no_drm = True
 
         book_id_found = book_id_re.search(self.stdout)
@@ -229,11 +468,79 @@ class CalibredbAdd(BaseCommand):
 
 
 
+class CalibredbAddBatch(BaseCommand):
+    # The output is split into per-file sections, so all of it is needed
+    keep_output = True
+
+    def __init__(self, paths, *args, environment=default_environment, **kwargs):
+        self.executable = calibre_executable_path('calibredb')
+        self.paths = list(paths)
+        self.command_args = ['add', '--library-path', environment.library_path, '--duplicates'] + self.paths
+        super(CalibredbAddBatch, self).__init__(*args, environment=environment, **kwargs)
+
+    def _process_output(self):
+        # calibredb adds files in the order given, so book IDs and DeDRM sections can be matched up by position and filename
+        book_ids_found = book_ids_re.search(self.stdout)
+        if not book_ids_found:
+            self.log_error()
+            raise CommandError
+        book_ids = [int(id) for id in book_ids_found.group(1).replace(' ', '').split(',') if id]
+        if len(book_ids) != len(self.paths):
+            raise BatchAttributionError('{0} books added from {1} files'.format(len(book_ids), len(self.paths)))
+        self.added_book_ids = dict(zip(self.paths, book_ids))
+        application.logger.debug('Files added to Calibre database with IDs: {0}'.format(self.added_book_ids))
+
+        self.drm_removal_failures = set()
+        self.drm_free = set()
+        sections = self.get_file_sections()
+        for path, section in sections.items():
+            if drm_removal_error in section:
+                self.drm_removal_failures.add(path)
+            if no_drm in section:
+                self.drm_free.add(path)
+
+    def get_file_sections(self):
+        matches = list(dedrm_file_re.finditer(self.stdout))
+        if not matches:
+            if drm_removal_error in self.markers or no_drm in self.markers:
+                raise BatchAttributionError('DeDRM output without file markers')
+            return {}
+
+        preamble = self.stdout[:matches[0].start()]
+        if drm_removal_error in preamble or no_drm in preamble:
+            raise BatchAttributionError('DeDRM output before the first file marker')
+
+        paths_by_filename = {}
+        for path in self.paths:
+            paths_by_filename.setdefault(os.path.basename(path), []).append(path)
+        sections = {}
+        for index, match in enumerate(matches):
+            end = matches[index + 1].start() if index + 1 < len(matches) else len(self.stdout)
+            candidates = paths_by_filename.get(match.group(1), [])
+            # Two files in the batch with the same name are indistinguishable in DeDRM's output
+            if len(candidates) != 1:
+                raise BatchAttributionError('Unable to attribute DeDRM output for {0}'.format(match.group(1)))
+            sections[candidates[0]] = sections.get(candidates[0], '') + self.stdout[match.start():end]
+        return sections
+
+    def check_drm_removal(self, path):
+        # Mirrors the single-file checks in CalibredbAdd._process_output, but only for the given file
+        if path in self.drm_removal_failures and conversion.remove_drm_only:
+            application.logger.error('DRM removal failed for file: {0}'.format(path))
+            raise DRMRemovalError
+
+        if conversion.remove_drm_only and path in self.drm_free:
+            conversion.no_drm = True
+
+
+
 class CalibredbList(BaseCommand):
-    def __init__(self, *args, **kwargs):
+    keep_output = True
+
+    def __init__(self, *args, environment=default_environment, **kwargs):
         self.executable = calibre_executable_path('calibredb')
-        self.command_args = ['list', '--library-path', calibre_library_path, '--for-machine', '--fields', 'all']
-        super(CalibredbList, self).__init__(*args, **kwargs)
+        self.command_args = ['list', '--library-path', environment.library_path, '--for-machine', '--fields', 'all']
+        super(CalibredbList, self).__init__(*args, environment=environment, **kwargs)
 
     def _process_output(self):
         self.library = json.loads(self.stdout)
@@ -262,9 +569,139 @@ class EbookConvert(BaseCommand):
 
 
 class CalibreCustomizeAddPlugin(BaseCommand):
+    # Plug-ins are loaded when calibre starts, so servers started before installation would never see them
+    use_server = False
+
     def __init__(self, plugin_path, *args, **kwargs):
         self.executable = calibre_executable_path('calibre-customize')
         self.command_args = ['-a', plugin_path]
         super(CalibreCustomizeAddPlugin, self).__init__(*args, **kwargs)
 
 
+
+class CalibreServer(object):
+    # A persistent calibre process which runs jobs sent to it by calibre_server.py's protocol
+    def __init__(self, environment):
+        self.environment = environment
+        self.jobs_run = 0
+        self.ready = False
+        self.process = subprocess.Popen(get_server_command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, startupinfo=get_startup_info(), env=get_process_environment(environment), encoding='utf-8')
+        application.logger.debug('Started calibre server with PID {0}'.format(self.process.pid))
+
+    def read_message(self):
+        line = self.process.stdout.readline()
+        if not line:
+            raise ServerCrashedError(self.process.pid)
+        return json.loads(line)
+
+    def send_job(self, command, args):
+        if not self.ready:
+            self.read_message()
+            self.ready = True
+        self.process.stdin.write(json.dumps({'command': command, 'args': args}) + '\n')
+        self.process.stdin.flush()
+        self.jobs_run += 1
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        self.process.kill()
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        application.logger.debug('Stopped calibre server with PID {0} after {1} jobs'.format(self.process.pid, self.jobs_run))
+
+
+
+class CalibreServerPool(object):
+    # Idle calibre servers for each environment, which are recycled after a fixed number of jobs or if they crash
+    def __init__(self, max_jobs):
+        self.max_jobs = max_jobs
+        self.idle_servers = {}
+        self.lock = threading.Lock()
+
+    def prestart(self, environment):
+        with self.lock:
+            if len(self.idle_servers.get(environment, [])) > 0:
+                return
+        server = CalibreServer(environment)
+        with self.lock:
+            self.idle_servers.setdefault(environment, []).append(server)
+
+    def acquire(self, environment):
+        with self.lock:
+            servers = self.idle_servers.get(environment, [])
+            while len(servers) > 0:
+                server = servers.pop()
+                if server.is_alive():
+                    return server
+        return CalibreServer(environment)
+
+    def release(self, server, crashed=False, killed=False):
+        if killed:
+            # Cancelled jobs kill their server on purpose, so it's replaced without being reported as a crash
+            server.kill()
+            application.logger.debug('Calibre server with PID {0} was stopped by a cancelled job'.format(server.process.pid))
+            return
+        if crashed or not server.is_alive():
+            application.logger.warning('Calibre server with PID {0} crashed, a new one will be started'.format(server.process.pid))
+            server.kill()
+            return
+        if server.jobs_run >= self.max_jobs:
+            server.stop()
+            return
+        with self.lock:
+            self.idle_servers.setdefault(server.environment, []).append(server)
+
+    def shutdown(self):
+        with self.lock:
+            servers = [server for servers in self.idle_servers.values() for server in servers]
+            self.idle_servers = {}
+        for server in servers:
+            server.stop()
+
+
+
+class ServerJob(object):
+    # Stands in for a subprocess.Popen object when a command is run by a calibre server, so BaseCommand can treat both the same way
+    def __init__(self, pool, environment, command, args):
+        self.pool = pool
+        self.command = command
+        self.args = args
+        self.killed = False
+        self.returncode = None
+        self.server = pool.acquire(environment)
+        self.pid = self.server.process.pid
+
+    def get_output_lines(self):
+        # Yields output lines as the server sends them, setting the return code once the job has finished
+        crashed = False
+        try:
+            self.server.send_job(self.command, self.args)
+            while True:
+                message = self.server.read_message()
+                if 'output' in message:
+                    yield message['output']
+                else:
+                    self.returncode = message['return_code']
+                    break
+        except (ServerCrashedError, OSError, ValueError):
+            crashed = True
+            self.returncode = -1
+            if not self.killed:
+                yield 'The calibre server running this command exited unexpectedly\n'
+        finally:
+            self.pool.release(self.server, crashed, self.killed)
+
+    def wait(self):
+        return self.returncode
+
+    def kill(self):
+        # The server may be part way through a job, so it can't be reused
+        self.killed = True
+        self.server.kill()
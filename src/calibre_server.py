@@ -0,0 +1,146 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+# A long-lived calibre worker process, started with "calibre-debug -e calibre_server.py".
+# calibre's modules and plug-ins are imported once, after which calibredb and ebook-convert jobs are run in-process.
+# This script runs inside calibre's own interpreter, so it must not import any Codex modules.
+# Requests and responses are JSON objects, one per line, on stdin and stdout.
+# Each line of a job's output is sent as soon as it's written, followed by the return code:
+#   {"command": "ebook-convert", "args": ["in.azw3", "out.epub"]}
+#   {"output": "34% Running transforms on e-book...\n"}
+#   {"return_code": 0}
+
+import io
+import json
+import os
+import sys
+import traceback
+
+# Library connections opened by the current calibredb job.  calibredb normally exits once it's done,
+# so it never closes them, but a server that kept them open would stop Codex replacing metadata.db between batches
+open_db_contexts = []
+
+def run_calibredb(args):
+    from calibre.db.cli.main import main
+    try:
+        return main(['calibredb'] + args)
+    finally:
+        close_db_contexts()
+
+def track_db_contexts():
+    from calibre.db.cli import main as calibredb
+    original_init = calibredb.DBCtx.__init__
+
+    def init(self, *args, **kwargs):
+        original_init(self, *args, **kwargs)
+        open_db_contexts.append(self)
+
+    calibredb.DBCtx.__init__ = init
+
+def close_db_contexts():
+    while open_db_contexts:
+        dbctx = open_db_contexts.pop()
+        # The library is only opened once a command needs it
+        db = getattr(dbctx, '_db', None)
+        if db is None or not hasattr(db, 'close'):
+            continue
+        try:
+            db.close()
+        except Exception:
+            traceback.print_exc()
+
+def run_ebook_convert(args):
+    from calibre.ebooks.conversion.cli import main
+    return main(['ebook-convert'] + args)
+
+def run_calibre_customize(args):
+    from calibre.customize.ui import main
+    return main(['calibre-customize'] + args)
+
+calibre_handlers = {
+    'calibredb': run_calibredb,
+    'ebook-convert': run_ebook_convert,
+    'calibre-customize': run_calibre_customize,
+}
+
+def preload_calibre():
+    # Pay calibre's import and plug-in initialisation cost before the first job arrives
+    import calibre.customize.ui
+    import calibre.db.cli.main
+    import calibre.ebooks.conversion.cli
+    track_db_contexts()
+
+class OutputStream(io.TextIOBase):
+    # Replaces sys.stdout and sys.stderr while a job runs, forwarding each complete line to Codex
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.pending = ''
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.pending += text
+        while '\n' in self.pending:
+            line, self.pending = self.pending.split('\n', 1)
+            send_message(self.protocol, {'output': line + '\n'})
+        return len(text)
+
+    def close_job(self):
+        if self.pending:
+            send_message(self.protocol, {'output': self.pending})
+            self.pending = ''
+
+def send_message(protocol, message):
+    protocol.write(json.dumps(message) + '\n')
+    protocol.flush()
+
+def run_job(handler, args, protocol):
+    output = OutputStream(protocol)
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = output
+    try:
+        return_code = handler(args)
+    except SystemExit as e:
+        if e.code is None:
+            return_code = 0
+        elif isinstance(e.code, int):
+            return_code = e.code
+        else:
+            output.write('{0}\n'.format(e.code))
+            return_code = 1
+    except Exception:
+        traceback.print_exc(file=output)
+        return_code = 1
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        output.close_job()
+
+    if not isinstance(return_code, int):
+        return_code = 0
+    send_message(protocol, {'return_code': return_code})
+
+def serve(handlers):
+    # Keep a private copy of stdout for the protocol, and send anything else written to file descriptor 1 to the null device
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8')
+    null_device = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(null_device, sys.stdout.fileno())
+    requests = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+
+    send_message(protocol, {'ready': True})
+    for line in requests:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        handler = handlers.get(request['command'])
+        if handler is None:
+            send_message(protocol, {'output': 'Unknown command: {0}\n'.format(request['command'])})
+            send_message(protocol, {'return_code': 1})
+        else:
+            run_job(handler, request['args'], protocol)
+
+if __name__ == '__main__':
+    preload_calibre()
+    serve(calibre_handlers)
@@ -0,0 +1,166 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+# A stand-in for calibre, which lets the conversion pipeline be exercised without calibre installed.
+# Run with no arguments, it speaks the same protocol as calibre_server.py.
+# Run with a command name and arguments (e.g. "calibre_stand_in.py calibredb list ..."), it behaves like that calibre executable.
+# Files named "Author - Title.ext" get that author and title, and nothing is actually converted: the input is just copied to the output path.
+# Set CODEX_STAND_IN_LATENCY to a number of seconds to simulate calibre's start-up and processing time for each command.
+# Its output can be tuned for benchmarks with these environment variables:
+#   CODEX_STAND_IN_OUTPUT_LINES: extra lines of log output written for each file, as calibre and its plug-ins are often verbose
+#   CODEX_STAND_IN_DRM_FAILURE: files whose names contain this text fail DRM removal
+#   CODEX_STAND_IN_DRM_FREE: files whose names contain this text are reported as not being DRM-protected
+
+import json
+import os
+import os.path
+import shutil
+import sys
+import time
+
+import calibre_server
+
+DEDRM_FORMATS = ['azw', 'azw1', 'azw3', 'azw4', 'epub', 'kfx-zip', 'mobi', 'pdb', 'pdf', 'prc', 'tpz']
+EBOOK_CONVERT_OPTIONS = ['--unsmarten-punctuation', '--asciiize']
+STATE_FILENAME = 'stand_in_library.json'
+
+def get_latency():
+    return float(os.environ.get('CODEX_STAND_IN_LATENCY', 0))
+
+def simulate_output():
+    for index in range(int(os.environ.get('CODEX_STAND_IN_OUTPUT_LINES', 0))):
+        print('Stand-in log line {0}'.format(index))
+
+def name_matches(path, variable):
+    text = os.environ.get(variable)
+    return bool(text) and text in os.path.basename(path)
+
+def simulate_latency(fraction=1):
+    latency = get_latency() * fraction
+    if latency > 0:
+        time.sleep(latency)
+
+def get_option(args, name):
+    index = args.index(name)
+    return args[index + 1]
+
+def get_database_signature(library_path):
+    # Codex resets a library by replacing metadata.db, so the stand-in's state is only valid for the copy it was written against
+    stat = os.stat(os.path.join(library_path, 'metadata.db'))
+    return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+def load_library(library_path):
+    state_path = os.path.join(library_path, STATE_FILENAME)
+    try:
+        with open(state_path, encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return []
+    if state['signature'] != get_database_signature(library_path):
+        return []
+    return state['books']
+
+def save_library(library_path, books):
+    state = {'signature': get_database_signature(library_path), 'books': books}
+    with open(os.path.join(library_path, STATE_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+
+def get_author_and_title(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    if ' - ' in name:
+        author, title = name.split(' - ', 1)
+        return author.strip(), title.strip()
+    return 'Unknown', name
+
+def get_author_sort(author):
+    tokens = author.split()
+    if len(tokens) < 2:
+        return author
+    return '{0}, {1}'.format(tokens[-1], ' '.join(tokens[:-1]))
+
+def calibredb_add(args):
+    library_path = get_option(args, '--library-path')
+    paths = [arg for arg in args[1:] if not arg.startswith('--') and arg != library_path]
+    books = load_library(library_path)
+    next_id = max([book['id'] for book in books], default=0) + 1
+    added_ids = []
+    for path in paths:
+        extension = os.path.splitext(path)[1].lstrip('.').lower()
+        if extension in DEDRM_FORMATS:
+            print('DeDRM v10.0.3: Trying to decrypt {0}'.format(os.path.basename(path)))
+            simulate_output()
+            if name_matches(path, 'CODEX_STAND_IN_DRM_FAILURE'):
+                print('DeDRM v10.0.3: Ultimately failed to decrypt after 0.0 seconds. Read the FAQs at noDRM\'s repository')
+            elif name_matches(path, 'CODEX_STAND_IN_DRM_FREE'):
+                print('DeDRM v10.0.3: {0} is not encrypted. DRM free perhaps?'.format(os.path.basename(path)))
+            print('DeDRM v10.0.3: Finished after 0.0 seconds')
+        if not os.path.exists(path):
+            print('{0} does not exist'.format(path))
+            continue
+        author, title = get_author_and_title(path)
+        book_directory = os.path.join(library_path, author, '{0} ({1})'.format(title, next_id))
+        os.makedirs(book_directory, exist_ok=True)
+        library_copy = os.path.join(book_directory, '{0} - {1}.{2}'.format(title, author, extension))
+        shutil.copy(path, library_copy)
+        books.append({'id': next_id, 'authors': author, 'author_sort': get_author_sort(author), 'title': title, 'formats': [library_copy]})
+        added_ids.append(str(next_id))
+        next_id += 1
+
+    save_library(library_path, books)
+    print('\nAdded book ids: {0}'.format(', '.join(added_ids)))
+    return 0
+
+def calibredb_list(args):
+    library_path = get_option(args, '--library-path')
+    print(json.dumps(load_library(library_path), indent=2))
+    return 0
+
+def run_calibredb(args):
+    simulate_latency()
+    if args[0] == 'add':
+        return calibredb_add(args)
+    elif args[0] == 'list':
+        return calibredb_list(args)
+    print('calibredb: unsupported command {0}'.format(args[0]))
+    return 1
+
+def run_ebook_convert(args):
+    input_path, output_path = args[0], args[1]
+    for option in args[2:]:
+        if option.startswith('--') and option.split('=')[0] not in EBOOK_CONVERT_OPTIONS:
+            print('ebook-convert: error: no such option: {0}'.format(option))
+            return 2
+    if not os.path.exists(input_path):
+        print('{0} does not exist'.format(input_path))
+        return 1
+
+    # Spread the simulated latency across the progress lines, so they arrive over time like calibre's do
+    for percentage, message in ((1, 'Converting input to HTML...'), (34, 'Running transforms on e-book...'), (67, 'Creating output...')):
+        print('{0}% {1}'.format(percentage, message), flush=True)
+        simulate_output()
+        simulate_latency(1 / 3)
+    shutil.copy(input_path, output_path)
+    print('Output saved to   {0}'.format(output_path))
+    return 0
+
+def run_calibre_customize(args):
+    simulate_latency()
+    print('Plugin added: {0}'.format(os.path.basename(args[-1])))
+    return 0
+
+stand_in_handlers = {
+    'calibredb': run_calibredb,
+    'ebook-convert': run_ebook_convert,
+    'calibre-customize': run_calibre_customize,
+}
+
+def main():
+    if len(sys.argv) < 2:
+        calibre_server.serve(stand_in_handlers)
+        return 0
+    return stand_in_handlers[sys.argv[1]](sys.argv[2:])
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,20 +3,39 @@
 # This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
 # See the file LICENSE.txt for more details.
 import argparse
+import contextlib
 import os
 import sys
 import time
 
-import wx
-
 import application
 
+# (step, seconds) for each stage of startup, reported in the log and, if --timing is given, on stdout
+startup_timings = []
+
+@contextlib.contextmanager
+def timed(step):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings.append((step, time.perf_counter() - start))
+
+def report_timings(total, show):
+    lines = ['{0}: {1:.4f} seconds'.format(step, duration) for step, duration in startup_timings]
+    lines.append('Total: {0:.4f} seconds'.format(total))
+    for line in lines:
+        application.logger.info('Startup timing: {0}'.format(line))
+    # sys.stdout is None when running under pythonw or as a frozen windowed executable
+    if show and sys.stdout is not None:
+        print('\n'.join(lines))
+
 def process_command_line():
     import conversion
     parser = argparse.ArgumentParser()
     parser.add_argument('path', nargs='?')
     parser.add_argument('-r', '--remove-drm-only', dest='remove_drm_only', action='store_true', default=False)
-    parser.add_argument('-f', '--format', nargs='?', default=application.config['default_output_format'], choices=[format.name for format in conversion.OutputFormat])
+    parser.add_argument('-f', '--format', nargs='+', default=[application.config['default_output_format']], choices=[format.name for format in conversion.OutputFormat])
 
     args = parser.parse_args()
     if not args.path:
@@ -27,61 +46,73 @@ def process_command_line():
 
 
 def main():
-    start = time.time()
-    application.wx_app = wx.App(False)
-    single_instance_checker = wx.SingleInstanceChecker()
+    start = time.perf_counter()
+    show_timings = '--timing' in sys.argv
+    if show_timings:
+        sys.argv.remove('--timing')
+    with timed('Loading wx'):
+        import wx
+    with timed('Creating the wx application'):
+        application.wx_app = wx.App(False)
+        single_instance_checker = wx.SingleInstanceChecker()
     if single_instance_checker.IsAnotherRunning():
         wx.MessageBox('Another instance of Codex is already running.', 'Error', wx.ICON_ERROR)
         sys.exit(1)
 
-    import paths
-    paths.setup()
-    import log
-    log.setup()
+    with timed('Setting up paths and logging'):
+        import paths
+        paths.setup()
+        import log
+        log.setup()
     logger = application.logger
     logger.info('Application version: {0}'.format(application.version))
     logger.info('Application directory: {0}'.format(application.application_path))
     logger.info('Application config directory: {0}'.format(application.config_directory))
 
-    import config
-    try:
-        config.setup()
-        log.set_debug_logging(application.config['debug'])
-    except config.ConfigLoadError:
-        wx.MessageBox('Unfortunately, there was a problem loading your configuration settings.  The application will now exit.', 'Configuration Error', wx.ICON_ERROR)
-        sys.exit(1)
+    with timed('Loading configuration'):
+        import config
+        try:
+            config.setup()
+            log.set_debug_logging(application.config['debug'])
+        except config.ConfigLoadError:
+            wx.MessageBox('Unfortunately, there was a problem loading your configuration settings.  The application will now exit.', 'Configuration Error', wx.ICON_ERROR)
+            sys.exit(1)
 
-    import i18n
-    i18n.setup()
+    with timed('Loading translations'):
+        import i18n
+        i18n.setup()
 
-    import shell_integration
-    try:
-        shell_integration.setup()
-    except shell_integration.ShellIntegrationError:
-        wx.MessageBox(_('Unfortunately there was a problem integrating Codex with Windows Explorer.  Please contact the application developer.'), _('Shell Integration Error'), wx.ICON_ERROR)
-    except shell_integration.ShellIntegrationNotSupportedError:
-        if 'shell_integration_not_supported' in application.config.keys():
-            pass
-        else:
-            wx.MessageBox(_('Unfortunately, Windows Explorer integration is not currently supported on this version of Windows.'), _('Shell Integration Error'), wx.ICON_ERROR)
-            application.config['shell_integration_not_supported'] = True
-
-    import calibre
-    try:
-        calibre.setup()
-    except calibre.InitialisationError:
-        wx.MessageBox(_('Unfortunately, there was a problem initialising the configuration settings for Calibre, the tool Codex uses for eBook conversion and DRM removal.'), _('Configuration Error'), wx.ICON_ERROR)
-        sys.exit(1)
+    with timed('Shell integration'):
+        import shell_integration
+        try:
+            shell_integration.setup()
+        except shell_integration.ShellIntegrationError:
+            wx.MessageBox(_('Unfortunately there was a problem integrating Codex with Windows Explorer.  Please contact the application developer.'), _('Shell Integration Error'), wx.ICON_ERROR)
+        except shell_integration.ShellIntegrationNotSupportedError:
+            if 'shell_integration_not_supported' in application.config.keys():
+                pass
+            else:
+                wx.MessageBox(_('Unfortunately, Windows Explorer integration is not currently supported on this version of Windows.'), _('Shell Integration Error'), wx.ICON_ERROR)
+                application.config['shell_integration_not_supported'] = True
+
+    # Copying calibre's directories and installing plug-ins can take several seconds, so it's done in the background.
+    # The first conversion waits for it to finish, and reports any errors
+    with timed('Loading calibre'):
+        import calibre
+        calibre.setup_in_background()
 
     if len(sys.argv) > 1:
         process_command_line()
 
-    import gui
-    gui.setup()
-    initialised = time.time() - start
+    with timed('Creating the interface'):
+        import gui
+        gui.setup()
+    initialised = time.perf_counter() - start
     logger.info(f'Initialised in {initialised:.4f} seconds')
+    report_timings(initialised, show_timings)
     application.wx_app.MainLoop()
+    calibre.shutdown_servers()
     application.config.write()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,181 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+# Converts eBooks from the command line without a GUI, for use from scripts and scheduled tasks.
+# wx is never imported.  Progress is written to stdout as JSON objects, one per line, for example:
+#   {"event": "started", "path": "C:\\Books\\book.azw", "count": 1, "total": 3}
+#   {"event": "progress", "path": "C:\\Books\\book.azw", "percentage": 34, "message": "Running transforms on e-book..."}
+#   {"event": "converted", "path": "C:\\Books\\book.azw", "output_paths": {"epub": "C:\\eBooks\\Author\\Title.epub"}}
+#   {"event": "complete", "converted": 3, "failed": 0}
+
+import argparse
+import json
+import os.path
+import sys
+import threading
+
+import application
+
+EXIT_SUCCESS = 0
+# Some books couldn't be converted
+EXIT_FAILURES = 1
+EXIT_USAGE = 2
+# Conversion couldn't run at all, e.g. because calibre couldn't be set up
+EXIT_ERROR = 3
+EXIT_CANCELLED = 130
+
+class EventWriter(object):
+    # Receives conversion signals, which arrive on worker threads, and writes them to stdout
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.total = 0
+        self.errors = []
+
+    def write(self, event, **fields):
+        fields['event'] = event
+        with self.lock:
+            self.stream.write(json.dumps(fields) + '\n')
+            self.stream.flush()
+
+    def onConversionStarted(self, sender, **kwargs):
+        self.write('started', path=kwargs['path'], count=kwargs['count'], total=self.total)
+
+    def onConversionProgress(self, sender, **kwargs):
+        self.write('progress', path=kwargs['path'], percentage=kwargs['percentage'], message=kwargs['message'])
+
+    def onConversionTiming(self, sender, **kwargs):
+        self.write('timing', **kwargs['summary'])
+
+    def onConversionError(self, sender, **kwargs):
+        self.errors.append(kwargs['error_msg'])
+        self.write('error', message=kwargs['error_msg'])
+
+def parse_arguments(output_formats, schedules):
+    parser = argparse.ArgumentParser(description='Convert eBooks and remove DRM without a GUI.')
+    parser.add_argument('paths', nargs='*', help='files or directories to convert')
+    parser.add_argument('-f', '--format', nargs='+', choices=output_formats, help='the output format(s), defaulting to the one set in Codex')
+    parser.add_argument('-r', '--remove-drm-only', dest='remove_drm_only', action='store_true', default=False)
+    parser.add_argument('-o', '--output-directory', dest='output_directory', help='where to put converted books, defaulting to the one set in Codex')
+    parser.add_argument('-w', '--workers', type=int, help='the number of books to convert at once')
+    parser.add_argument('-s', '--schedule', choices=schedules, help='the order to convert books in, defaulting to the one set in Codex')
+    parser.add_argument('--timing', action='store_true', default=False, help='report how long each stage of conversion took')
+    parser.add_argument('--resume', action='store_true', default=False, help='carry on with the last batch, skipping books which have already been converted')
+    args = parser.parse_args()
+    if len(args.paths) == 0 and not args.resume:
+        parser.error('no files or directories given')
+    return args
+
+def setup():
+    import paths
+    paths.setup()
+    import log
+    log.setup(gui=False)
+
+    import config
+    config.setup()
+    log.set_debug_logging(application.config['debug'])
+
+    # Translations have to be installed before conversion is imported, as it translates strings at import time
+    import i18n
+    i18n.install_translations()
+
+def add_paths(paths_to_add, events):
+    import conversion
+    import paths
+    for path in paths_to_add:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            candidates = paths.scan_directory_tree(path, set(conversion.input_formats))
+            check_exists = False
+        else:
+            candidates = [path]
+            check_exists = True
+        for candidate in candidates:
+            try:
+                conversion.add_path(candidate, check_exists=check_exists)
+            except conversion.FileAlreadyAddedError:
+                continue
+            except conversion.FiletypeNotSupportedError:
+                events.write('skipped', path=candidate, reason='unsupported')
+            except conversion.FileNotFoundError:
+                events.write('skipped', path=candidate, reason='not_found')
+
+def main():
+    try:
+        setup()
+    except Exception as e:
+        sys.stderr.write('Unable to load configuration settings: {0}\n'.format(e))
+        return EXIT_ERROR
+
+    import calibre
+    import conversion
+    import scheduling
+    from signals import conversion_started, conversion_progress, conversion_error, conversion_timing
+
+    args = parse_arguments([format.name for format in conversion.OutputFormat], scheduling.SCHEDULES)
+    events = EventWriter(sys.stdout)
+    if args.output_directory:
+        application.config['output_directory'] = os.path.abspath(args.output_directory)
+    if args.schedule:
+        application.config['conversion_schedule'] = args.schedule
+    if args.resume:
+        try:
+            skipped_count = conversion.resume_last_batch()
+            events.write('resumed', skipped=skipped_count)
+        except conversion.NoBatchToResumeError:
+            pass
+    add_paths(args.paths, events)
+    events.total = len(conversion.conversion_queue)
+    if events.total == 0:
+        events.write('complete', converted=0, failed=0)
+        return EXIT_USAGE
+
+    try:
+        calibre.ensure_setup()
+    except calibre.InitialisationError:
+        events.write('error', message='Unable to initialise calibre')
+        return EXIT_ERROR
+
+    conversion.signal_dispatcher = conversion.dispatch_signal_directly
+    conversion_started.connect(events.onConversionStarted)
+    conversion_progress.connect(events.onConversionProgress)
+    conversion_error.connect(events.onConversionError)
+    if args.timing:
+        conversion_timing.connect(events.onConversionTiming)
+    # A resumed batch keeps the settings it was started with
+    if conversion.resume_batch_id is None:
+        conversion.remove_drm_only = args.remove_drm_only
+        conversion.output_format = set(args.format or [application.config['default_output_format']])
+
+    worker = conversion.ConversionWorker(worker_count=args.workers)
+    worker.start()
+    cancelled = False
+    try:
+        while worker.is_alive():
+            worker.join(1)
+    except KeyboardInterrupt:
+        cancelled = True
+        conversion.stop_conversion.set()
+        worker.join()
+    finally:
+        calibre.shutdown_servers()
+
+    for book in conversion.converted_files:
+        events.write('converted', path=book.input_path, output_paths=book.output_paths)
+    for book in conversion.failed_conversions:
+        events.write('failed', path=book.input_path)
+    events.write('complete', converted=len(conversion.converted_files), failed=len(conversion.failed_conversions))
+
+    if cancelled:
+        return EXIT_CANCELLED
+    if len(events.errors) > 0:
+        return EXIT_ERROR
+    if len(conversion.failed_conversions) > 0 or len(conversion.converted_files) < events.total:
+        return EXIT_FAILURES
+    return EXIT_SUCCESS
+
+if __name__ == '__main__':
+    sys.exit(main())
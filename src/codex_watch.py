@@ -0,0 +1,65 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+# Runs the folder watcher without a GUI, converting new books in the Kindle content directory (or another directory) as they arrive.
+# Stop it with Ctrl+C.
+
+import argparse
+import logging
+import sys
+
+import application
+
+def main():
+    parser = argparse.ArgumentParser(description='Watch a directory and convert new eBooks as they arrive.')
+    parser.add_argument('directory', nargs='?', help='the directory to watch, defaulting to the Kindle content directory')
+    parser.add_argument('--convert-existing', dest='convert_existing', action='store_true', default=False, help='on the first run, also convert books which are already in the directory')
+    args = parser.parse_args()
+
+    import paths
+    paths.setup()
+    import log
+    log.setup(gui=False)
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+    application.logger.addHandler(console)
+
+    import config
+    try:
+        config.setup()
+        log.set_debug_logging(application.config['debug'])
+    except config.ConfigLoadError:
+        application.logger.critical('Unable to load configuration settings')
+        return 1
+
+    import i18n
+    i18n.install_translations()
+
+    import calibre
+    try:
+        calibre.ensure_setup()
+    except calibre.InitialisationError:
+        application.logger.critical('Unable to initialise calibre')
+        return 1
+
+    import conversion
+    import folder_watcher
+    conversion.signal_dispatcher = conversion.dispatch_signal_directly
+    directory = args.directory or application.config['kindle_content_directory']
+    watcher = folder_watcher.FolderWatcher(directory, convert_existing=args.convert_existing)
+    watcher.start()
+    try:
+        while watcher.is_alive():
+            watcher.join(1)
+    except KeyboardInterrupt:
+        application.logger.info('Stopping folder watcher')
+        watcher.stop()
+        watcher.join()
+    finally:
+        calibre.shutdown_servers()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -25,6 +25,16 @@ def setup():
     remove_smart_punctuation = boolean(default=False)
     asciiize = boolean(default=False)
     extra_ebook_convert_options = string(default='')
+    conversion_workers = integer(default=1, min=1, max=16)
+    conversion_schedule = option('fifo', 'shortest_first', 'largest_first', default='fifo')
+    direct_conversion = boolean(default=True)
+    import_batch_size = integer(default=1, min=1, max=500)
+    calibre_server_mode = option('off', 'calibre', default='off')
+    calibre_server_max_jobs = integer(default=50, min=1)
+    conversion_cache_size = integer(default=0, min=0)
+    watch_settle_time = integer(default=5, min=1)
+    profile_conversion = boolean(default=False)
+    use_calibre_stand_in = boolean(default=False)
     debug = boolean(default=False)'''.format(default_output_directory=os.path.join(application.user_documents_path, 'eBooks'), kindle_content_directory=os.path.join(application.user_documents_path, 'My Kindle Content'), default_working_directory=application.user_documents_path))
 
     try:
@@ -2,6 +2,8 @@
 # Copyright (C) 2015 James Scholes
 # This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
 # See the file LICENSE.txt for more details.
+import collections
+import contextlib
 from enum import Enum
 import os
 import os.path
@@ -11,13 +13,17 @@ import threading
 import time
 import unicodedata
 
-import wx
-
 import application
 import calibre
+import conversion_cache
+import ebook_metadata
+import events
+import job_journal
 import models
-from paths import make_valid_filename
-from signals import conversion_started, conversion_error, conversion_complete
+import scheduling
+import stage_timing
+from paths import make_valid_filename, scan_directory_tree
+from signals import conversion_started, conversion_progress, conversion_error, conversion_complete, conversion_timing, files_found, scan_complete, stage_completed
 
 class ConversionCancelled(Exception):
     pass
@@ -34,6 +40,14 @@ class FiletypeNotSupportedError(Exception):
 class FileNotFoundError(Exception):
     pass
 
+class CachedOutputMissing(Exception):
+    # Raised if a cached output is evicted before it can be restored, and the book hasn't been imported
+    pass
+
+class NoBatchToResumeError(Exception):
+    # Raised if the last batch was finished, or can't be read from the job journal
+    pass
+
 input_formats = ['azw', 'azw3', 'azw4', 'azw8', 'cbc', 'cbr', 'cbz', 'chm', 'djvu', 'docx', 'epub', 'fb2', 'html', 'htmlz', 'kfx', 'kfx-zip', 'kpf', 'lit', 'lrf', 'mobi', 'odt', 'pdb', 'pdf', 'pml', 'prc', 'rb', 'rtf', 'snb', 'tcr', 'txt', 'txtz']
 untitled_formats = ['txt', 'txtz']
 input_wildcards = ';'.join(['*.{0}'.format(format) for format in input_formats])
@@ -48,114 +62,696 @@ class OutputFormat(Enum):
     rtf = _('Rich text format')
     txt = _('Plain text')
 
-conversion_queue = []
+class ConversionQueue(object):
+    '''
+    The books waiting to be converted, in the order they were added.
+    Books are indexed by input path, so checking for duplicates and removing a book take constant time however large the queue grows.
+    '''
+    def __init__(self):
+        self.books = collections.OrderedDict()
+        # Built on demand for index access, then kept in step with the queue rather than rebuilt after every change
+        self.snapshot = None
+
+    def __len__(self):
+        return len(self.books)
+
+    def __iter__(self):
+        return iter(list(self.books.values()))
+
+    def __contains__(self, path):
+        return path in self.books
+
+    def __getitem__(self, index):
+        if self.snapshot is None:
+            self.snapshot = list(self.books.values())
+        return self.snapshot[index]
+
+    def append(self, book):
+        self.books[book.input_path] = book
+        if self.snapshot is not None:
+            self.snapshot.append(book)
+
+    def remove(self, book, index=None):
+        # Callers which know the book's index, such as the files list, should pass it so the snapshot doesn't have to be searched
+        del self.books[book.input_path]
+        if self.snapshot is None:
+            return
+        if index is None or index >= len(self.snapshot) or self.snapshot[index] is not book:
+            index = self.snapshot.index(book)
+        del self.snapshot[index]
+
+    def clear(self):
+        self.books.clear()
+        self.snapshot = None
+
+conversion_queue = ConversionQueue()
 converted_files = []
 failed_conversions = []
 output_format = 'epub'
 remove_drm_only = False
 no_drm = False
-stop_conversion = threading.Event()
-skip_current_file = threading.Event()
+# The journal batch being resumed, whose books are recorded against it rather than a new batch
+resume_batch_id = None
+# The scheduler of the batch being converted, if any, through which priorities are changed
+active_scheduler = None
+# Minimum number of seconds between progress updates for a single book, so the main loop isn't flooded
+progress_interval = 0.25
+# Maximum number of files found by a directory scan before they're sent to the main thread
+scan_batch_size = 500
+stop_conversion = events.WakeableEvent()
+# Books the user has asked to skip, by input path.  Each worker only waits on the event for its own book, and removes it once that book is finished with
+skip_requests = {}
+skip_requests_lock = threading.Lock()
+
+def get_skip_request(path):
+    with skip_requests_lock:
+        return skip_requests.setdefault(path, events.WakeableEvent())
+
+def skip_book(path):
+    # Called from the progress dialog with the book it was showing, as another may have been announced by the time a worker notices
+    get_skip_request(path).set()
+
+def clear_skip_request(path):
+    with skip_requests_lock:
+        skip_requests.pop(path, None)
+
+def clear_skip_requests():
+    with skip_requests_lock:
+        skip_requests.clear()
+
+def dispatch_signal_on_main_thread(signal, sender, **kwargs):
+    # Signal receivers normally update the GUI, so they have to run on the main thread.  wx is imported here so that running without a GUI never loads it
+    import wx
+    wx.CallAfter(signal.send, sender, **kwargs)
+
+def dispatch_signal_directly(signal, sender, **kwargs):
+    # For running without a GUI, where receivers are called on whichever thread sent the signal
+    signal.send(sender, **kwargs)
+
+signal_dispatcher = dispatch_signal_on_main_thread
+
+def get_output_formats():
+    # output_format may be a format name, an OutputFormat member, or a collection of either
+    formats = output_format
+    if isinstance(formats, (str, OutputFormat)):
+        formats = [formats]
+    names = set(format.name if isinstance(format, OutputFormat) else format for format in formats)
+    return [format.name for format in OutputFormat if format.name in names]
 
 def filetype_not_supported(path):
     return os.path.splitext(path)[1].lstrip('.').lower() not in input_formats
 
-def add_path(path):
-    if path in [book.input_path for book in conversion_queue]:
+def add_path(path, check_exists=True):
+    if path in conversion_queue:
         raise FileAlreadyAddedError
     elif filetype_not_supported(path):
         raise FiletypeNotSupportedError
-    elif not os.path.exists(path):
+    elif check_exists and not os.path.exists(path):
         raise FileNotFoundError
 
     book = models.Book(input_path=path)
     conversion_queue.append(book)
     return book
 
+def set_priority(book, priority):
+    # Takes effect straight away if the book is waiting in a running batch
+    priority = max(scheduling.MIN_PRIORITY, min(priority, scheduling.MAX_PRIORITY))
+    scheduler = active_scheduler
+    if scheduler is not None:
+        scheduler.set_priority(book, priority)
+    else:
+        book.priority = priority
+
+def resume_last_batch():
+    '''
+    Queues the books from the last batch which weren't converted, or whose outputs have since gone missing, and restores the output formats that batch used.
+    Books which were converted are skipped without repeating any work.  Returns the number of them.
+    '''
+    global output_format, remove_drm_only, resume_batch_id
+    try:
+        journal = job_journal.JobJournal()
+    except job_journal.JournalError:
+        application.logger.exception('Unable to open the job journal')
+        raise NoBatchToResumeError
+    try:
+        batch = journal.get_unfinished_batch()
+        if batch is None:
+            raise NoBatchToResumeError
+        skipped_count = 0
+        for input_path, state, output_paths in batch.jobs:
+            if state == job_journal.CONVERTED and job_journal.outputs_exist(output_paths):
+                skipped_count += 1
+            elif state in job_journal.UNFINISHED_STATES or state == job_journal.CONVERTED:
+                try:
+                    add_path(input_path)
+                except FileAlreadyAddedError:
+                    pass
+                except FileNotFoundError:
+                    # The original has been moved or deleted since, so stop it holding the batch open
+                    journal.set_state(batch.batch_id, models.Book(input_path=input_path), job_journal.FAILED)
+    except job_journal.JournalError:
+        application.logger.exception('Unable to read the last batch from the job journal')
+        raise NoBatchToResumeError
+    finally:
+        journal.close()
+
+    if len(conversion_queue) == 0:
+        raise NoBatchToResumeError
+    output_format = batch.output_formats
+    remove_drm_only = batch.remove_drm_only
+    resume_batch_id = batch.batch_id
+    application.logger.info('Resuming batch {0}: {1} files to convert, {2} already converted'.format(batch.batch_id, len(conversion_queue), skipped_count))
+    return skipped_count
+
+
+
+class DirectoryScanner(threading.Thread):
+    '''
+    Searches a directory tree for supported files on a background thread.
+    Files are sent to the main thread in batches as they're found, via the files_found signal, followed by scan_complete.
+    '''
+    def __init__(self, path, *args, **kwargs):
+        super(DirectoryScanner, self).__init__(*args, **kwargs)
+        self.path = path
+        self.cancelled = threading.Event()
+        self.daemon = True
+
+    def run(self):
+        extensions = set(input_formats)
+        found_count = 0
+        batch = []
+        last_sent = time.monotonic()
+        for path in scan_directory_tree(self.path, extensions, self.cancelled):
+            batch.append(path)
+            if len(batch) >= scan_batch_size or time.monotonic() - last_sent >= progress_interval:
+                found_count += len(batch)
+                self.send_signal(files_found, paths=batch, count=found_count)
+                batch = []
+                last_sent = time.monotonic()
+
+        if len(batch) > 0:
+            found_count += len(batch)
+            self.send_signal(files_found, paths=batch, count=found_count)
+        self.send_signal(scan_complete, count=found_count, cancelled=self.cancelled.is_set())
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def send_signal(self, signal, **kwargs):
+        signal_dispatcher(signal, self, **kwargs)
+
 
 
 class ConversionWorker(threading.Thread):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, worker_count=None, *args, **kwargs):
         super(ConversionWorker, self).__init__(*args, **kwargs)
+        if worker_count is None:
+            worker_count = application.config['conversion_workers']
+        self.worker_count = max(1, min(worker_count, len(conversion_queue)))
+        self.batch_size = application.config['import_batch_size']
+        self.scheduler = scheduling.Scheduler(application.config['conversion_schedule'])
+        self.environments = []
+        self.counter_lock = threading.Lock()
+        self.started_count = 0
+        self.announced_books = set()
+        self.output_formats = get_output_formats()
+        self.cache_keys = {}
+        self.cache_entries = {}
+        # Books DeDRM found to be DRM-free, which is remembered in their cache entries
+        self.drm_free_books = set()
+        self.progress_times = {}
+        self.journal = None
+        self.batch_id = None
+        self.start_time = None
+        self.first_result_time = None
+        self.stage_times = stage_timing.StageTimes()
+        self.profiler = None
+        if application.config['profile_conversion']:
+            self.profiler = stage_timing.Profiler()
 
-    def run_command(self, cls, *args):
+    def run_command(self, book, cls, *args, **kwargs):
         '''
-        Instantiates an object of the given class, which should be a subclass of calibre.BaseCommand, and waits for the command to complete while periodically checking whether the user has cancelled the conversion process.
+        Instantiates an object of the given class, which should be a subclass of calibre.BaseCommand, and blocks until the command completes or the user cancels or skips, whichever happens first.
         Upon command completion, returns the object.  If the user has cancelled the process, the command is terminated and ConversionCancelled is raised to tell the conversion worker to stop what it's doing and clean up as soon as possible.
+        Skipping only applies to the book the user asked to skip, which is the one that was shown in the progress dialog at the time.
         '''
-        command = cls.__call__(*args)
-        while not command.has_completed():
-            time.sleep(0.1)
-            if stop_conversion.is_set():
-                command.cancel()
-                raise ConversionCancelled
-            if skip_current_file.is_set():
-                command.cancel()
-                raise SkipCurrentFile
+        return self.run_commands(book, [(cls, args, kwargs)])[0]
 
-        command.process_output()
-        return command
+    def run_commands(self, book, command_specs):
+        '''
+        Like run_command, but starts several commands at once from a list of (class, args, kwargs) tuples, and blocks until all of them have completed.
+        If the user cancels or skips, every command which is still running is terminated.
+        '''
+        commands = []
+        skip_request = get_skip_request(book.input_path)
+        try:
+            for cls, args, kwargs in command_specs:
+                commands.append(cls(*args, **kwargs))
+            while True:
+                pending = [command.completed for command in commands if not command.has_completed()]
+                if len(pending) == 0:
+                    break
+                if stop_conversion.is_set():
+                    raise ConversionCancelled
+                if skip_request.is_set():
+                    raise SkipCurrentFile
+                events.wait_for_any(stop_conversion, skip_request, *pending)
+        except (ConversionCancelled, SkipCurrentFile, calibre.ExecutableNotFoundError):
+            for command in commands:
+                if not command.has_completed():
+                    command.cancel()
+            raise
+
+        for command in commands:
+            self.record_stage(type(command).__name__, book, command.duration)
+        for command in commands:
+            command.process_output()
+        return commands
 
     def send_signal(self, signal, **kwargs):
-        wx.CallAfter(signal.send, self, **kwargs)
+        signal_dispatcher(signal, self, **kwargs)
+
+    def announce_book(self, book):
+        # Books in a calibre batch are announced before the import and again when converted, but only the first announcement counts
+        with self.counter_lock:
+            if book in self.announced_books:
+                return
+            self.announced_books.add(book)
+            self.started_count += 1
+            self.send_signal(conversion_started, path=book.input_path, count=self.started_count)
+
+    def record_stage(self, stage, book, duration):
+        input_format = stage_timing.get_input_format(book)
+        self.stage_times.add(stage, input_format, duration)
+        # Stages are recorded many times per book, so don't queue events for the main thread unless something is listening
+        if stage_completed.receivers:
+            self.send_signal(stage_completed, stage=stage, path=book.input_path if book is not None else None, input_format=input_format, duration=duration)
+
+    @contextlib.contextmanager
+    def timed_stage(self, stage, book=None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, book, time.monotonic() - start)
+
+    def report_progress(self, book, percentage, message):
+        now = time.monotonic()
+        if percentage < 100 and now - self.progress_times.get(book, 0) < progress_interval:
+            return
+        self.progress_times[book] = now
+        self.send_signal(conversion_progress, path=book.input_path, percentage=percentage, message=message)
+
+    def open_journal(self):
+        # Conversion carries on without the journal if it can't be opened, but the batch can't be resumed
+        try:
+            self.journal = job_journal.JobJournal()
+        except job_journal.JournalError:
+            application.logger.exception('Unable to open the job journal')
+            return
+        try:
+            if resume_batch_id is None:
+                self.batch_id = self.journal.start_batch(conversion_queue, self.output_formats, remove_drm_only)
+            else:
+                # Books added alongside the resumed ones become part of the batch
+                self.journal.add_books(resume_batch_id, conversion_queue)
+                self.batch_id = resume_batch_id
+        except job_journal.JournalError:
+            application.logger.exception('Unable to record batch in the job journal')
+            self.journal.close()
+            self.journal = None
+
+    def record_state(self, book, state):
+        if self.journal is None:
+            return
+        try:
+            self.journal.set_state(self.batch_id, book, state)
+        except job_journal.JournalError:
+            application.logger.exception('Unable to record state of file {0} in the job journal'.format(book.input_path))
+
+    def record_result(self):
+        # Notes how long the batch took to produce its first output, which is how soon the user sees anything finished
+        with self.counter_lock:
+            if self.first_result_time is None:
+                self.first_result_time = time.monotonic() - self.start_time
 
     def run(self, *args, **kwargs):
-        for index, book in enumerate(conversion_queue):
-            if stop_conversion.is_set():
-                break
+        global active_scheduler
+        self.start_time = time.monotonic()
+        conversion_cache.reset_statistics()
+        with self.timed_stage('scheduling'):
+            for book in conversion_queue:
+                self.scheduler.put(book)
+        active_scheduler = self.scheduler
+        self.open_journal()
 
-            try:
-                self.send_signal(conversion_started, path=book.input_path, count=index + 1)
-                book_id = self.run_command(calibre.CalibredbAdd, book.input_path).added_book_id
-                book_info = self.run_command(calibre.CalibredbList).get_book(book_id)
-
-                book.author = unicodedata.normalize('NFKC', book_info['authors'])
-                book.author_sort = unicodedata.normalize('NFKC', book_info['author_sort'])
-                book.title = unicodedata.normalize('NFKC', book_info['title'])
-                book.calibre_path = book_info['formats'][0]
-                if remove_drm_only:
-                    book.output_path = book.generate_output_path(extension=os.path.splitext(book.calibre_path)[1].lstrip('.'))
-                else:
-                    book.output_path = book.generate_output_path(extension=output_format)
-
-                base_path = os.path.dirname(book.output_path)
-                if not os.path.exists(base_path):
-                    os.makedirs(base_path)
-
-                if remove_drm_only:
-                    shutil.move(book.calibre_path, book.output_path)
-                else:
-                    self.run_command(calibre.EbookConvert, book.calibre_path, book.output_path)
+        try:
+            with self.timed_stage('calibre setup'):
+                calibre.ensure_setup()
+                for index in range(self.worker_count):
+                    self.environments.append(calibre.get_worker_environment(index))
+        except calibre.InitialisationError:
+            application.logger.exception('Unable to initialise calibre worker directories')
+            if len(self.environments) == 0:
+                self.send_signal(conversion_error, error_msg=_('Unfortunately, there was a problem initialising the configuration settings for Calibre, the tool Codex uses for eBook conversion and DRM removal.'))
+                self.cleanup()
+                return
+
+        application.logger.info('Converting {0} files with {1} worker(s)'.format(len(conversion_queue), len(self.environments)))
+        with self.timed_stage('server startup'):
+            calibre.start_servers(self.environments)
+        threads = []
+        for environment in self.environments:
+            if self.profiler is not None:
+                thread = threading.Thread(target=self.profiler.run, args=(self.process_books, environment))
+            else:
+                thread = threading.Thread(target=self.process_books, args=(environment,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
 
-                converted_files.append(book)
-                calibre.reset_library_db()
-            except ConversionCancelled:
-                calibre.reset_library_db()
+        self.cleanup()
+
+    def get_next_books(self):
+        books = []
+        while len(books) < self.batch_size:
+            book = self.scheduler.get()
+            if book is None:
                 break
-            except SkipCurrentFile:
-                skip_current_file.clear()
-                calibre.reset_library_db()
-                continue
-            except calibre.InvalidCalibreOptionError:
-                self.send_signal(conversion_error, error_msg=_('One or more of the custom options provided to ebook-convert.exe were not valid.  Please check your configuration.'))
+            books.append(book)
+        return books
+
+    def process_books(self, environment):
+        while not stop_conversion.is_set():
+            books = self.get_next_books()
+            if len(books) == 0:
                 break
-            except (FileNotFoundError, calibre.CommandError, calibre.DRMRemovalError) as e:
-                application.logger.exception('Exception occurred while converting file: {0}'.format(book.input_path))
-                failed_conversions.append(book)
-                calibre.reset_library_db()
-                continue
-            except calibre.ExecutableNotFoundError:
-                self.send_signal(conversion_error, error_msg=_('The required utilities for eBook conversion could not be found.  Please reinstall the application.'))
+            if not self.process_batch(books, environment):
                 break
 
-        self.cleanup()
+    def process_batch(self, books, environment):
+        '''
+        Converts a batch of books taken from the queue, returning False if the worker should stop.
+        DRM-free books are converted directly, while the rest are imported with as few calibredb invocations as possible.
+        '''
+        calibre_books = []
+        for book in books:
+            if self.is_fully_cached(book):
+                if not self.process_book(book, environment, self.restore_cached_book):
+                    return False
+                continue
 
-    def cleanup(self):
+            metadata = self.get_direct_conversion_metadata(book)
+            if metadata is None:
+                calibre_books.append(book)
+            elif not self.process_book(book, environment, self.convert_book_directly, metadata):
+                return False
+
+        if len(calibre_books) == 0:
+            return True
         try:
-            calibre.empty_library()
-        except WindowsError:
-            time.sleep(0.1)
-            self.cleanup()
+            if len(calibre_books) == 1:
+                return self.process_book(calibre_books[0], environment, self.convert_book)
+            return self.process_calibre_batch(calibre_books, environment)
+        finally:
+            self.reset_library_db(environment)
+
+    def process_book(self, book, environment, convert, *args):
+        # Converts a single book, returning False if the worker should stop
+        try:
+            self.announce_book(book)
+            self.record_state(book, job_journal.CONVERTING)
+            convert(book, environment, *args)
+            converted_files.append(book)
+            self.record_result()
+            self.record_state(book, job_journal.CONVERTED)
+        except ConversionCancelled:
+            return False
+        except SkipCurrentFile:
+            self.record_state(book, job_journal.SKIPPED)
+        except calibre.InvalidCalibreOptionError:
+            self.send_signal(conversion_error, error_msg=_('One or more of the custom options provided to ebook-convert.exe were not valid.  Please check your configuration.'))
+            # Other workers would only hit the same error, so stop them too
+            stop_conversion.set()
+            return False
+        except (FileNotFoundError, calibre.CommandError, calibre.DRMRemovalError) as e:
+            application.logger.exception('Exception occurred while converting file: {0}'.format(book.input_path))
+            failed_conversions.append(book)
+            self.record_state(book, job_journal.FAILED)
+        except calibre.ExecutableNotFoundError:
+            self.send_signal(conversion_error, error_msg=_('The required utilities for eBook conversion could not be found.  Please reinstall the application.'))
+            stop_conversion.set()
+            return False
+        finally:
+            # A skip which arrives as the book finishes has nothing left to skip
+            clear_skip_request(book.input_path)
+        return True
+
+    def process_calibre_batch(self, books, environment):
+        first_book = books[0]
+        try:
+            self.announce_book(first_book)
+            add_command = self.run_command(first_book, calibre.CalibredbAddBatch, [book.input_path for book in books], environment=environment)
+            list_command = self.run_command(first_book, calibre.CalibredbList, environment=environment)
+        except ConversionCancelled:
+            return False
+        except calibre.ExecutableNotFoundError:
+            self.send_signal(conversion_error, error_msg=_('The required utilities for eBook conversion could not be found.  Please reinstall the application.'))
+            stop_conversion.set()
+            return False
+        except (SkipCurrentFile, calibre.CommandError, calibre.BatchAttributionError) as e:
+            # Fall back to importing the files one at a time, so that any errors are attributed to the right book
+            if isinstance(e, SkipCurrentFile):
+                clear_skip_request(first_book.input_path)
+                self.record_state(first_book, job_journal.SKIPPED)
+                books = books[1:]
+            else:
+                application.logger.warning('Batched import failed, importing files individually: {0}'.format(e))
+            for book in books:
+                self.reset_library_db(environment, book)
+                if not self.process_book(book, environment, self.convert_book):
+                    return False
+            return True
+
+        for book in books:
+            if not self.process_book(book, environment, self.convert_imported_book, add_command, list_command):
+                return False
+        return True
+
+    def is_fully_cached(self, book):
+        # Looks up each of the book's outputs in the cache, returning True if all of them are cached
+        if not conversion_cache.is_enabled():
+            return False
+        try:
+            with self.timed_stage('cache lookup', book):
+                content_hash = conversion_cache.hash_file(book.input_path)
+        except OSError:
+            application.logger.exception('Unable to calculate cache key for file: {0}'.format(book.input_path))
+            return False
+
+        # Only removing DRM produces a single output regardless of options, which is cached under the format None
+        if remove_drm_only:
+            keys = {None: conversion_cache.get_key(content_hash, None, None)}
+        else:
+            options = conversion_cache.get_ebook_convert_options()
+            keys = dict((format, conversion_cache.get_key(content_hash, format, options)) for format in self.output_formats)
+        self.cache_keys[book] = keys
+
+        entries = {}
+        for format, key in keys.items():
+            entry = conversion_cache.lookup(key)
+            if entry is not None:
+                entries[format] = entry
+        self.cache_entries[book] = entries
+        cached = len(entries) == len(keys)
+        conversion_cache.record_lookup(cached)
+        return cached
+
+    def restore_cached_book(self, book, environment):
+        entry = next(iter(self.cache_entries[book].values()))
+        self.set_book_metadata(book, entry['author'], entry['author_sort'], entry['title'])
+        if entry.get('drm_free'):
+            self.mark_drm_free(book)
+        try:
+            self.write_output(book, environment)
+            application.logger.debug('File {0} restored from conversion cache'.format(book.input_path))
+            return
+        except CachedOutputMissing:
+            del self.cache_entries[book]
+
+        # An entry was evicted by another worker, so convert the book as if it had never been cached
+        metadata = self.get_direct_conversion_metadata(book)
+        if metadata is not None:
+            self.convert_book_directly(book, environment, metadata)
+        else:
+            self.reset_library_db(environment, book)
+            self.convert_book(book, environment)
+
+    def store_in_cache(self, book, format, output_path):
+        key = self.cache_keys.get(book, {}).get(format)
+        if key is None:
+            return
+        try:
+            with self.timed_stage('cache store', book):
+                conversion_cache.store(key, book, output_path, drm_free=book in self.drm_free_books)
+        except OSError:
+            application.logger.exception('Unable to store file in conversion cache: {0}'.format(output_path))
+
+    def get_direct_conversion_metadata(self, book):
+        if not application.config['direct_conversion'] or not ebook_metadata.supports_direct_conversion(book.input_path):
+            return None
+        try:
+            with self.timed_stage('direct conversion metadata', book):
+                return ebook_metadata.get_metadata(book.input_path)
+        except ebook_metadata.EbookMetadataError:
+            application.logger.debug('File {0} needs importing into calibre, so the direct conversion path will not be used'.format(book.input_path))
+            return None
+
+    def mark_drm_free(self, book):
+        global no_drm
+        self.drm_free_books.add(book)
+        if remove_drm_only:
+            no_drm = True
+
+    def convert_book(self, book, environment):
+        add_command = self.run_command(book, calibre.CalibredbAdd, book.input_path, environment=environment)
+        if add_command.drm_free:
+            self.mark_drm_free(book)
+        book_id = add_command.added_book_id
+        book_info = self.run_command(book, calibre.CalibredbList, environment=environment).get_book(book_id)
+        self.convert_library_book(book, environment, book_info)
+
+    def convert_imported_book(self, book, environment, add_command, list_command):
+        add_command.check_drm_removal(book.input_path)
+        if book.input_path in add_command.drm_free:
+            self.mark_drm_free(book)
+        book_info = list_command.get_book(add_command.added_book_ids[book.input_path])
+        if book_info is None:
+            raise calibre.CommandError('Book {0} not found in calibre library'.format(book.input_path))
+        self.convert_library_book(book, environment, book_info)
+
+    def convert_library_book(self, book, environment, book_info):
+        self.set_book_metadata(book, book_info['authors'], book_info['author_sort'], book_info['title'])
+        book.calibre_path = book_info['formats'][0]
+        self.write_output(book, environment)
+
+    def convert_book_directly(self, book, environment, metadata):
+        # DRM-free files don't need DeDRM, so skip calibredb entirely and convert the original file
+        application.logger.debug('File {0} is not DRM-protected, converting directly'.format(book.input_path))
+        self.set_book_metadata(book, metadata['author'], metadata['author_sort'], metadata['title'])
+        book.calibre_path = book.input_path
+        self.mark_drm_free(book)
+        self.write_output(book, environment)
+
+    def set_book_metadata(self, book, author, author_sort, title):
+        with self.timed_stage('metadata normalisation', book):
+            book.author = unicodedata.normalize('NFKC', author)
+            book.author_sort = unicodedata.normalize('NFKC', author_sort)
+            book.title = unicodedata.normalize('NFKC', title)
+
+    def write_output(self, book, environment):
+        cache_entries = self.cache_entries.get(book, {})
+        if remove_drm_only:
+            if None in cache_entries:
+                extension = cache_entries[None]['extension']
+            elif book.calibre_path is not None:
+                extension = os.path.splitext(book.calibre_path)[1].lstrip('.')
+            else:
+                raise CachedOutputMissing
+            book.output_path = book.generate_output_path(extension=extension)
+            book.output_paths = {extension: book.output_path}
+            # Another worker may create the same output directory at the same time, hence exist_ok
+            with self.timed_stage('makedirs', book):
+                os.makedirs(os.path.dirname(book.output_path), exist_ok=True)
+            if None in cache_entries and self.restore_from_cache(book, cache_entries[None], book.output_path):
+                return
+            if book.calibre_path is None:
+                raise CachedOutputMissing
+
+            # Files converted directly are still the user's originals, so they must be copied rather than moved
+            if book.calibre_path == book.input_path:
+                with self.timed_stage('copy', book):
+                    shutil.copy(book.calibre_path, book.output_path)
+            else:
+                with self.timed_stage('move', book):
+                    shutil.move(book.calibre_path, book.output_path)
+            self.store_in_cache(book, None, book.output_path)
+            return
+
+        # Every output format is converted from the same decrypted file at once
+        book.output_paths = {}
+        command_specs = []
+        converted_paths = {}
+        progress = {}
+        for format in self.output_formats:
+            output_path = book.generate_output_path(extension=format)
+            book.output_paths[format] = output_path
+            with self.timed_stage('makedirs', book):
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            if format in cache_entries and self.restore_from_cache(book, cache_entries[format], output_path):
+                continue
+            if book.calibre_path is None:
+                raise CachedOutputMissing
+
+            progress[format] = 0
+            progress_callback = self.get_progress_callback(book, format, progress)
+            command_specs.append((calibre.EbookConvert, (book.calibre_path, output_path), {'environment': environment, 'progress_callback': progress_callback}))
+            converted_paths[format] = output_path
+
+        book.output_path = book.output_paths[self.output_formats[0]]
+        self.run_commands(book, command_specs)
+        for format, output_path in converted_paths.items():
+            self.store_in_cache(book, format, output_path)
+
+    def restore_from_cache(self, book, entry, output_path):
+        with self.timed_stage('cache restore', book):
+            return conversion_cache.restore(entry, output_path)
+
+    def get_progress_callback(self, book, format, progress):
+        # When converting to several formats at once, the book's progress is the average across all of them
+        def progress_callback(percentage, message):
+            progress[format] = percentage
+            self.report_progress(book, sum(progress.values()) // len(progress), message)
+        return progress_callback
+
+    def cleanup(self):
+        global active_scheduler
+        active_scheduler = None
+        for environment in self.environments:
+            with self.timed_stage('empty_library'):
+                self.empty_library(environment)
+        if self.journal is not None:
+            self.journal.close()
+
+        summary = self.stage_times.get_summary(time.monotonic() - self.start_time, self.first_result_time, self.scheduler.schedule)
+        application.logger.info('Conversion timings:\n{0}'.format(stage_timing.format_summary(summary)))
+        self.send_signal(conversion_timing, summary=summary)
+        if self.profiler is not None:
+            try:
+                self.profiler.write()
+            except OSError:
+                application.logger.exception('Unable to save conversion profile')
+
+        if conversion_cache.is_enabled():
+            statistics = conversion_cache.get_statistics()
+            application.logger.info('Conversion cache: {0} hits, {1} misses'.format(statistics['hits'], statistics['misses']))
 
         self.send_signal(conversion_complete)
         return
+
+    def reset_library_db(self, environment, book=None):
+        # Books left in the library are harmless, so carry on if the database couldn't be replaced
+        try:
+            with self.timed_stage('reset_library_db', book):
+                calibre.reset_library_db(environment)
+        except OSError:
+            application.logger.exception('Unable to reset calibre library database: {0}'.format(environment.database_path))
+
+    def empty_library(self, environment):
+        try:
+            calibre.empty_library(environment)
+        except OSError:
+            time.sleep(0.1)
+            self.empty_library(environment)
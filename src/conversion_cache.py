@@ -0,0 +1,181 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+
+import application
+
+# Output files are stored as <key>.<extension>, alongside a <key>.json file holding the metadata needed to recreate the output path
+cache_path = os.path.join(application.config_directory, 'conversion_cache')
+hash_chunk_size = 1024 * 1024
+cache_lock = threading.Lock()
+hits = 0
+misses = 0
+# Each cached key's size, last use and files, and the size of the whole cache, loaded on the first store
+entries = None
+total_size = 0
+
+def is_enabled():
+    return application.config['conversion_cache_size'] > 0
+
+def hash_file(input_path):
+    content_hash = hashlib.sha256()
+    with open(input_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(hash_chunk_size), b''):
+            content_hash.update(chunk)
+    return content_hash.digest()
+
+def get_key(content_hash, output_format, options):
+    '''
+    Returns a cache key made up of the input file's content hash, the output format and the options which affect the output.
+    output_format should be None when only removing DRM, as the output is then the decrypted input.
+    '''
+    key = hashlib.sha256()
+    key.update(content_hash)
+    key.update(json.dumps([output_format, options]).encode('utf-8'))
+    return key.hexdigest()
+
+def get_ebook_convert_options():
+    return [application.config['remove_smart_punctuation'], application.config['asciiize'], application.config['extra_ebook_convert_options']]
+
+def get_metadata_path(key):
+    return os.path.join(cache_path, '{0}.json'.format(key))
+
+def load_entries():
+    # Scans the cache directory once, after which entries and total_size are kept up to date as files are stored and evicted.  Must be called with cache_lock held
+    global entries, total_size
+    if entries is not None:
+        return
+    entries = {}
+    total_size = 0
+    try:
+        files = list(os.scandir(cache_path))
+    except FileNotFoundError:
+        files = []
+    for file in files:
+        if file.name.endswith('.tmp'):
+            # Another worker may still be writing it
+            continue
+        key = file.name.split('.', 1)[0]
+        stat = file.stat()
+        entry = entries.setdefault(key, {'size': 0, 'last_used': 0, 'paths': set()})
+        entry['size'] += stat.st_size
+        entry['last_used'] = max(entry['last_used'], stat.st_mtime)
+        entry['paths'].add(file.path)
+        total_size += stat.st_size
+
+def lookup(key):
+    # Returns the cached metadata, including the cached file's path, or None on a miss
+    with cache_lock:
+        try:
+            with open(get_metadata_path(key), encoding='utf-8') as f:
+                entry = json.load(f)
+            entry['path'] = os.path.join(cache_path, '{0}.{1}'.format(key, entry['extension']))
+            # Bump the modification time so that eviction treats this as recently used
+            os.utime(entry['path'])
+            os.utime(get_metadata_path(key))
+        except (OSError, ValueError, KeyError):
+            return None
+
+        if entries is not None and key in entries:
+            entries[key]['last_used'] = time.time()
+        return entry
+
+def record_lookup(hit):
+    # Books are counted rather than formats, so a book with only some of its outputs cached counts as a miss
+    global hits, misses
+    with cache_lock:
+        if hit:
+            hits += 1
+        else:
+            misses += 1
+
+def restore(entry, destination):
+    # Copies a cached file to destination, returning False if it has been evicted in the meantime
+    with cache_lock:
+        try:
+            shutil.copy(entry['path'], destination)
+        except OSError:
+            application.logger.exception('Unable to restore cached file: {0}'.format(entry['path']))
+            return False
+    return True
+
+def write_temporary_file(key, write):
+    # Returns the path of a uniquely named temporary file in the cache directory, filled in by write, so that workers storing at the same time never share one
+    fd, path = tempfile.mkstemp(dir=cache_path, prefix='{0}.'.format(key), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+    except:
+        os.remove(path)
+        raise
+    return path
+
+def store(key, book, output_path, drm_free=False):
+    # drm_free records that DeDRM found nothing to remove, so a later hit can tell the user the same thing
+    global total_size
+    extension = os.path.splitext(output_path)[1].lstrip('.')
+    entry = {'author': book.author, 'author_sort': book.author_sort, 'title': book.title, 'extension': extension, 'drm_free': drm_free}
+    cached_file_path = os.path.join(cache_path, '{0}.{1}'.format(key, extension))
+    metadata_path = get_metadata_path(key)
+    os.makedirs(cache_path, exist_ok=True)
+
+    # Copying can take a while for large books, so it's done before taking the lock.  Temporary files are never treated as hits
+    def copy_output(f):
+        with open(output_path, 'rb') as source:
+            shutil.copyfileobj(source, f)
+    temporary_file_path = write_temporary_file(key, copy_output)
+    try:
+        temporary_metadata_path = write_temporary_file(key, lambda f: f.write(json.dumps(entry).encode('utf-8')))
+    except:
+        os.remove(temporary_file_path)
+        raise
+
+    with cache_lock:
+        load_entries()
+        os.replace(temporary_file_path, cached_file_path)
+        os.replace(temporary_metadata_path, metadata_path)
+        old_entry = entries.pop(key, None)
+        if old_entry is not None:
+            total_size -= old_entry['size']
+        size = os.path.getsize(cached_file_path) + os.path.getsize(metadata_path)
+        entries[key] = {'size': size, 'last_used': time.time(), 'paths': {cached_file_path, metadata_path} | (old_entry['paths'] if old_entry is not None else set())}
+        total_size += size
+        evict(application.config['conversion_cache_size'] * 1024 * 1024)
+
+def evict(max_size):
+    # Removes least recently used entries until the cache fits within max_size bytes.  Must be called with cache_lock held, after load_entries
+    global total_size
+    if total_size <= max_size:
+        return
+    for key, entry in sorted(entries.items(), key=lambda item: item[1]['last_used']):
+        if total_size <= max_size:
+            break
+        for path in entry['paths']:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                application.logger.exception('Unable to remove cached file: {0}'.format(path))
+        del entries[key]
+        total_size -= entry['size']
+        application.logger.debug('Evicted conversion cache entry: {0}'.format(key))
+
+def get_statistics():
+    with cache_lock:
+        return {'hits': hits, 'misses': misses}
+
+def reset_statistics():
+    global hits, misses
+    with cache_lock:
+        hits = 0
+        misses = 0
@@ -0,0 +1,284 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+import codecs
+import os
+import os.path
+import re
+import xml.etree.ElementTree as ElementTree
+import zipfile
+import zlib
+
+# Formats which never need DeDRM once we've checked that they aren't encrypted, and whose metadata we can read without calibre
+DIRECT_FORMATS = ['docx', 'epub', 'pdf', 'txt']
+UNKNOWN_AUTHOR = 'Unknown'
+# Font obfuscation algorithms are listed in encryption.xml, but don't prevent conversion
+EPUB_FONT_OBFUSCATION_ALGORITHMS = [
+    'http://www.idpf.org/2008/embedding',
+    'http://ns.adobe.com/pdf/enc#RC',
+]
+AUTHOR_SUFFIXES = ['jr', 'jr.', 'sr', 'sr.', 'ii', 'iii', 'iv', 'phd', 'ph.d', 'ph.d.']
+NAMESPACES = {
+    'container': 'urn:oasis:names:tc:opendocument:xmlns:container',
+    'opf': 'http://www.idpf.org/2007/opf',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'enc': 'http://www.w3.org/2001/04/xmlenc#',
+}
+PDF_SCAN_SIZE = 1024 * 1024
+PDF_STRING_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f', b'(': b'(', b')': b')', b'\\': b'\\'}
+# The trailer's reference to the document information dictionary, the only place a PDF's title and author are stored; outline entries and annotations have titles of their own
+PDF_INFO_REFERENCE_EXPRESSION = re.compile(rb'/Info\s+(\d+)\s+(\d+)\s+R')
+PDF_INFO_EXPRESSION = re.compile(rb'/(Title|Author)\s*(\((?:\\.|[^\\)])*\)|<[0-9A-Fa-f\s]*>)', re.DOTALL)
+
+class EbookMetadataError(Exception):
+    pass
+
+class DRMProtectedError(EbookMetadataError):
+    pass
+
+def supports_direct_conversion(path):
+    return get_extension(path) in DIRECT_FORMATS
+
+def get_metadata(path):
+    '''
+    Returns a dictionary containing the author, author_sort and title of a DRM-free eBook, falling back to the same defaults as calibre when a field is missing.
+    Raises DRMProtectedError if the file appears to be encrypted, or EbookMetadataError if it can't be read at all, in which case the file should go through calibredb instead.
+    '''
+    extension = get_extension(path)
+    try:
+        if extension == 'epub':
+            metadata = get_epub_metadata(path)
+        elif extension == 'docx':
+            metadata = get_docx_metadata(path)
+        elif extension == 'pdf':
+            metadata = get_pdf_metadata(path)
+        elif extension == 'txt':
+            metadata = {}
+        else:
+            raise EbookMetadataError(path)
+    except (OSError, zipfile.BadZipFile, ElementTree.ParseError, KeyError) as e:
+        raise EbookMetadataError(path) from e
+    except (RuntimeError, NotImplementedError, UnicodeDecodeError, EOFError, zlib.error) as e:
+        # zipfile raises these for encrypted members, unsupported compression methods and corrupt data, and text can fail to decode.  None of them should stop the file going through calibredb
+        raise EbookMetadataError(path) from e
+
+    if not metadata.get('title'):
+        metadata['title'] = os.path.splitext(os.path.basename(path))[0]
+    if not metadata.get('author'):
+        metadata['author'] = UNKNOWN_AUTHOR
+    if not metadata.get('author_sort'):
+        metadata['author_sort'] = get_author_sort(metadata['author'])
+    return metadata
+
+def get_extension(path):
+    return os.path.splitext(path)[1].lstrip('.').lower()
+
+def get_author_sort(author):
+    # Mirrors calibre's default author sort: "First Middle Last" becomes "Last, First Middle"
+    sorted_authors = []
+    for name in author.split(' & '):
+        tokens = name.split()
+        if len(tokens) < 2 or ',' in name:
+            sorted_authors.append(name.strip())
+            continue
+        suffix = ''
+        if tokens[-1].lower() in AUTHOR_SUFFIXES:
+            suffix = ' ' + tokens.pop()
+        sorted_authors.append('{0}, {1}{2}'.format(tokens[-1], ' '.join(tokens[:-1]), suffix))
+
+    return ' & '.join(sorted_authors)
+
+def get_epub_metadata(path):
+    with zipfile.ZipFile(path) as epub:
+        names = epub.namelist()
+        if 'META-INF/rights.xml' in names:
+            raise DRMProtectedError(path)
+        if 'META-INF/encryption.xml' in names:
+            check_epub_encryption(epub.read('META-INF/encryption.xml'), path)
+
+        container = ElementTree.fromstring(epub.read('META-INF/container.xml'))
+        rootfile = container.find('container:rootfiles/container:rootfile', NAMESPACES)
+        if rootfile is None:
+            raise EbookMetadataError(path)
+        opf_path = rootfile.get('full-path')
+        opf = ElementTree.fromstring(epub.read(opf_path))
+
+    metadata_element = opf.find('opf:metadata', NAMESPACES)
+    if metadata_element is None:
+        return {}
+
+    metadata = {}
+    title = metadata_element.find('dc:title', NAMESPACES)
+    if title is not None and title.text:
+        metadata['title'] = title.text.strip()
+
+    # EPUB 3 moves file-as into refining meta elements
+    file_as = {}
+    for meta in metadata_element.findall('opf:meta', NAMESPACES):
+        if meta.get('property') == 'file-as' and meta.get('refines', '').startswith('#') and meta.text:
+            file_as[meta.get('refines')[1:]] = meta.text.strip()
+
+    authors = []
+    author_sorts = []
+    for creator in metadata_element.findall('dc:creator', NAMESPACES):
+        role = creator.get('{{{0}}}role'.format(NAMESPACES['opf']))
+        if role not in (None, 'aut') or not creator.text:
+            continue
+        authors.append(creator.text.strip())
+        sort = creator.get('{{{0}}}file-as'.format(NAMESPACES['opf'])) or file_as.get(creator.get('id'))
+        author_sorts.append(sort.strip() if sort else get_author_sort(creator.text.strip()))
+
+    if authors:
+        metadata['author'] = ' & '.join(authors)
+        metadata['author_sort'] = ' & '.join(author_sorts)
+    return metadata
+
+def check_epub_encryption(encryption_xml, path):
+    encryption = ElementTree.fromstring(encryption_xml)
+    for method in encryption.iter('{{{0}}}EncryptionMethod'.format(NAMESPACES['enc'])):
+        if method.get('Algorithm') not in EPUB_FONT_OBFUSCATION_ALGORITHMS:
+            raise DRMProtectedError(path)
+
+def get_docx_metadata(path):
+    # Rights-managed Word documents are stored as OLE compound files rather than ZIP packages
+    if not zipfile.is_zipfile(path):
+        raise DRMProtectedError(path)
+
+    with zipfile.ZipFile(path) as docx:
+        try:
+            core = ElementTree.fromstring(docx.read('docProps/core.xml'))
+        except KeyError:
+            return {}
+
+    metadata = {}
+    title = core.find('dc:title', NAMESPACES)
+    if title is not None and title.text:
+        metadata['title'] = title.text.strip()
+    creator = core.find('dc:creator', NAMESPACES)
+    if creator is not None and creator.text:
+        metadata['author'] = creator.text.strip()
+    return metadata
+
+def get_pdf_metadata(path):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as stream:
+        head = stream.read(PDF_SCAN_SIZE)
+        if not head.startswith(b'%PDF'):
+            raise EbookMetadataError(path)
+        if size > PDF_SCAN_SIZE:
+            stream.seek(max(PDF_SCAN_SIZE, size - PDF_SCAN_SIZE))
+            tail = stream.read()
+        else:
+            tail = b''
+
+    # The trailer is normally at the end of the file, or near the start for linearised PDFs
+    if b'/Encrypt' in head or b'/Encrypt' in tail:
+        raise DRMProtectedError(path)
+
+    info = find_pdf_info_dictionary(path, (tail, head))
+    metadata = {}
+    for match in PDF_INFO_EXPRESSION.finditer(info):
+        key = match.group(1).decode('ascii').lower()
+        if key not in metadata:
+            value = decode_pdf_string(match.group(2)).strip()
+            if value:
+                metadata[key] = value
+    return metadata
+
+def find_pdf_info_dictionary(path, chunks):
+    '''
+    Follows the trailer's /Info reference to the document information dictionary, returning its contents.
+    Later revisions are appended to the end of the file, so the last reference and object found in each chunk win, and chunks are searched in the order given.
+    Raises EbookMetadataError if either can't be found, such as when the dictionary is inside a compressed object stream.
+    '''
+    for data in chunks:
+        references = PDF_INFO_REFERENCE_EXPRESSION.findall(data)
+        if references:
+            number, generation = references[-1]
+            break
+    else:
+        raise EbookMetadataError(path)
+
+    object_expression = re.compile(rb'(?<![0-9])' + number + rb'\s+' + generation + rb'\s+obj\s*<<')
+    for data in chunks:
+        matches = list(object_expression.finditer(data))
+        if matches:
+            info = read_pdf_dictionary(data, matches[-1].end())
+            if info is None:
+                raise EbookMetadataError(path)
+            return info
+    raise EbookMetadataError(path)
+
+def read_pdf_dictionary(data, start):
+    # Returns the contents of the dictionary opened just before start, or None if it isn't closed.  Strings are skipped over, as they may contain brackets
+    depth = 1
+    index = start
+    while index < len(data):
+        if data.startswith(b'<<', index):
+            depth += 1
+            index += 2
+        elif data.startswith(b'>>', index):
+            depth -= 1
+            if depth == 0:
+                return data[start:index]
+            index += 2
+        elif data.startswith(b'(', index):
+            nesting = 1
+            index += 1
+            while index < len(data) and nesting > 0:
+                char = data[index:index + 1]
+                if char == b'\\':
+                    index += 2
+                    continue
+                if char == b'(':
+                    nesting += 1
+                elif char == b')':
+                    nesting -= 1
+                index += 1
+        elif data.startswith(b'<', index):
+            end = data.find(b'>', index)
+            if end == -1:
+                return None
+            index = end + 1
+        else:
+            index += 1
+    return None
+
+def decode_pdf_string(token):
+    if token.startswith(b'<'):
+        digits = re.sub(rb'\s', b'', token[1:-1]).decode('ascii')
+        # An odd number of hex digits is padded with a trailing zero
+        if len(digits) % 2:
+            digits += '0'
+        value = bytes.fromhex(digits)
+    else:
+        value = unescape_pdf_literal(token[1:-1])
+
+    if value.startswith(codecs.BOM_UTF16_BE):
+        return value[2:].decode('utf-16-be', errors='replace')
+    return value.decode('latin-1')
+
+def unescape_pdf_literal(literal):
+    result = bytearray()
+    index = 0
+    while index < len(literal):
+        char = literal[index:index + 1]
+        if char != b'\\':
+            result += char
+            index += 1
+            continue
+        escape = literal[index + 1:index + 2]
+        if escape in PDF_STRING_ESCAPES:
+            result += PDF_STRING_ESCAPES[escape]
+            index += 2
+        elif escape and escape in b'01234567':
+            octal = re.match(rb'[0-7]{1,3}', literal[index + 1:index + 4]).group(0)
+            result.append(int(octal, 8) & 0xff)
+            index += 1 + len(octal)
+        else:
+            # Line continuations and unknown escapes are dropped
+            index += 2
+
+    return bytes(result)
@@ -0,0 +1,43 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+import threading
+
+class WakeableEvent(threading.Event):
+    '''
+    A threading.Event which also sets any wakeup events linked to it.
+    This allows a thread to block until any one of several events is set, without having to poll each of them in turn.
+    '''
+    def __init__(self):
+        super(WakeableEvent, self).__init__()
+        self._wakeups = set()
+        self._wakeups_lock = threading.Lock()
+
+    def link(self, wakeup):
+        with self._wakeups_lock:
+            self._wakeups.add(wakeup)
+        # The event may have been set before we were linked
+        if self.is_set():
+            wakeup.set()
+
+    def unlink(self, wakeup):
+        with self._wakeups_lock:
+            self._wakeups.discard(wakeup)
+
+    def set(self):
+        super(WakeableEvent, self).set()
+        with self._wakeups_lock:
+            wakeups = list(self._wakeups)
+        for wakeup in wakeups:
+            wakeup.set()
+
+def wait_for_any(*events, timeout=None):
+    wakeup = threading.Event()
+    for event in events:
+        event.link(wakeup)
+    try:
+        return wakeup.wait(timeout)
+    finally:
+        for event in events:
+            event.unlink(wakeup)
@@ -0,0 +1,354 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+# Watches a directory, normally the Kindle content directory, and converts new books as they arrive.
+# Changes come from ReadDirectoryChangesW on Windows or inotify on Linux, falling back to polling where neither is available.
+# A file is only converted once its size and modification time have stopped changing, and every file that has been dealt with is recorded so that restarting the watcher doesn't convert it again.
+
+import ctypes
+import ctypes.util
+import ctypes.wintypes
+import os
+import os.path
+import select
+import sqlite3
+import struct
+import sys
+import threading
+import time
+
+import application
+import conversion
+from paths import scan_directory_tree
+from signals import conversion_error
+
+record_path = os.path.join(application.config_directory, 'watch_folder.db')
+# Seconds between checks on files which are still being written, and between scans when polling
+CHECK_INTERVAL = 1.0
+POLL_INTERVAL = 30.0
+CHANGE_BUFFER_SIZE = 64 * 1024
+
+class ChangeSourceUnavailableError(Exception):
+    pass
+
+class ProcessedFiles(object):
+    # Records each file the watcher has dealt with, along with the size and modification time it had at the time
+    def __init__(self, path=None):
+        self.connection = sqlite3.connect(path or record_path)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS processed (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL, status TEXT NOT NULL)')
+
+    def is_empty(self):
+        return self.connection.execute('SELECT COUNT(*) FROM processed').fetchone()[0] == 0
+
+    def contains(self, path, stat):
+        row = self.connection.execute('SELECT size, mtime FROM processed WHERE path = ?', (path,)).fetchone()
+        return row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns
+
+    def add(self, files, status):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO processed (path, size, mtime, status) VALUES (?, ?, ?, ?)', [(path, stat.st_size, stat.st_mtime_ns, status) for path, stat in files])
+
+    def close(self):
+        self.connection.close()
+
+class PollingChangeSource(object):
+    # Reports that everything may have changed every POLL_INTERVAL seconds
+    def __init__(self, directory):
+        self.directory = directory
+        self.next_poll = 0
+
+    def wait(self, timeout):
+        '''
+        Blocks for up to timeout seconds, returning a set of paths which have changed.
+        None means that changes may have been missed, so the whole directory should be scanned.
+        '''
+        now = time.monotonic()
+        if now >= self.next_poll:
+            self.next_poll = now + POLL_INTERVAL
+            return None
+        time.sleep(min(timeout, self.next_poll - now))
+        return set()
+
+    def close(self):
+        pass
+
+class InotifyChangeSource(object):
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, directory):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.file_descriptor = self.libc.inotify_init1(self.IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            raise ChangeSourceUnavailableError from e
+        if self.file_descriptor < 0:
+            raise ChangeSourceUnavailableError(os.strerror(ctypes.get_errno()))
+        # inotify isn't recursive, so every subdirectory needs a watch of its own
+        self.watches = {}
+        self.add_watch(directory)
+        for path, directories, filenames in os.walk(directory):
+            for name in directories:
+                self.add_watch(os.path.join(path, name))
+
+    def add_watch(self, directory):
+        mask = self.IN_MODIFY|self.IN_CLOSE_WRITE|self.IN_MOVED_TO|self.IN_CREATE|self.IN_DELETE_SELF
+        watch_descriptor = self.libc.inotify_add_watch(self.file_descriptor, os.fsencode(directory), mask)
+        if watch_descriptor < 0:
+            application.logger.warning('Unable to watch directory {0}: {1}'.format(directory, os.strerror(ctypes.get_errno())))
+            return
+        self.watches[watch_descriptor] = directory
+
+    def wait(self, timeout):
+        readable, writable, exceptional = select.select([self.file_descriptor], [], [], timeout)
+        if not readable:
+            return set()
+
+        data = os.read(self.file_descriptor, CHANGE_BUFFER_SIZE)
+        changes = set()
+        offset = 0
+        while offset < len(data):
+            watch_descriptor, mask, cookie, name_length = self.EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + self.EVENT_HEADER.size:offset + self.EVENT_HEADER.size + name_length].rstrip(b'\x00'))
+            offset += self.EVENT_HEADER.size + name_length
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            if mask & self.IN_DELETE_SELF:
+                self.watches.pop(watch_descriptor, None)
+                continue
+            if watch_descriptor not in self.watches or not name:
+                continue
+            path = os.path.join(self.watches[watch_descriptor], name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE|self.IN_MOVED_TO):
+                    # Files may have been added to the new directory before its watch was in place
+                    self.add_watch(path)
+                    changes.update(scan_directory_tree(path))
+            else:
+                changes.add(path)
+        return changes
+
+    def close(self):
+        os.close(self.file_descriptor)
+
+class OVERLAPPED(ctypes.Structure):
+    _fields_ = [
+        ('Internal', ctypes.c_size_t),
+        ('InternalHigh', ctypes.c_size_t),
+        ('Offset', ctypes.wintypes.DWORD),
+        ('OffsetHigh', ctypes.wintypes.DWORD),
+        ('hEvent', ctypes.wintypes.HANDLE),
+    ]
+
+class WindowsChangeSource(object):
+    FILE_LIST_DIRECTORY = 0x1
+    FILE_SHARE_ALL = 0x1|0x2|0x4
+    OPEN_EXISTING = 3
+    FILE_FLAG_BACKUP_SEMANTICS = 0x02000000
+    FILE_FLAG_OVERLAPPED = 0x40000000
+    FILE_NOTIFY_CHANGE_FILE_NAME = 0x1
+    FILE_NOTIFY_CHANGE_DIR_NAME = 0x2
+    FILE_NOTIFY_CHANGE_SIZE = 0x8
+    FILE_NOTIFY_CHANGE_LAST_WRITE = 0x10
+    FILE_ACTION_REMOVED = 2
+    FILE_ACTION_RENAMED_OLD_NAME = 4
+    WAIT_OBJECT_0 = 0
+    INVALID_HANDLE_VALUE = ctypes.wintypes.HANDLE(-1).value
+    # next entry offset, action, file name length in bytes
+    NOTIFY_HEADER = struct.Struct('<III')
+
+    def __init__(self, directory):
+        try:
+            self.kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        except (OSError, AttributeError) as e:
+            raise ChangeSourceUnavailableError from e
+        self.kernel32.CreateFileW.restype = ctypes.wintypes.HANDLE
+        self.kernel32.CreateFileW.argtypes = [ctypes.wintypes.LPCWSTR, ctypes.wintypes.DWORD, ctypes.wintypes.DWORD, ctypes.c_void_p, ctypes.wintypes.DWORD, ctypes.wintypes.DWORD, ctypes.wintypes.HANDLE]
+        self.kernel32.CreateEventW.restype = ctypes.wintypes.HANDLE
+        self.kernel32.CreateEventW.argtypes = [ctypes.c_void_p, ctypes.wintypes.BOOL, ctypes.wintypes.BOOL, ctypes.wintypes.LPCWSTR]
+        self.kernel32.ResetEvent.argtypes = [ctypes.wintypes.HANDLE]
+        self.kernel32.ReadDirectoryChangesW.argtypes = [ctypes.wintypes.HANDLE, ctypes.c_void_p, ctypes.wintypes.DWORD, ctypes.wintypes.BOOL, ctypes.wintypes.DWORD, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+        self.kernel32.WaitForSingleObject.argtypes = [ctypes.wintypes.HANDLE, ctypes.wintypes.DWORD]
+        self.kernel32.GetOverlappedResult.argtypes = [ctypes.wintypes.HANDLE, ctypes.c_void_p, ctypes.c_void_p, ctypes.wintypes.BOOL]
+        self.kernel32.CancelIoEx.argtypes = [ctypes.wintypes.HANDLE, ctypes.c_void_p]
+        self.kernel32.CloseHandle.argtypes = [ctypes.wintypes.HANDLE]
+
+        self.directory = directory
+        self.handle = self.kernel32.CreateFileW(directory, self.FILE_LIST_DIRECTORY, self.FILE_SHARE_ALL, None, self.OPEN_EXISTING, self.FILE_FLAG_BACKUP_SEMANTICS|self.FILE_FLAG_OVERLAPPED, None)
+        if self.handle == self.INVALID_HANDLE_VALUE:
+            raise ChangeSourceUnavailableError(ctypes.FormatError(ctypes.get_last_error()))
+        self.overlapped = OVERLAPPED()
+        self.overlapped.hEvent = self.kernel32.CreateEventW(None, True, False, None)
+        self.buffer = ctypes.create_string_buffer(CHANGE_BUFFER_SIZE)
+        self.start_read()
+
+    def start_read(self):
+        self.kernel32.ResetEvent(self.overlapped.hEvent)
+        mask = self.FILE_NOTIFY_CHANGE_FILE_NAME|self.FILE_NOTIFY_CHANGE_DIR_NAME|self.FILE_NOTIFY_CHANGE_SIZE|self.FILE_NOTIFY_CHANGE_LAST_WRITE
+        if not self.kernel32.ReadDirectoryChangesW(self.handle, self.buffer, len(self.buffer), True, mask, None, ctypes.byref(self.overlapped), None):
+            raise ChangeSourceUnavailableError(ctypes.FormatError(ctypes.get_last_error()))
+
+    def wait(self, timeout):
+        if self.kernel32.WaitForSingleObject(self.overlapped.hEvent, int(timeout * 1000)) != self.WAIT_OBJECT_0:
+            return set()
+        transferred = ctypes.wintypes.DWORD()
+        self.kernel32.GetOverlappedResult(self.handle, ctypes.byref(self.overlapped), ctypes.byref(transferred), False)
+        data = self.buffer.raw[:transferred.value]
+        self.start_read()
+        # Nothing is returned if the buffer overflowed
+        if transferred.value == 0:
+            return None
+
+        changes = set()
+        offset = 0
+        while True:
+            next_entry_offset, action, name_length = self.NOTIFY_HEADER.unpack_from(data, offset)
+            name_start = offset + self.NOTIFY_HEADER.size
+            name = data[name_start:name_start + name_length].decode('utf-16-le')
+            if action not in (self.FILE_ACTION_REMOVED, self.FILE_ACTION_RENAMED_OLD_NAME):
+                path = os.path.join(self.directory, name)
+                if os.path.isdir(path):
+                    changes.update(scan_directory_tree(path))
+                else:
+                    changes.add(path)
+            if next_entry_offset == 0:
+                break
+            offset += next_entry_offset
+        return changes
+
+    def close(self):
+        self.kernel32.CancelIoEx(self.handle, None)
+        self.kernel32.CloseHandle(self.overlapped.hEvent)
+        self.kernel32.CloseHandle(self.handle)
+
+def stat_files(paths):
+    files = []
+    for path in paths:
+        try:
+            files.append((path, os.stat(path)))
+        except OSError:
+            continue
+    return files
+
+def get_change_source(directory):
+    if sys.platform == 'win32':
+        native_source = WindowsChangeSource
+    elif sys.platform.startswith('linux'):
+        native_source = InotifyChangeSource
+    else:
+        native_source = None
+
+    if native_source is not None:
+        try:
+            return native_source(directory)
+        except ChangeSourceUnavailableError:
+            application.logger.exception('Unable to watch {0} for changes, falling back to polling'.format(directory))
+    return PollingChangeSource(directory)
+
+class FolderWatcher(threading.Thread):
+    def __init__(self, directory, convert_existing=False, settle_time=None, *args, **kwargs):
+        super(FolderWatcher, self).__init__(*args, **kwargs)
+        self.directory = directory
+        self.convert_existing = convert_existing
+        if settle_time is None:
+            settle_time = application.config['watch_settle_time']
+        self.settle_time = settle_time
+        self.stopped = threading.Event()
+        # path -> ((size, mtime), time at which that signature was first seen)
+        self.pending_files = {}
+
+    def stop(self):
+        self.stopped.set()
+        conversion.stop_conversion.set()
+
+    def run(self):
+        processed_files = ProcessedFiles()
+        change_source = get_change_source(self.directory)
+        application.logger.info('Watching {0} for new books using {1}'.format(self.directory, type(change_source).__name__))
+        try:
+            # Files which arrived while the watcher wasn't running are picked up by the first scan
+            if processed_files.is_empty() and not self.convert_existing:
+                existing_files = stat_files(scan_directory_tree(self.directory, set(conversion.input_formats)))
+                processed_files.add(existing_files, 'existing')
+                application.logger.info('Recorded {0} existing files without converting them'.format(len(existing_files)))
+            changes = None
+            while not self.stopped.is_set():
+                if changes is None:
+                    changes = set(scan_directory_tree(self.directory, set(conversion.input_formats)))
+                for path in changes:
+                    if not conversion.filetype_not_supported(path):
+                        self.pending_files.setdefault(path, None)
+
+                ready_files = [(path, stat) for path, stat in self.get_settled_files() if not processed_files.contains(path, stat)]
+                if len(ready_files) > 0:
+                    self.convert(ready_files, processed_files)
+                changes = change_source.wait(CHECK_INTERVAL)
+        finally:
+            change_source.close()
+            processed_files.close()
+
+    def get_settled_files(self):
+        # Returns files whose size and modification time haven't changed for settle_time seconds, as they've most likely finished downloading
+        now = time.monotonic()
+        settled_files = []
+        for path, state in list(self.pending_files.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending_files[path]
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if state is None or state[0] != signature:
+                self.pending_files[path] = (signature, now)
+            elif now - state[1] >= self.settle_time:
+                settled_files.append((path, stat))
+                del self.pending_files[path]
+        return settled_files
+
+    def convert(self, files, processed_files):
+        application.logger.info('Converting {0} new files'.format(len(files)))
+        conversion.conversion_queue.clear()
+        conversion.converted_files = []
+        conversion.failed_conversions = []
+        conversion.remove_drm_only = False
+        conversion.output_format = application.config['default_output_format']
+        for path, stat in files:
+            try:
+                conversion.add_path(path)
+            except (conversion.FileAlreadyAddedError, conversion.FiletypeNotSupportedError, conversion.FileNotFoundError):
+                continue
+
+        conversion_error.connect(self.onConversionError)
+        try:
+            worker = conversion.ConversionWorker()
+            worker.start()
+            worker.join()
+        finally:
+            conversion_error.disconnect(self.onConversionError)
+        if self.stopped.is_set():
+            return
+
+        # Failed files are recorded too, so that they aren't retried until they change
+        stats = dict(files)
+        processed_files.add([(book.input_path, stats[book.input_path]) for book in conversion.converted_files], 'converted')
+        processed_files.add([(book.input_path, stats[book.input_path]) for book in conversion.failed_conversions], 'failed')
+        for book in conversion.converted_files:
+            application.logger.info('Converted {0} to {1}'.format(book.input_path, book.output_path))
+        for book in conversion.failed_conversions:
+            application.logger.warning('Failed to convert {0}'.format(book.input_path))
+        conversion.stop_conversion.clear()
+        conversion.clear_skip_requests()
+        conversion.conversion_queue.clear()
+
+    def onConversionError(self, sender, **kwargs):
+        application.logger.error('Conversion error: {0}'.format(kwargs['error_msg']))
@@ -4,7 +4,6 @@
 # See the file LICENSE.txt for more details.
 import os.path
 import subprocess
-import webbrowser
 
 import wx
 import wx.lib.sized_controls as sc
@@ -14,11 +13,11 @@ import calibre
 import clipboard
 import conversion
 import models
-import paths
 
 from . import conversion_pipeline
 from . import dialogs
-from .utils import create_button, create_labelled_field, get_output_format_choices
+from .controls import VirtualList
+from .utils import change_selected_book_priority, create_button, create_labelled_field, get_book_label, get_checked_output_formats, get_output_format_checklist
 
 
 class MainWindow(sc.SizedFrame):
@@ -37,13 +36,14 @@ class MainWindow(sc.SizedFrame):
         if not os.path.exists(readme_path):
             readme_path = os.path.join(documentation_directory, 'readme-en.html')
 
+        import webbrowser
         webbrowser.open(readme_path)
 
     def remove_file(self, selected_item):
         if selected_item != -1:
-            book = self.files_list.GetClientData(selected_item)
-            conversion.conversion_queue.remove(book)
-            self.files_list.Delete(selected_item)
+            book = conversion.conversion_queue[selected_item]
+            conversion.conversion_queue.remove(book, selected_item)
+            self.files_list.refresh()
             try:
                 if self.files_list.GetCount() != 0:
                     if selected_item == self.files_list.GetCount():
@@ -70,10 +70,11 @@ class MainWindow(sc.SizedFrame):
         main_panel.SetSizerType('vertical')
 
         files_list_label = wx.StaticText(main_panel, label=_('Files'))
-        self.files_list = wx.ListBox(main_panel, style=wx.LB_NEEDED_SB)
+        # The list reads straight from the conversion queue, so it stays fast however many files are added
+        self.files_list = VirtualList(main_panel, _('Path'), lambda: len(conversion.conversion_queue), lambda index: get_book_label(conversion.conversion_queue[index]))
         self.files_list.SetSizerProps(expand=True, proportion=1)
         self.files_list.Bind(wx.EVT_CHAR, self.onFilesListKeyPressed)
-        self.files_list.Bind(wx.EVT_LISTBOX, self.onFilesListSelectionChange)
+        self.files_list.Bind(wx.EVT_LIST_ITEM_SELECTED, self.onFilesListSelectionChange)
 
         files_list_buttons_panel = sc.SizedPanel(main_panel)
         files_list_buttons_panel.SetSizerType('horizontal')
@@ -86,7 +87,7 @@ class MainWindow(sc.SizedFrame):
         self.main_buttons_panel.SetSizerType('horizontal')
         self.main_buttons_panel.Disable()
 
-        self.output_formats = get_output_format_choices(self.main_buttons_panel, _('O&utput format'))
+        self.output_formats = get_output_format_checklist(self.main_buttons_panel, _('O&utput formats'))
         self.output_formats.Disable()
 
         self.convert_button = create_button(self.main_buttons_panel, _('&Convert'), self.onConvert, wx.ID_CONVERT)
@@ -115,6 +116,8 @@ class MainWindow(sc.SizedFrame):
         self.Bind(wx.EVT_MENU, self.onAddFiles, add_files)
         add_directory = file_menu.Append(wx.NewId(), _('Add &directory...\tCtrl+D'))
         self.Bind(wx.EVT_MENU, self.onAddDirectory, add_directory)
+        resume_last_batch = file_menu.Append(wx.NewId(), _('&Resume last batch...'))
+        self.Bind(wx.EVT_MENU, self.onResumeLastBatch, resume_last_batch)
         file_menu.AppendSeparator()
         options = file_menu.Append(wx.ID_PREFERENCES, _('&Options...\tCtrl+P'))
         self.Bind(wx.EVT_MENU, self.onOptions, options)
@@ -126,6 +129,8 @@ class MainWindow(sc.SizedFrame):
         tools_menu = wx.Menu()
         find_book_from_url = tools_menu.Append(wx.NewId(), _('&Find Kindle file from Amazon URL...'))
         self.Bind(wx.EVT_MENU, self.onFindBookFromUrl, find_book_from_url)
+        find_books_from_urls = tools_menu.Append(wx.NewId(), _('Find Kindle files from &multiple Amazon URLs...'))
+        self.Bind(wx.EVT_MENU, self.onFindBooksFromUrls, find_books_from_urls)
         browse_kindle_books = tools_menu.Append(wx.NewId(), _('&Browse downloaded Kindle books...'))
         self.Bind(wx.EVT_MENU, self.onBrowseKindleBooks, browse_kindle_books)
         if not application.is_frozen:
@@ -151,7 +156,7 @@ class MainWindow(sc.SizedFrame):
         self.remove_drm_button.Disable()
         self.main_buttons_panel.Disable()
         self.output_formats.Disable()
-        self.files_list.Clear()
+        self.files_list.refresh()
         self.files_list.SetFocus()
 
     def onFilesListKeyPressed(self, event):
@@ -159,14 +164,11 @@ class MainWindow(sc.SizedFrame):
             self.remove_file(self.files_list.GetSelection())
         elif event.GetKeyCode() == wx.WXK_CONTROL_V:
             self.paste_files_from_clipboard()
-        else:
+        elif not change_selected_book_priority(self.files_list, event.GetKeyCode()):
             event.Skip()
 
     def onFilesListSelectionChange(self, event):
-        if event.IsSelection():
-            self.remove_file_button.Enable()
-        else:
-            event.Skip()
+        self.remove_file_button.Enable()
 
     def onAdd(self, event):
         self.PopupMenu(self.add_menu, self.add_button.GetScreenPosition())
@@ -191,9 +193,14 @@ class MainWindow(sc.SizedFrame):
         result = folder_dialog.ShowModal()
 
         if result == wx.ID_OK:
-            conversion_pipeline.add_paths(paths.walk_directory_tree(folder_dialog.GetPath()), parent=self, from_folder=True)
+            conversion_pipeline.add_directory(folder_dialog.GetPath(), parent=self)
             application.config['working_directory'] = os.path.split(folder_dialog.GetPath())[0]
             self.files_list.SetFocus()
+            if self.files_list.GetCount() != 0:
+                self.convert_button.Enable()
+                self.remove_drm_button.Enable()
+                self.main_buttons_panel.Enable()
+                self.output_formats.Enable()
 
     def onRemoveFile(self, event):
         if self.files_list.GetCount() != 0:
@@ -206,7 +213,31 @@ class MainWindow(sc.SizedFrame):
         self.reset()
 
     def onConvert(self, event):
-        conversion.output_format = self.output_formats.GetClientData(self.output_formats.GetSelection())
+        output_formats = get_checked_output_formats(self.output_formats)
+        if len(output_formats) == 0:
+            wx.MessageBox(_('Please choose at least one output format.'), _('Error'), wx.ICON_ERROR, parent=self)
+            self.output_formats.SetFocus()
+            return
+        conversion.output_format = output_formats
+        conversion_pipeline.start(parent=self)
+        self.reset()
+
+    def onResumeLastBatch(self, event):
+        if self.files_list.GetCount() != 0:
+            wx.MessageBox(_('Please convert or remove the files which have already been added before resuming the last batch.'), _('Error'), wx.ICON_ERROR, parent=self)
+            return
+        try:
+            skipped_count = conversion.resume_last_batch()
+        except conversion.NoBatchToResumeError:
+            wx.MessageBox(_('There is no unfinished batch to resume.'), _('Error'), wx.ICON_ERROR, parent=self)
+            return
+
+        self.files_list.refresh()
+        message = _('{count} files from the last batch still need to be converted, and {skipped} which have already been converted will be skipped.  Would you like to resume converting them now?').format(count=len(conversion.conversion_queue), skipped=skipped_count)
+        if wx.MessageBox(message, _('Resume last batch'), wx.YES_NO|wx.ICON_QUESTION, parent=self) != wx.YES:
+            conversion_pipeline.cleanup()
+            self.reset()
+            return
         conversion_pipeline.start(parent=self)
         self.reset()
 
@@ -215,21 +246,28 @@ class MainWindow(sc.SizedFrame):
         options_dialog.ShowModal()
 
     def onCalibreEnvironment(self, event):
-        calibre.setup()
+        try:
+            calibre.ensure_setup()
+        except calibre.InitialisationError:
+            wx.MessageBox(_('Unfortunately, there was a problem initialising the configuration settings for Calibre, the tool Codex uses for eBook conversion and DRM removal.'), _('Configuration Error'), wx.ICON_ERROR, parent=self)
+            return
         subprocess.Popen(['cmd.exe'], cwd=calibre.calibre_path, creationflags=subprocess.CREATE_NEW_CONSOLE)
 
     def onFindBookFromUrl(self, event):
         find_dialog = dialogs.FindBookFromURLDialog(self)
         find_dialog.ShowModal()
 
+    def onFindBooksFromUrls(self, event):
+        find_dialog = dialogs.FindBooksFromURLsDialog(self)
+        find_dialog.ShowModal()
+
     def onBrowseKindleBooks(self, event):
         if not os.path.exists(application.config['kindle_content_directory']):
             wx.MessageBox(_('The configured Kindle content directory does not exist.'), _('Error'), wx.ICON_ERROR, parent=self)
             return
 
-        kindle_files = os.listdir(application.config['kindle_content_directory'])
-        kindle_files.sort(key=lambda path: os.stat(os.path.join(application.config['kindle_content_directory'], path)).st_ctime)
-        kindle_files = [file for file in kindle_files if file.endswith('azw')]
+        import kindle_index
+        kindle_files = kindle_index.scan_content_directory(application.config['kindle_content_directory'])
         if len(kindle_files) == 0:
             wx.MessageBox(_('No Kindle files found.  Please make sure that the Kindle content directory setting is correct in the Codex Options dialog.'), _('Error'), wx.ICON_ERROR, parent=self)
             return
@@ -241,6 +279,7 @@ class MainWindow(sc.SizedFrame):
         self.open_readme()
 
     def onHomePage(self, event):
+        import webbrowser
         webbrowser.open(application.url)
 
     def onOpenConfigDirectory(self, event):
@@ -264,7 +303,8 @@ def setup():
             wx.MessageBox(_('The specified file or directory does not exist.'), _('Error'), wx.ICON_ERROR, parent=None)
             return
         if os.path.isdir(args.path):
-            conversion_pipeline.add_paths(paths.walk_directory_tree(args.path), from_folder=True)
+            if not conversion_pipeline.add_directory(args.path):
+                return
             if len(conversion.conversion_queue) == 0:
                 wx.MessageBox(_('No supported files were found in the specified directory.'), _('Error'), wx.ICON_ERROR, parent=None)
                 return
@@ -276,6 +316,6 @@ def setup():
 
         conversion.remove_drm_only = args.remove_drm_only
         if not conversion.remove_drm_only:
-            conversion.output_format = conversion.OutputFormat[args.format].name
+            conversion.output_format = set(conversion.OutputFormat[format].name for format in args.format)
         conversion_pipeline.start()
         return
\ No newline at end of file
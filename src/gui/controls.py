@@ -0,0 +1,54 @@
+# Codex
+# Copyright (C) 2020 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+import wx
+from wx.lib.mixins.listctrl import ListCtrlAutoWidthMixin
+
+class VirtualList(wx.ListCtrl, ListCtrlAutoWidthMixin):
+    '''
+    A single column list which asks for the text of each row only when it's drawn, instead of holding a copy of every item.
+    get_item_count and get_item_text read from the data structure behind the list, and refresh should be called whenever that changes.
+    Selection methods mirror those of wx.ListBox.
+    '''
+    def __init__(self, parent, label, get_item_count, get_item_text, multiple_selection=False):
+        style = wx.LC_REPORT|wx.LC_VIRTUAL
+        if not multiple_selection:
+            style |= wx.LC_SINGLE_SEL
+        wx.ListCtrl.__init__(self, parent, style=style)
+        ListCtrlAutoWidthMixin.__init__(self)
+        self.get_item_count = get_item_count
+        self.get_item_text = get_item_text
+        self.InsertColumn(0, label)
+        self.refresh()
+
+    def OnGetItemText(self, item, column):
+        return self.get_item_text(item)
+
+    def refresh(self):
+        count = self.get_item_count()
+        self.SetItemCount(count)
+        if count > 0:
+            # Only rows which are on screen are redrawn
+            top = self.GetTopItem()
+            self.RefreshItems(top, min(top + self.GetCountPerPage(), count - 1))
+
+    def GetCount(self):
+        return self.GetItemCount()
+
+    def GetSelection(self):
+        return self.GetFirstSelected()
+
+    def GetSelections(self):
+        selections = []
+        item = self.GetFirstSelected()
+        while item != -1:
+            selections.append(item)
+            item = self.GetNextSelected(item)
+        return selections
+
+    def SetSelection(self, item):
+        for selected_item in self.GetSelections():
+            self.Select(selected_item, on=False)
+        self.Select(item)
+        self.Focus(item)
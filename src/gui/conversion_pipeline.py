@@ -9,14 +9,16 @@ import conversion
 
 from . import dialogs
 
-def add_paths(path_list, parent=None, from_folder=False):
+def add_paths(path_list, parent=None, from_folder=False, report_duplicates=True):
+    # Returns the paths which had already been added, so callers which turn off report_duplicates can summarise them instead
+    duplicate_paths = []
     for path in path_list:
         try:
-            book = conversion.add_path(path)
-            if parent is not None:
-                application.main_window.files_list.Append(book.input_path, book)
+            # Files found by scanning a folder are known to exist, so don't check each one again
+            conversion.add_path(path, check_exists=not from_folder)
         except conversion.FileAlreadyAddedError:
-            if not from_folder:
+            duplicate_paths.append(path)
+            if not from_folder and report_duplicates:
                 wx.MessageBox(_('File {file} has already been added.').format(file=path), _('Error'), wx.ICON_ERROR, parent=parent)
             continue
         except conversion.FiletypeNotSupportedError:
@@ -28,6 +30,17 @@ def add_paths(path_list, parent=None, from_folder=False):
                 wx.MessageBox(_('The specified file does not exist.'), _('Error'), wx.ICON_ERROR, parent=parent)
             continue
 
+    if parent is not None:
+        application.main_window.files_list.refresh()
+    return duplicate_paths
+
+def add_directory(path, parent=None):
+    # Returns False if the user cancelled the scan, although any files found before then are still added
+    scan_dialog = dialogs.DirectoryScanDialog(parent, path)
+    result = scan_dialog.ShowModal()
+    scan_dialog.Destroy()
+    return result == wx.ID_OK
+
 def start(parent=None):
     if len(conversion.conversion_queue) == 0:
         wx.MessageBox(_('No files have been added for conversion.'), _('Error'), wx.ICON_ERROR, parent=parent)
@@ -52,9 +65,10 @@ def start(parent=None):
 
 def cleanup():
     conversion.stop_conversion.clear()
-    conversion.skip_current_file.clear()
-    conversion.conversion_queue = []
+    conversion.clear_skip_requests()
+    conversion.conversion_queue.clear()
     conversion.converted_files = []
     conversion.failed_conversions = []
     conversion.remove_drm_only = False
+    conversion.resume_batch_id = None
     conversion.no_drm = False
@@ -14,13 +14,13 @@ from wx.lib import sized_controls as sc
 import application
 import clipboard
 import conversion
-import kindle_finder
-import kindle_metadata
 import log
-from signals import conversion_started, conversion_error, conversion_complete
+import search_index
+from signals import conversion_started, conversion_progress, conversion_error, conversion_complete, files_found, scan_complete
 
 import gui.conversion_pipeline
-from .utils import create_button, create_labelled_field, get_output_format_choices
+from .controls import VirtualList
+from .utils import change_selected_book_priority, check_default_output_format, create_button, create_labelled_field, get_book_label, get_output_format_choices, get_schedule_choices
 
 class BaseDialog(sc.SizedDialog):
     def __init__(self, parent, *args, **kwargs):
@@ -36,6 +36,47 @@ class BaseDialog(sc.SizedDialog):
 
 
 
+class DirectoryScanDialog(BaseDialog):
+    def __init__(self, parent, path, *args, **kwargs):
+        self._title = _('Adding files...')
+        self.path = path
+        self.is_cancelled = False
+        files_found.connect(self.onFilesFound)
+        scan_complete.connect(self.onScanComplete)
+        super(DirectoryScanDialog, self).__init__(parent=parent, *args, **kwargs)
+        self.directory_scanner = conversion.DirectoryScanner(path)
+        self.directory_scanner.start()
+
+    def setup_layout(self):
+        self.directory_text = wx.StaticText(self.panel, label=self.path)
+        self.found_files_text = wx.StaticText(self.panel, label=_('Searching for supported files...'))
+
+        button_sizer = wx.StdDialogButtonSizer()
+        self.cancel_button = wx.Button(self.panel, wx.ID_CANCEL)
+        self.cancel_button.Bind(wx.EVT_BUTTON, self.onCancel)
+        button_sizer.AddButton(self.cancel_button)
+        self.SetButtonSizer(button_sizer)
+        self.SetEscapeId(wx.ID_CANCEL)
+
+    def onFilesFound(self, sender, **kwargs):
+        gui.conversion_pipeline.add_paths(kwargs['paths'], parent=self.GetParent(), from_folder=True)
+        self.found_files_text.SetLabel(_('{0} supported files found').format(kwargs['count']))
+
+    def onScanComplete(self, sender, **kwargs):
+        files_found.disconnect(self.onFilesFound)
+        scan_complete.disconnect(self.onScanComplete)
+        self.EndModal(wx.ID_CANCEL if kwargs['cancelled'] else wx.ID_OK)
+
+    def onCancel(self, event):
+        if self.is_cancelled:
+            return
+
+        self.cancel_button.SetLabel(_('Cancelling...'))
+        self.is_cancelled = True
+        self.directory_scanner.cancel()
+
+
+
 class ConversionProgressDialog(BaseDialog):
     def __init__(self, parent, *args, **kwargs):
         if conversion.remove_drm_only:
@@ -44,10 +85,14 @@ class ConversionProgressDialog(BaseDialog):
             self._title = _('Converting...')
         self.counter = 1
         self.current_file = conversion.conversion_queue[0].input_path
+        self.current_file_progress = 0
+        self.current_file_status = ''
+
         self.files_to_be_converted = len(conversion.conversion_queue)
         self.is_cancelled = False
         conversion.stop_conversion.clear()
         conversion_started.connect(self.onConversionStarted)
+        conversion_progress.connect(self.onConversionProgress)
         conversion_error.connect(self.onConversionError)
         conversion_complete.connect(self.onConversionComplete)
         super(ConversionProgressDialog, self).__init__(parent=parent, *args, **kwargs)
@@ -57,11 +102,19 @@ class ConversionProgressDialog(BaseDialog):
     def setup_layout(self):
         self.progress_text = wx.StaticText(self.panel)
         self.current_file_text = wx.StaticText(self.panel)
+        self.current_file_status_text = wx.StaticText(self.panel)
         self.progress_bar = wx.Gauge(self.panel, -1, range=100, style=wx.GA_VERTICAL)
         self.progress_bar.SetSizerProps(expand=True)
         self.progress_bar.Pulse()
         self.update_progress()
 
+        if len(conversion.conversion_queue) > 1:
+            # Priorities can be changed here while the batch runs, as the main window can't be reached until it's finished
+            files_list_label = wx.StaticText(self.panel, label=_('&Files (press + or - to change priority)'))
+            self.files_list = VirtualList(self.panel, _('Path'), lambda: len(conversion.conversion_queue), lambda index: get_book_label(conversion.conversion_queue[index]))
+            self.files_list.SetSizerProps(expand=True)
+            self.files_list.Bind(wx.EVT_CHAR, self.onFilesListKeyPressed)
+
         button_sizer = wx.StdDialogButtonSizer()
         if len(conversion.conversion_queue) > 1:
             self.skip_button = create_button(self.panel, _('&Skip'), self.onSkip)
@@ -80,22 +133,30 @@ class ConversionProgressDialog(BaseDialog):
             verb = _('Converting')
         self.progress_text.SetLabel(_('{0} file {1} of {2}').format(verb, self.counter, self.files_to_be_converted))
         self.current_file_text.SetLabel(self.current_file)
+        self.current_file_status_text.SetLabel(self.current_file_status)
 
     def calculate_progress(self):
-        # First, get the percentage increase for a single file to subtract it from the overall progress,
+        # Files before the current one are complete, and the current file contributes however far through it ebook-convert has got,
         # because otherwise we end up showing 25% when conversion has only just started
-        single_file_percentage = int(round((1 / self.files_to_be_converted) * 100))
-        if single_file_percentage < 0:
-            single_file_percentage = 0
-
-        progress = int(round(((self.counter / self.files_to_be_converted) * 100) - single_file_percentage))
-        return progress
+        completed_files = (self.counter - 1) + (self.current_file_progress / 100)
+        progress = int(round((completed_files / self.files_to_be_converted) * 100))
+        return max(0, min(progress, 100))
 
     def onConversionStarted(self, sender, **kwargs):
             self.counter = kwargs['count']
             self.current_file = kwargs['path']
+            self.current_file_progress = 0
+            self.current_file_status = ''
             self.update_progress()
 
+    def onConversionProgress(self, sender, **kwargs):
+        # With several workers, only the most recently started file is shown
+        if kwargs['path'] != self.current_file:
+            return
+        self.current_file_progress = kwargs['percentage']
+        self.current_file_status = _('{0}% complete').format(kwargs['percentage'])
+        self.update_progress()
+
     def onConversionError(self, sender, **kwargs):
         wx.MessageBox(kwargs['error_msg'], _('Error'), wx.ICON_ERROR, parent=self)
         self.EndModal(wx.ID_CANCEL)
@@ -115,7 +176,11 @@ class ConversionProgressDialog(BaseDialog):
         conversion.stop_conversion.set()
 
     def onSkip(self, event):
-        conversion.skip_current_file.set()
+        conversion.skip_book(self.current_file)
+
+    def onFilesListKeyPressed(self, event):
+        if not change_selected_book_priority(self.files_list, event.GetKeyCode()):
+            event.Skip()
 
 
 
@@ -134,7 +199,10 @@ class ConversionCompleteDialog(BaseDialog):
         selected_items = self.converted_files.GetSelections()
         book_paths = []
         for index in selected_items:
-            book_paths.append(self.converted_files.GetClientData(index).output_path.lstrip('\\\\?\\'))
+            book = self.converted_files.GetClientData(index)
+            # Books converted to several formats put every output file on the clipboard
+            for output_path in (book.output_paths.values() if book.output_paths else [book.output_path]):
+                book_paths.append(output_path.lstrip('\\\\?\\'))
 
         try:
             clipboard.put_files_on_clipboard(book_paths)
@@ -227,6 +295,9 @@ class OptionsDialog(BaseDialog):
         self.remove_smart_punctuation = self.create_checkbox(self.conversion_options, _('&Remove smart punctuation from converted files'), 'remove_smart_punctuation')
         self.asciiize = self.create_checkbox(self.conversion_options, _('Re&place unicode characters with their ASCII equivalents (not recommended)'), 'asciiize')
         self.extra_ebook_convert_options = create_labelled_field(self.conversion_options, _('E&xtra options to pass to calibre ebook-convert command'), application.config['extra_ebook_convert_options'])
+        conversion_workers_label = wx.StaticText(self.conversion_options, label=_('&Number of files to convert at once'))
+        self.conversion_workers = wx.SpinCtrl(self.conversion_options, min=1, max=16, initial=application.config['conversion_workers'])
+        self.conversion_schedule = get_schedule_choices(self.conversion_options, _('Conversion &order'))
         self.debug = self.create_checkbox(self.other_options, _('&Enable debug logging'), 'debug')
 
         ok_button = wx.Button(self.panel, wx.ID_OK)
@@ -281,9 +352,11 @@ class OptionsDialog(BaseDialog):
             application.config['remove_smart_punctuation'] = self.remove_smart_punctuation.IsChecked()
             application.config['asciiize'] = self.asciiize.IsChecked()
             application.config['extra_ebook_convert_options'] = self.extra_ebook_convert_options.GetValue()
+            application.config['conversion_workers'] = self.conversion_workers.GetValue()
+            application.config['conversion_schedule'] = self.conversion_schedule.GetClientData(self.conversion_schedule.GetSelection())
             debug = self.debug.IsChecked()
             application.config['debug'] = debug
-            application.main_window.output_formats.SetStringSelection(self.default_output_format.GetStringSelection())
+            check_default_output_format(application.main_window.output_formats, application.config['default_output_format'])
 
             validation_result = application.config.validate(application.config_validator)
             if validation_result == True:
@@ -314,6 +387,7 @@ class FindBookFromURLDialog(BaseDialog):
         self.SetEscapeId(wx.ID_CANCEL)
 
     def onOK(self, event):
+        import kindle_finder
         try:
             ebook_path = kindle_finder.find_kindle_file_from_amazon_url(application.config['kindle_content_directory'], self.url.GetValue())
             gui.conversion_pipeline.add_paths([ebook_path], parent=self)
@@ -324,20 +398,93 @@ class FindBookFromURLDialog(BaseDialog):
             wx.MessageBox(_('Codex was unable to locate an eBook file for this product on your computer.  If you\'ve changed the location of your Kindle content directory within the Kindle for PC software, please also change the corresponding setting in the Codex Options dialog.'), _('Error'), wx.ICON_ERROR, parent=self)
 
 
+
+class FindBooksFromURLsDialog(BaseDialog):
+    _title = _('Find Kindle eBook Files from Amazon URLs')
+    # Maximum number of missing or already added books listed by name after a search
+    books_listed = 20
+
+    def setup_layout(self):
+        dialog_label = wx.StaticText(self.panel)
+        dialog_label.SetLabel(_('Paste or load a list of Amazon product page URLs, such as a reading list or order history, to add every eBook file found on this computer.'))
+        urls_label = wx.StaticText(self.panel, label=_('&Amazon URLs'))
+        self.urls = wx.TextCtrl(self.panel, style=wx.TE_MULTILINE|wx.TE_DONTWRAP, size=(500, 250))
+        self.urls.SetSizerProps(expand=True, proportion=1)
+        self.load_button = create_button(self.panel, _('&Load from file...'), self.onLoad)
+
+        ok_button = wx.Button(self.panel, wx.ID_OK)
+        cancel_button = wx.Button(self.panel, wx.ID_CANCEL)
+        ok_button.Bind(wx.EVT_BUTTON, self.onOK)
+        button_sizer = wx.StdDialogButtonSizer()
+        button_sizer.AddButton(ok_button)
+        button_sizer.AddButton(cancel_button)
+        self.SetButtonSizer(button_sizer)
+        self.SetAffirmativeId(wx.ID_OK)
+        self.SetEscapeId(wx.ID_CANCEL)
+
+    def onLoad(self, event):
+        file_dialog = wx.FileDialog(self, message=_('Please select a file containing Amazon URLs'), defaultDir=application.config['working_directory'], wildcard=_('Text and HTML files|{0}|All files|{1}').format('*.txt;*.htm;*.html;*.csv', '*.*'), style=wx.FD_OPEN|wx.FD_FILE_MUST_EXIST)
+        if file_dialog.ShowModal() == wx.ID_OK:
+            with open(file_dialog.GetPath(), encoding='utf-8', errors='replace') as f:
+                self.urls.SetValue(f.read())
+            self.urls.SetFocus()
+        file_dialog.Destroy()
+
+    def onOK(self, event):
+        import kindle_finder
+        with wx.BusyCursor():
+            found_books, missing_asins = kindle_finder.find_kindle_files_from_text(application.config['kindle_content_directory'], self.urls.GetValue())
+        if len(found_books) == 0 and len(missing_asins) == 0:
+            wx.MessageBox(_('No Amazon product URLs were found.'), _('Error'), wx.ICON_ERROR, parent=self)
+            return
+
+        # Order histories often overlap with books already in the list, so those are summarised below rather than reported one at a time
+        duplicate_paths = gui.conversion_pipeline.add_paths([path for asin, path in found_books], parent=self.GetParent(), report_duplicates=False)
+        if len(missing_asins) > 0 or len(duplicate_paths) > 0:
+            added_count = len(found_books) - len(duplicate_paths)
+            report = [_('{0} of {1} books were added.').format(added_count, len(found_books) + len(missing_asins))]
+            if len(duplicate_paths) > 0:
+                report.append(_('The following books were already in the list of files:\n{0}').format(self.format_book_list([os.path.basename(path) for path in duplicate_paths])))
+            if len(missing_asins) > 0:
+                report.append(_('eBook files could not be found for the following products:\n{0}').format(self.format_book_list(missing_asins)))
+            wx.MessageBox('\n\n'.join(report), _('Some Books Not Added'), wx.ICON_WARNING, parent=self)
+        self.EndModal(wx.ID_OK)
+
+    def format_book_list(self, books):
+        book_list = '\n'.join(books[:self.books_listed])
+        if len(books) > self.books_listed:
+            book_list += '\n' + _('...and {0} more').format(len(books) - self.books_listed)
+        return book_list
+
+
+
 class BrowseKindleBooksDialog(BaseDialog):
     _title = _('Downloaded Kindle Books')
+    # Minimum number of seconds between additions to the books list
+    update_interval = 0.1
 
     def __init__(self, parent, files, *args, **kwargs):
         self.dismissed = False
-        self.item_has_focus = False
+        # Set once a book has been selected, by the user or automatically when the first books arrive, after which the selection is left alone
+        self.book_selected = False
         self.files = files
+        # (label, path) tuples for every book loaded so far, and the indexes of those which match the filter, which the books list reads from
+        self.books = []
+        self.visible_books = []
+        self.search_index = search_index.SearchIndex()
         super().__init__(parent, *args, **kwargs)
 
     def setup_layout(self):
+        filter_label = wx.StaticText(self.panel, label=_('&Filter'))
+        self.filter = wx.TextCtrl(self.panel)
+        self.filter.SetSizerProps(expand=True)
+        self.filter.Bind(wx.EVT_TEXT, self.onFilterChange)
+
         books_label = wx.StaticText(self.panel, label=_('&Books'))
-        self.books_list = wx.ListBox(self.panel, style=wx.LB_NEEDED_SB|wx.LB_EXTENDED)
+        self.books_list = VirtualList(self.panel, _('Book'), lambda: len(self.visible_books), lambda index: self.books[self.visible_books[index]][0], multiple_selection=True)
         self.books_list.SetSizerProps(expand=True, proportion=1)
-        self.books_list.Bind(wx.EVT_LISTBOX, self.onBooksListSelectionChange)
+        self.books_list.Bind(wx.EVT_LIST_ITEM_SELECTED, self.onBooksListSelectionChange)
+        self.books_list.Bind(wx.EVT_LIST_ITEM_DESELECTED, self.onBooksListSelectionChange)
         self.loader_thread = threading.Thread(target=self.set_books_list_items)
         self.loader_thread.setDaemon(True)
         self.loader_thread.start()
@@ -355,38 +502,78 @@ class BrowseKindleBooksDialog(BaseDialog):
         self.SetEscapeId(wx.ID_CANCEL)
 
     def set_books_list_items(self):
-        for file in self.files[::-1]:
-            if self.dismissed:
-                return
-            try:
-                full_path = os.path.join(application.config['kindle_content_directory'], file)
-                metadata = kindle_metadata.get_title_and_author_from_kindle_file(full_path)
-            except kindle_metadata.KindleMetadataError:
-                metadata = {'author': _('Unknown Author'), 'title': _('Unknown Title')}
-            try:
-                author = ' '.join(metadata['author'].split(', ')[::-1])
-            except KeyError:
-                author = _('Unknown Author')
-            try:
-                title = metadata['title']
-            except KeyError:
-                title = _('Unknown Title')
-            wx.CallAfter(self.books_list.Append, '{0} - {1} ({2})'.format(author, title, file), full_path)
-            if not self.item_has_focus:
-                wx.CallAfter(self.books_list.SetSelection, 0)
-                self.item_has_focus = True
+        # Books are added to the list in batches, so that the event queue isn't flooded with one update per book
+        items = []
+        last_update = time.monotonic()
+        import kindle_index
+        books = kindle_index.load_metadata(application.config['kindle_content_directory'], self.files[::-1])
+        try:
+            for full_path, metadata in books:
+                if self.dismissed:
+                    return
+                try:
+                    # Authors are stored as "Last, First", possibly several of them
+                    author = ' & '.join(' '.join(name.split(', ')[::-1]) for name in metadata['author'].split(' & '))
+                except KeyError:
+                    author = _('Unknown Author')
+                try:
+                    title = metadata['title']
+                except KeyError:
+                    title = _('Unknown Title')
+                items.append(('{0} - {1} ({2})'.format(author, title, os.path.basename(full_path)), full_path, metadata.get('asin')))
+                if time.monotonic() - last_update >= self.update_interval:
+                    wx.CallAfter(self.append_books, items)
+                    items = []
+                    last_update = time.monotonic()
+        finally:
+            books.close()
+
+        if len(items) > 0:
+            wx.CallAfter(self.append_books, items)
+
+    def append_books(self, items):
+        if self.dismissed:
+            return
+        # Only the new books need checking against the filter, and as they're appended the existing rows and their selections don't move
+        query_words = search_index.tokenise(self.filter.GetValue())
+        for label, full_path, asin in items:
+            book_index = len(self.books)
+            self.search_index.add(book_index, label, asin)
+            self.books.append((label, full_path))
+            if search_index.matches(query_words, label, asin):
+                self.visible_books.append(book_index)
+        self.books_list.refresh()
+        if not self.book_selected and len(self.visible_books) > 0:
+            self.books_list.SetSelection(0)
+            self.book_selected = True
+
+    def apply_filter(self):
+        # Books which were selected stay selected if they still match
+        selected_books = set(self.visible_books[index] for index in self.books_list.GetSelections())
+        matches = self.search_index.search(self.filter.GetValue())
+        if matches is None:
+            self.visible_books = list(range(len(self.books)))
+        else:
+            self.visible_books = sorted(matches)
+
+        for index in self.books_list.GetSelections():
+            self.books_list.Select(index, on=False)
+        self.books_list.refresh()
+        for index, book_index in enumerate(self.visible_books):
+            if book_index in selected_books:
+                self.books_list.Select(index)
+
+    def onFilterChange(self, event):
+        self.apply_filter()
 
     def onBooksListSelectionChange(self, event):
-        is_selection = event.GetExtraLong()
-        if is_selection:
-            self.item_has_focus = True
-        else:
-            self.item_has_focus = False
+        if self.books_list.GetSelectedItemCount() > 0:
+            self.book_selected = True
 
     def onOK(self, event):
         self.dismissed = True
         selected_items = self.books_list.GetSelections()
-        selected_paths = [self.books_list.GetClientData(index) for index in selected_items]
+        selected_paths = [self.books[self.visible_books[index]][1] for index in selected_items]
         gui.conversion_pipeline.add_paths(selected_paths, parent=self.GetParent())
         self.EndModal(wx.ID_OK)
 
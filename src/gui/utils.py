@@ -8,6 +8,15 @@ import wx
 
 import application
 import conversion
+import scheduling
+
+schedule_labels = {
+    'fifo': _('In the order they were added'),
+    'shortest_first': _('Smallest files first'),
+    'largest_first': _('Largest files first'),
+}
+# Keys which raise or lower the priority of the selected book in a list of queued files
+priority_keys = {ord('+'): 1, ord('='): 1, ord('-'): -1}
 
 
 def create_button(parent, label='', callback=None, id=-1):
@@ -51,3 +60,65 @@ def get_output_format_choices(parent, label):
     control.SetStringSelection(default_value)
     return control
 
+
+
+def get_schedule_choices(parent, label):
+    label = wx.StaticText(parent, label=label)
+    control = wx.ComboBox(parent, style=wx.CB_SIMPLE|wx.CB_READONLY)
+    try:
+        control.SetSizerProps(expand=True)
+    except AttributeError:
+        pass
+
+    for schedule in scheduling.SCHEDULES:
+        control.Append(schedule_labels[schedule], schedule)
+    control.SetStringSelection(schedule_labels[application.config['conversion_schedule']])
+    return control
+
+
+def get_book_label(book):
+    # Books only show their priority once it's been changed
+    if book.priority == 0:
+        return book.input_path
+    return _('{path} (priority {priority:+d})').format(path=book.input_path, priority=book.priority)
+
+
+def change_selected_book_priority(files_list, key_code):
+    # Returns False if the key doesn't change priorities, so the caller can let it through
+    change = priority_keys.get(key_code)
+    selected_item = files_list.GetSelection()
+    if change is None or selected_item == -1:
+        return False
+    book = conversion.conversion_queue[selected_item]
+    conversion.set_priority(book, book.priority + change)
+    files_list.refresh()
+    return True
+
+
+def get_output_format_checklist(parent, label):
+    # Lets several output formats be chosen at once, with the default format checked to begin with
+    label = wx.StaticText(parent, label=label)
+    control = wx.CheckListBox(parent, choices=[format.value for format in conversion.OutputFormat])
+    try:
+        control.SetSizerProps(expand=True)
+    except AttributeError:
+        pass
+
+    check_default_output_format(control, application.config['default_output_format'])
+    return control
+
+
+def check_default_output_format(control, format_name):
+    formats = list(conversion.OutputFormat)
+    try:
+        default_index = formats.index(conversion.OutputFormat[format_name])
+    except KeyError:
+        default_index = formats.index(conversion.OutputFormat['epub'])
+
+    control.SetCheckedItems([default_index])
+    control.SetSelection(default_index)
+
+
+def get_checked_output_formats(control):
+    formats = list(conversion.OutputFormat)
+    return set(formats[index].name for index in control.GetCheckedItems())
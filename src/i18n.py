@@ -7,31 +7,37 @@ import builtins
 import gettext
 import os.path
 
-import wx
-
 import application
 
+# Languages are given by the name of their wx constant, so that translations can be installed without importing wx
 available_locales = {
-    'en': ('English', wx.LANGUAGE_ENGLISH),
-    'es': ('Español', wx.LANGUAGE_SPANISH),
+    'en': ('English', 'LANGUAGE_ENGLISH'),
+    'es': ('Español', 'LANGUAGE_SPANISH'),
 }
 
-def setup():
+def install_translations():
+    # Installs _ and __ as builtins, without touching wx, and returns the locale path, code and name plus the name of the wx language constant
     application.logger.info('Available locales: {0}'.format(len(available_locales)))
     locale_path = os.path.join(application.application_path, 'locale')
     application.logger.info('Application locale path: {0}'.format(locale_path))
 
     locale_code = application.config.get('interface_language', 'en')
     try:
-        locale_name, wx_locale = available_locales[locale_code]
+        locale_name, wx_language = available_locales[locale_code]
     except KeyError as e:
         application.logger.error('No locale found for code: {0}'.format(e.message))
         locale_code = 'en'
-        locale_name, wx_locale = available_locales[locale_code]
+        locale_name, wx_language = available_locales[locale_code]
 
     trans = gettext.translation(domain=application.gettext_domain, localedir=locale_path, languages=[locale_code], fallback=True)
     trans.install()
     builtins.__dict__['__'] = trans.ngettext
+    return locale_path, locale_code, locale_name, wx_language
+
+def setup():
+    import wx
+    locale_path, locale_code, locale_name, wx_language = install_translations()
+    wx_locale = getattr(wx, wx_language)
     application.wx_app.locale = wx.Locale()
     application.wx_app.locale.AddCatalogLookupPathPrefix(locale_path)
     application.wx_app.locale.AddCatalog('wxstd')
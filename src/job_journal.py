@@ -0,0 +1,122 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+# An on-disk record of each conversion batch and the state of every book in it, so that a batch interrupted by a crash or cancellation can be resumed.
+# Every state change is committed as it happens, and the journal uses SQLite's write-ahead log so a crash can't lose earlier changes.
+
+import json
+import os.path
+import sqlite3
+import threading
+import time
+
+import application
+
+journal_path = os.path.join(application.config_directory, 'jobs.db')
+# Older batches are forgotten when a new one starts
+KEEP_BATCHES = 10
+
+QUEUED = 'queued'
+CONVERTING = 'converting'
+CONVERTED = 'converted'
+FAILED = 'failed'
+# Skipped by the user, so not converted again when the batch is resumed
+SKIPPED = 'skipped'
+# Books in these states still need converting when a batch is resumed
+UNFINISHED_STATES = (QUEUED, CONVERTING)
+
+class JournalError(Exception):
+    # Raised if the journal can't be opened or written to
+    pass
+
+class Batch(object):
+    def __init__(self, batch_id, started, output_formats, remove_drm_only, jobs):
+        self.batch_id = batch_id
+        self.started = started
+        self.output_formats = output_formats
+        self.remove_drm_only = remove_drm_only
+        # (input_path, state, output_paths) tuples, in the order the books were queued
+        self.jobs = jobs
+
+class JobJournal(object):
+    def __init__(self, path=None):
+        # Conversion workers record their books from several threads, so the connection is shared behind a lock
+        self.lock = threading.Lock()
+        try:
+            self.connection = sqlite3.connect(path or journal_path, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS batches (id INTEGER PRIMARY KEY, started REAL NOT NULL, output_formats TEXT NOT NULL, remove_drm_only INTEGER NOT NULL)')
+                self.connection.execute('CREATE TABLE IF NOT EXISTS jobs (batch INTEGER NOT NULL, position INTEGER NOT NULL, input_path TEXT NOT NULL, state TEXT NOT NULL, output_paths TEXT, PRIMARY KEY (batch, input_path))')
+        except sqlite3.Error as e:
+            raise JournalError(e) from e
+
+    def start_batch(self, books, output_formats, remove_drm_only):
+        # Records a new batch with every book queued, returning its ID
+        with self.lock:
+            try:
+                with self.connection:
+                    cursor = self.connection.execute('INSERT INTO batches (started, output_formats, remove_drm_only) VALUES (?, ?, ?)', (time.time(), json.dumps(output_formats), int(remove_drm_only)))
+                    batch_id = cursor.lastrowid
+                    self.insert_jobs(batch_id, books)
+                    self.connection.execute('DELETE FROM jobs WHERE batch <= ?', (batch_id - KEEP_BATCHES,))
+                    self.connection.execute('DELETE FROM batches WHERE id <= ?', (batch_id - KEEP_BATCHES,))
+            except sqlite3.Error as e:
+                raise JournalError(e) from e
+        return batch_id
+
+    def add_books(self, batch_id, books):
+        # Adds books to an existing batch, leaving the state of any which are already in it alone
+        with self.lock:
+            try:
+                with self.connection:
+                    self.insert_jobs(batch_id, books)
+            except sqlite3.Error as e:
+                raise JournalError(e) from e
+
+    def insert_jobs(self, batch_id, books):
+        first_position = self.connection.execute('SELECT COUNT(*) FROM jobs WHERE batch = ?', (batch_id,)).fetchone()[0]
+        self.connection.executemany('INSERT OR IGNORE INTO jobs (batch, position, input_path, state) VALUES (?, ?, ?, ?)', [(batch_id, first_position + index, book.input_path, QUEUED) for index, book in enumerate(books)])
+
+    def set_state(self, batch_id, book, state):
+        output_paths = None
+        if state == CONVERTED:
+            output_paths = json.dumps(book.output_paths)
+        with self.lock:
+            try:
+                with self.connection:
+                    self.connection.execute('UPDATE jobs SET state = ?, output_paths = ? WHERE batch = ? AND input_path = ?', (state, output_paths, batch_id, book.input_path))
+            except sqlite3.Error as e:
+                raise JournalError(e) from e
+
+    def get_unfinished_batch(self):
+        # Returns the most recent Batch if it still has books to convert, or None
+        with self.lock:
+            try:
+                row = self.connection.execute('SELECT id, started, output_formats, remove_drm_only FROM batches ORDER BY id DESC LIMIT 1').fetchone()
+                if row is None or self.connection.execute('SELECT COUNT(*) FROM jobs WHERE batch = ? AND state IN (?, ?)', (row[0],) + UNFINISHED_STATES).fetchone()[0] == 0:
+                    return None
+                jobs = self.connection.execute('SELECT input_path, state, output_paths FROM jobs WHERE batch = ? ORDER BY position', (row[0],)).fetchall()
+            except sqlite3.Error as e:
+                raise JournalError(e) from e
+        jobs = [(input_path, state, json.loads(output_paths) if output_paths else {}) for input_path, state, output_paths in jobs]
+        return Batch(row[0], row[1], json.loads(row[2]), bool(row[3]), jobs)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def outputs_exist(output_paths):
+    # A converted book only counts as done if every output it was recorded with is still there and isn't empty
+    if len(output_paths) == 0:
+        return False
+    for path in output_paths.values():
+        try:
+            if os.path.getsize(path) == 0:
+                return False
+        except OSError:
+            return False
+    return True
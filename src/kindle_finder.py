@@ -3,8 +3,13 @@
 # This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
 # See the file LICENSE.txt for more details.
 
+import os
 import os.path
 import re
+import sqlite3
+
+import application
+import kindle_index
 
 
 class InvalidAmazonURLError(Exception):
@@ -18,7 +23,12 @@ class BookNotFoundError(Exception):
 
 
 AMAZON_URL_EXPRESSION = re.compile(r'^(https??://)??(www\.)??amazon\.([a-z\.]+)/(.*?)/dp/(?P<asin>B[a-zA-Z0-9]+?)(/.*?)??$')
+# Finds product links anywhere in a block of text, such as a pasted order history
+EMBEDDED_URL_EXPRESSION = re.compile(r'amazon\.[a-z\.]+/(?:[^\s]*?/)?(?:dp|gp/product)/(?P<asin>B[a-zA-Z0-9]{9})\b')
+# Kindle for PC names books, and the folders holding KFX books, after their ASIN
+ASIN_NAME_EXPRESSION = re.compile(r'^(?P<asin>B[A-Z0-9]{9})_(EBOK|EBSP)\b')
 EBOOK_SUFFIX = '_EBOK.azw'
+BOOK_EXTENSIONS = ['azw', 'azw3', 'azw8', 'kfx', 'mobi', 'prc']
 
 
 def find_kindle_file_from_amazon_url(kindle_content_directory, url):
@@ -26,8 +36,85 @@ def find_kindle_file_from_amazon_url(kindle_content_directory, url):
     possible_path = construct_file_path_from_asin(kindle_content_directory, asin)
     if os.path.exists(possible_path):
         return possible_path
-    else:
-        raise BookNotFoundError
+
+    # Fall back to searching subfolders and metadata, for KFX books and older downloads
+    asin_index = build_asin_index(kindle_content_directory)
+    if asin in asin_index:
+        return asin_index[asin]
+    raise BookNotFoundError
+
+
+def find_kindle_files_from_text(kindle_content_directory, text):
+    '''
+    Finds the eBook files for every Amazon product link in a block of text.
+    Returns a list of (asin, path) tuples for the books which were found, and a list of ASINs which weren't.
+    '''
+    asins = []
+    for match in EMBEDDED_URL_EXPRESSION.finditer(text):
+        asin = match.group('asin').upper()
+        if asin not in asins:
+            asins.append(asin)
+
+    found_books = []
+    missing_asins = []
+    if len(asins) > 0:
+        asin_index = build_asin_index(kindle_content_directory)
+        for asin in asins:
+            if asin in asin_index:
+                found_books.append((asin, asin_index[asin]))
+            else:
+                missing_asins.append(asin)
+    return found_books, missing_asins
+
+
+def build_asin_index(kindle_content_directory):
+    '''
+    Returns a dictionary mapping ASINs to eBook files, built in a single scan of the content directory and its subfolders.
+    A book's ASIN comes from its file name or, for KFX books, the name of its folder, and otherwise from the ASIN stored in the file itself.
+    '''
+    asin_index = {}
+    book_paths = []
+    unnamed_files = []
+    for path, directories, filenames in os.walk(kindle_content_directory):
+        directory_match = ASIN_NAME_EXPRESSION.match(os.path.basename(path))
+        for filename in filenames:
+            if os.path.splitext(filename)[1].lstrip('.').lower() not in BOOK_EXTENSIONS:
+                continue
+            full_path = os.path.join(path, filename)
+            book_paths.append(full_path)
+            file_match = ASIN_NAME_EXPRESSION.match(filename)
+            if file_match:
+                # A file named after its ASIN is always preferred over one which is only in a folder of that name
+                asin_index[file_match.group('asin')] = full_path
+            elif directory_match:
+                asin_index.setdefault(directory_match.group('asin'), full_path)
+            else:
+                unnamed_files.append(full_path)
+
+    if len(unnamed_files) > 0:
+        try:
+            add_indexed_asins(asin_index, kindle_content_directory, book_paths, unnamed_files)
+        except sqlite3.Error:
+            # Books named after their ASIN can still be found without the index
+            application.logger.exception('Unable to use the Kindle index')
+    return asin_index
+
+
+def add_indexed_asins(asin_index, kindle_content_directory, book_paths, unnamed_files):
+    # Adds the ASINs stored in unnamed_files, reading each file only if the index doesn't already have it
+    index = kindle_index.KindleIndex()
+    try:
+        # Subfolders are indexed here too, so forget anything beneath the content directory which has gone
+        index.prune(kindle_content_directory, book_paths, recursive=True)
+        for full_path in unnamed_files:
+            try:
+                asin = index.get_metadata(full_path).get('asin')
+            except OSError:
+                continue
+            if asin is not None:
+                asin_index.setdefault(asin, full_path)
+    finally:
+        index.close()
 
 
 def extract_asin_from_url(url):
@@ -0,0 +1,144 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+# An on-disk index of metadata read from the Kindle content directory.
+# Entries are keyed by path and remember the size and modification time they were read at, so only new or changed files are parsed again.
+
+import concurrent.futures
+import os
+import os.path
+import sqlite3
+
+import application
+import kindle_metadata
+
+index_path = os.path.join(application.config_directory, 'kindle_index.db')
+KINDLE_EXTENSION = 'azw'
+# Number of newly parsed files between commits, so that progress survives the dialog being closed part way through
+COMMIT_INTERVAL = 100
+# Parsing is mostly waiting on the disk, so use more threads than there are processors
+PARSE_WORKERS = min(16, (os.cpu_count() or 1) * 2)
+
+class KindleIndex(object):
+    def __init__(self, path=None):
+        # sqlite3 connections can only be used on the thread which created them
+        self.connection = sqlite3.connect(path or index_path)
+        self.pending_changes = 0
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS books (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL, author TEXT, title TEXT, asin TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS books_asin ON books (asin)')
+
+    def get_metadata(self, path, stat=None):
+        '''
+        Returns a dictionary containing whichever of author, title and asin could be read from the Kindle file at path.
+        The file is only parsed if it isn't in the index, or its size or modification time have changed.
+        '''
+        if stat is None:
+            stat = os.stat(path)
+        metadata = self.lookup(path, stat)
+        if metadata is None:
+            metadata = self.store(path, stat, *read_metadata(path))
+        return metadata
+
+    def lookup(self, path, stat):
+        # Returns the indexed metadata, or None if the file isn't indexed or has changed
+        row = self.connection.execute('SELECT size, mtime, author, title, asin FROM books WHERE path = ?', (path,)).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None
+        return get_metadata_dictionary(*row[2:])
+
+    def store(self, path, stat, author, title, asin):
+        self.connection.execute('INSERT OR REPLACE INTO books (path, size, mtime, author, title, asin) VALUES (?, ?, ?, ?, ?, ?)', (path, stat.st_size, stat.st_mtime_ns, author, title, asin))
+        self.pending_changes += 1
+        if self.pending_changes >= COMMIT_INTERVAL:
+            self.commit()
+        return get_metadata_dictionary(author, title, asin)
+
+    def find_by_asin(self, asin):
+        # Returns the indexed paths for a given ASIN, most recently modified first
+        rows = self.connection.execute('SELECT path FROM books WHERE asin = ? ORDER BY mtime DESC', (asin,)).fetchall()
+        return [row[0] for row in rows]
+
+    def prune(self, directory, existing_paths, recursive=False):
+        # Forgets indexed files in directory, or anywhere beneath it if recursive is True, which no longer exist
+        directory = os.path.normpath(directory)
+        existing_paths = set(existing_paths)
+        rows = self.connection.execute('SELECT path FROM books').fetchall()
+        removed_paths = [(path,) for path, in rows if is_in_directory(path, directory, recursive) and path not in existing_paths]
+        self.connection.executemany('DELETE FROM books WHERE path = ?', removed_paths)
+        self.pending_changes += len(removed_paths)
+
+    def commit(self):
+        self.connection.commit()
+        self.pending_changes = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+def is_in_directory(path, directory, recursive):
+    parent = os.path.normpath(os.path.dirname(path))
+    if recursive:
+        return parent == directory or parent.startswith(os.path.join(directory, ''))
+    return parent == directory
+
+def get_metadata_dictionary(author, title, asin):
+    metadata = {}
+    for key, value in (('author', author), ('title', title), ('asin', asin)):
+        if value is not None:
+            metadata[key] = value
+    return metadata
+
+def load_metadata(directory, files):
+    '''
+    A generator which yields (path, metadata) for each (path, stat) tuple in files, in the same order.
+    Indexed files come straight from the index, while the rest are parsed by a pool of threads.  Closing the generator cancels any parsing which hasn't started.
+    '''
+    index = KindleIndex()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=PARSE_WORKERS)
+    pending = []
+    try:
+        index.prune(directory, [path for path, stat in files])
+        for path, stat in files:
+            metadata = index.lookup(path, stat)
+            if metadata is None:
+                pending.append((path, stat, executor.submit(read_metadata, path)))
+            else:
+                pending.append((path, stat, metadata))
+
+        for path, stat, result in pending:
+            if isinstance(result, concurrent.futures.Future):
+                yield path, index.store(path, stat, *result.result())
+            else:
+                yield path, result
+    finally:
+        for path, stat, result in pending:
+            if isinstance(result, concurrent.futures.Future):
+                result.cancel()
+        executor.shutdown(wait=False)
+        index.close()
+
+def read_metadata(path):
+    # Files which can't be parsed are still indexed, with no metadata, so they aren't retried until they change
+    try:
+        kindle_file = kindle_metadata.read_kindle_file(path)
+    except kindle_metadata.KindleMetadataError:
+        return None, None, None
+    author = ' & '.join(kindle_file.authors) or None
+    return author, kindle_file.title, kindle_file.asin
+
+def scan_content_directory(directory):
+    '''
+    Returns a list of (path, stat) tuples for the Kindle books in directory, oldest first.
+    scandir returns most of the stat information along with each name on Windows, so this avoids a separate stat call per file.
+    '''
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith(KINDLE_EXTENSION) and entry.is_file():
+                files.append((entry.path, entry.stat()))
+
+    files.sort(key=lambda file: file[1].st_ctime)
+    return files
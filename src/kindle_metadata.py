@@ -3,114 +3,225 @@
 # This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
 # See the file LICENSE.txt for more details.
 
+# Reads metadata from MOBI, AZW and PDB files without calibre.
+# Files are memory-mapped and every field is unpacked in place, so only the pages holding the headers are ever read from disk.
+
+import collections
+import mmap
 import os.path
 import struct
 
 
-FIRST_RECORD_INFO_OFFSET = 78
+# name, attributes, version, creation/modification/backup dates, modification number, app info, sort info, type, creator, unique ID seed, next record list, record count
+PDB_HEADER = struct.Struct('>32sHHIIIIII4s4sIIH')
+# data offset, then attributes in the top byte and a 24-bit unique ID
+PDB_RECORD_INFO = struct.Struct('>II')
+# compression, unused, text length, text record count, text record size, encryption type, unknown
+PALMDOC_HEADER = struct.Struct('>HHIHHHH')
+# identifier, header length, MOBI type, text encoding, unique ID, file version
+MOBI_HEADER = struct.Struct('>4sIIIII')
+MOBI_HEADER_OFFSET = PALMDOC_HEADER.size
+MOBI_FULL_NAME = struct.Struct('>II')
+MOBI_FULL_NAME_OFFSET = 84
+MOBI_LOCALE = struct.Struct('>I')
+MOBI_LOCALE_OFFSET = 92
+MOBI_FIRST_IMAGE = struct.Struct('>I')
+MOBI_FIRST_IMAGE_OFFSET = 108
+MOBI_EXTH_FLAGS = struct.Struct('>I')
+MOBI_EXTH_FLAGS_OFFSET = 128
+MOBI_HAS_EXTH = 0x40
+# identifier, header length, record count
+EXTH_HEADER = struct.Struct('>4sII')
+# record type, record length including this header
+EXTH_RECORD_HEADER = struct.Struct('>II')
+EXTH_INTEGER = struct.Struct('>I')
+MOBI_FORMATS = [(b'BOOK', b'MOBI'), (b'TEXt', b'REAd')]
+TEXT_ENCODINGS = {1252: 'cp1252', 65001: 'utf-8'}
+NO_ENCRYPTION = 0
+
+# EXTH record types and the names they're exposed under.  Types which can appear more than once are collected into lists
+EXTH_STRING_RECORDS = {
+    100: 'author',
+    101: 'publisher',
+    103: 'description',
+    104: 'isbn',
+    105: 'subject',
+    106: 'publication_date',
+    108: 'contributor',
+    109: 'rights',
+    113: 'asin',
+    501: 'cde_type',
+    503: 'updated_title',
+    504: 'cde_content_key',
+    524: 'language',
+    525: 'writing_mode',
+}
+EXTH_INTEGER_RECORDS = {
+    201: 'cover_offset',
+    202: 'thumbnail_offset',
+    203: 'has_fake_cover',
+    401: 'clipping_limit',
+    406: 'rental_expiration',
+}
+EXTH_REPEATABLE_RECORDS = [100, 105, 108]
+# Records which only appear in files carrying Amazon's DRM
+EXTH_DRM_RECORDS = [208, 209, 401, 406]
+
+PDBRecord = collections.namedtuple('PDBRecord', ['offset', 'length', 'attributes', 'unique_id'])
 
 
 class KindleMetadataError(Exception):
     pass
 
 
-def get_title_and_author_from_kindle_file(path):
-    stream = open(path, 'rb')
-
-    format_header = stream.read(3)
-    if b'TPZ' in format_header:
-        raise KindleMetadataError
-
+class KindleFile(object):
+    def __init__(self, path, name, type, creator, records):
+        self.path = path
+        self.name = name
+        self.type = type
+        self.creator = creator
+        self.records = records
+        self.compression = None
+        self.text_length = None
+        self.encryption_type = NO_ENCRYPTION
+        self.mobi_type = None
+        self.text_encoding = None
+        self.file_version = None
+        self.full_name = None
+        self.locale = None
+        self.first_image_index = None
+        # Every EXTH record as (type, raw bytes), in file order, including types without a name
+        self.exth_records = []
+        self.metadata = {}
+
+    @property
+    def title(self):
+        return self.metadata.get('updated_title') or self.full_name or self.name or os.path.basename(self.path)
+
+    @property
+    def authors(self):
+        return self.metadata.get('author', [])
+
+    @property
+    def asin(self):
+        # Personal documents only have the CDE content key
+        return self.metadata.get('asin') or self.metadata.get('cde_content_key')
+
+    @property
+    def is_encrypted(self):
+        return self.encryption_type != NO_ENCRYPTION or any(record_type in EXTH_DRM_RECORDS for record_type, data in self.exth_records)
+
+
+def read_kindle_file(path):
+    '''
+    Parses the PDB record table, MOBI header and every EXTH record of a MOBI, AZW or PDB file, returning a KindleFile.
+    Raises KindleMetadataError if the file can't be read or isn't in one of those formats.
+    '''
     try:
-        record_zero = get_record(0, stream)
-        exth_header = get_exth_header(record_zero)
-        metadata_records = get_metadata_from_exth_header(exth_header)
-        if 'title' not in metadata_records.keys():
-            metadata_records['title'] = os.path.basename(path)
-        return metadata_records
-    except struct.Error:
-        raise KindleMetadataError
-
-
-def get_record(record_number, stream):
-    record_info_offset = get_record_info_offset(0)
-    record_data_offset = get_record_data_offset(record_info_offset, stream)
-    next_record_info_offset = get_record_info_offset(1)
-    next_record_data_offset = get_record_data_offset(next_record_info_offset, stream)
-    stream.seek(record_data_offset)
-    return stream.read(next_record_data_offset - record_data_offset)
-
-
-def get_record_info_offset(record_number):
-    record_info_offset = FIRST_RECORD_INFO_OFFSET + (8 * record_number)
-    return record_info_offset
-
-
-def get_record_data_offset(record_info_offset, stream):
-    stream.seek(record_info_offset)
-    record_data_offset = struct.unpack('>i', stream.read(4))[0]
-    return record_data_offset
-
-
-def get_exth_header(record_zero):
-    mobi_header_length = get_mobi_header_length(record_zero)
-    exth_header_offset = mobi_header_length + 16
-    exth_header_length = get_exth_header_length(exth_header_offset, record_zero)
-    return record_zero[exth_header_offset:exth_header_offset + exth_header_length]
-
-
-def get_mobi_header_length(record_zero):
-    return struct.unpack('>i', record_zero[20:24])[0]
-
-
-def get_exth_header_length(exth_header_offset, record_zero):
-    exth_header_length_offset = exth_header_offset + 4
-    return struct.unpack('>i', record_zero[exth_header_length_offset:exth_header_length_offset + 4])[0] + 16
+        with open(path, 'rb') as stream:
+            data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as e:
+        # mmap raises ValueError for empty files
+        raise KindleMetadataError(path) from e
 
-
-def get_metadata_from_exth_header(exth_header):
-    record_count = get_number_of_exth_records(exth_header)
-    metadata_records = get_metadata_records(record_count, exth_header)
-    return metadata_records
-
-
-def get_number_of_exth_records(exth_header):
-    return struct.unpack('>i', exth_header[8:12])[0]
+    try:
+        with memoryview(data) as view:
+            return parse_kindle_file(path, view)
+    except (struct.error, IndexError) as e:
+        raise KindleMetadataError(path) from e
+    finally:
+        data.close()
 
 
-def get_metadata_records(record_count, exth_header):
-    metadata_records = {}
-    exth_identifiers = {100: 'author', 503: 'title'}
-    current_record = 1
-    current_offset = 12
-    while current_record <= record_count:
-        record_type = get_record_type(current_offset, exth_header)
-        record_length = get_record_length(current_offset, exth_header)
-        if record_type in exth_identifiers:
-            metadata_records[exth_identifiers[record_type]] = get_record_data(current_offset, record_length, exth_header)
-            current_record += 1
-            current_offset += record_length
+def get_title_and_author_from_kindle_file(path):
+    kindle_file = read_kindle_file(path)
+    metadata = {'title': kindle_file.title}
+    if kindle_file.authors:
+        metadata['author'] = ' & '.join(kindle_file.authors)
+    return metadata
+
+
+def parse_kindle_file(path, view):
+    if bytes(view[:3]) == b'TPZ':
+        raise KindleMetadataError(path)
+
+    header = PDB_HEADER.unpack_from(view, 0)
+    name, type, creator, record_count = header[0], header[9], header[10], header[13]
+    if (type, creator) not in MOBI_FORMATS or record_count == 0:
+        raise KindleMetadataError(path)
+
+    kindle_file = KindleFile(path, decode_string(name.split(b'\x00', 1)[0], 'cp1252'), type, creator, get_records(view, record_count))
+    record_zero = kindle_file.records[0]
+    parse_record_zero(kindle_file, view, record_zero.offset, record_zero.offset + record_zero.length)
+    return kindle_file
+
+
+def get_records(view, record_count):
+    # Each record runs until the next one starts, and the last runs to the end of the file
+    entries = [PDB_RECORD_INFO.unpack_from(view, PDB_HEADER.size + (PDB_RECORD_INFO.size * index)) for index in range(record_count)]
+    records = []
+    for index, (offset, attributes) in enumerate(entries):
+        if index + 1 < record_count:
+            end = entries[index + 1][0]
         else:
-            current_record += 1
-            current_offset += record_length
-            continue
-
-    return metadata_records
-
-
-def get_record_type(offset, exth_header):
-    record_type = struct.unpack('>i', exth_header[offset:offset + 4])[0]
-    return record_type
-
-
-def get_record_length(offset, exth_header):
-    record_length = struct.unpack('>i', exth_header[offset + 4:offset + 8])[0]
-    return record_length
-
-
-def get_record_data(offset, record_length, exth_header):
-    data_length = record_length - 8
-    record_data = struct.unpack('>{0}s'.format(data_length), exth_header[offset + 8:offset + 8 + data_length])[0].decode('utf-8', errors='replace').replace('\x00', '')
-    return record_data
-
-
+            end = len(view)
+        if not offset <= end <= len(view):
+            raise IndexError('Record {0} lies outside the file'.format(index))
+        records.append(PDBRecord(offset, end - offset, attributes >> 24, attributes & 0xffffff))
+    return records
+
+
+def parse_record_zero(kindle_file, view, start, end):
+    kindle_file.compression, unused, kindle_file.text_length, text_record_count, text_record_size, kindle_file.encryption_type, unknown = PALMDOC_HEADER.unpack_from(view, start)
+    if end - start < MOBI_HEADER_OFFSET + MOBI_HEADER.size:
+        return
+
+    # Plain PalmDOC files stop after the PalmDOC header
+    identifier, header_length, kindle_file.mobi_type, kindle_file.text_encoding, unique_id, kindle_file.file_version = MOBI_HEADER.unpack_from(view, start + MOBI_HEADER_OFFSET)
+    if identifier != b'MOBI':
+        return
+    encoding = TEXT_ENCODINGS.get(kindle_file.text_encoding, 'utf-8')
+    header_end = start + MOBI_HEADER_OFFSET + header_length
+
+    full_name_offset, full_name_length = MOBI_FULL_NAME.unpack_from(view, start + MOBI_FULL_NAME_OFFSET)
+    if 0 < full_name_length and start + full_name_offset + full_name_length <= end:
+        kindle_file.full_name = decode_string(view[start + full_name_offset:start + full_name_offset + full_name_length], encoding)
+    kindle_file.locale = MOBI_LOCALE.unpack_from(view, start + MOBI_LOCALE_OFFSET)[0]
+    kindle_file.first_image_index = MOBI_FIRST_IMAGE.unpack_from(view, start + MOBI_FIRST_IMAGE_OFFSET)[0]
+
+    exth_flags = MOBI_EXTH_FLAGS.unpack_from(view, start + MOBI_EXTH_FLAGS_OFFSET)[0]
+    if exth_flags & MOBI_HAS_EXTH:
+        parse_exth_header(kindle_file, view, header_end, end, encoding)
+
+
+def parse_exth_header(kindle_file, view, start, end, encoding):
+    identifier, header_length, record_count = EXTH_HEADER.unpack_from(view, start)
+    if identifier != b'EXTH':
+        return
+
+    offset = start + EXTH_HEADER.size
+    for index in range(record_count):
+        record_type, record_length = EXTH_RECORD_HEADER.unpack_from(view, offset)
+        if record_length < EXTH_RECORD_HEADER.size or offset + record_length > end:
+            raise IndexError('EXTH record {0} lies outside record zero'.format(index))
+        data_start = offset + EXTH_RECORD_HEADER.size
+        data_end = offset + record_length
+        kindle_file.exth_records.append((record_type, bytes(view[data_start:data_end])))
+
+        if record_type in EXTH_STRING_RECORDS:
+            value = decode_string(view[data_start:data_end], encoding)
+        elif record_type in EXTH_INTEGER_RECORDS and data_end - data_start == EXTH_INTEGER.size:
+            value = EXTH_INTEGER.unpack_from(view, data_start)[0]
+        else:
+            value = None
+        if value is not None:
+            name = EXTH_STRING_RECORDS.get(record_type) or EXTH_INTEGER_RECORDS.get(record_type)
+            if record_type in EXTH_REPEATABLE_RECORDS:
+                kindle_file.metadata.setdefault(name, []).append(value)
+            else:
+                kindle_file.metadata[name] = value
+        offset = data_end
+
+
+def decode_string(data, encoding):
+    return str(data, encoding, errors='replace').replace('\x00', '').strip()
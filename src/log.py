@@ -9,11 +9,13 @@ import signal
 import sys
 import threading
 
-import wx
-
 import application
 
+# Set by setup(), so that errors in threads are only handed to the main loop when there is one
+gui_enabled = True
+
 def excepthook(*exc_info):
+    import wx
     application.logger.critical('Unhandled exception', exc_info=exc_info)
     log_path = os.path.join(application.config_directory, '{0}.log'.format(application.internal_name))
     wx.MessageBox('An unhandled error occurred.  Please submit the log file located at {0} to the application developer.'.format(log_path), 'Error', wx.ICON_ERROR)
@@ -30,6 +32,10 @@ def add_threading_excepthook(func):
             try:
                 stock_run(*run_args, **run_kwargs)
             except Exception:
+                if not gui_enabled:
+                    func(*sys.exc_info())
+                    return
+                import wx
                 wx.CallAfter(func, *sys.exc_info())
 
         self.run = run_and_catch
@@ -44,7 +50,13 @@ def set_debug_logging(flag):
         application.logger.debug('Debug logging disabled')
         application.logger.setLevel(logging.INFO)
 
-def setup():
+def headless_excepthook(*exc_info):
+    application.logger.critical('Unhandled exception', exc_info=exc_info)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+def setup(gui=True):
+    global gui_enabled
+    gui_enabled = gui
     logger = logging.getLogger(application.internal_name)
     logger.setLevel(logging.INFO)
     log_path = os.path.join(application.config_directory, '{0}.log'.format(application.internal_name))
@@ -60,6 +72,8 @@ def setup():
     logger.addHandler(log_file)
     application.logger = logger
     if application.is_frozen:
-        sys.excepthook = excepthook
-        add_threading_excepthook(excepthook)
+        # Without a GUI, there's nowhere to show an error message
+        hook = excepthook if gui else headless_excepthook
+        sys.excepthook = hook
+        add_threading_excepthook(hook)
 
@@ -5,19 +5,27 @@
 import os
 import os.path
 import string
+import sys
 
 import application
 import conversion
 from paths import make_valid_filename
 
 class Book(object):
+    # Queues can hold hundreds of thousands of books, so avoid a per-instance __dict__
+    __slots__ = ['input_path', 'calibre_path', 'output_path', 'output_paths', 'author', 'author_sort', 'title', 'priority']
+
     def __init__(self, input_path, calibre_path=None, output_path=None, author=None, author_sort=None, title=None):
         self.input_path = input_path
         self.calibre_path = calibre_path
         self.output_path = output_path
+        # Maps each output format to its path, when converting to more than one
+        self.output_paths = {}
         self.author = author
         self.author_sort = author_sort
         self.title = title
+        # Books with a higher priority are converted first
+        self.priority = 0
 
     def generate_output_path(self, extension):
         if None in (self.author, self.author_sort, self.title):
@@ -27,7 +35,9 @@ class Book(object):
         title = make_valid_filename(self.title)
 
         filename_template = string.Template(application.config['filename_template'])
-        # Use a trick found at https://serverfault.com/questions/232986/overcoming-maximum-file-path-length-restrictions-in-windows
-        output_path = '\\\\?\\{0}.{1}'.format(os.path.join(application.config['output_directory'], filename_template.safe_substitute(author=author, title=title)), extension)
+        output_path = '{0}.{1}'.format(os.path.join(application.config['output_directory'], filename_template.safe_substitute(author=author, title=title)), extension)
+        if sys.platform == 'win32':
+            # Use a trick found at https://serverfault.com/questions/232986/overcoming-maximum-file-path-length-restrictions-in-windows
+            output_path = '\\\\?\\{0}'.format(output_path)
 
         return output_path
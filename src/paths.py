@@ -2,6 +2,7 @@
 # Copyright (C) 2015 James Scholes
 # This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
 # See the file LICENSE.txt for more details.
+import collections
 import ctypes.wintypes
 import os
 import os.path
@@ -38,14 +39,36 @@ def setup():
     application.config_file = os.path.join(application.config_directory, '{0}.ini'.format(application.internal_name))
     application.working_path = application.user_documents_path
 
-def walk_directory_tree(starting_path):
-    files = []
+def scan_directory_tree(starting_path, extensions=None, cancelled=None):
+    '''
+    Yields the path of each file under starting_path as soon as it's found, rather than listing the whole tree up front.
+    If extensions is given, only files with one of those lower case extensions are yielded.  Scanning stops early if cancelled, a threading.Event, is set.
+    '''
+    directories = collections.deque([starting_path])
+    while directories:
+        if cancelled is not None and cancelled.is_set():
+            return
+        directory = directories.popleft()
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            application.logger.warning('Unable to scan directory: {0}'.format(directory))
+            continue
 
-    for path, directories, filenames in os.walk(starting_path, topdown=False):
-        for filename in filenames:
-            files.append(os.path.join(path, filename))
-
-    return files
+        # scandir gets the file type along with each name, so there's no need to stat every file
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                except OSError:
+                    continue
+                if extensions is not None and os.path.splitext(entry.name)[1].lstrip('.').lower() not in extensions:
+                    continue
+                yield entry.path
 
 def make_valid_filename(filename):
     # strip out any disallowed chars and replace with underscores
@@ -0,0 +1,84 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+# Decides the order in which conversion workers take books from a batch.
+
+import heapq
+import itertools
+import os
+import os.path
+import threading
+
+# fifo converts books in the order they were added.  shortest_first finishes quick books early so output appears sooner,
+# and largest_first starts the slowest books first so that parallel workers all finish at about the same time
+SCHEDULES = ['fifo', 'shortest_first', 'largest_first']
+MIN_PRIORITY = -9
+MAX_PRIORITY = 9
+# Rough cost of converting a byte of each input format, relative to a byte of a Kindle book.
+# Comics are mostly images calibre copies as they are, while PDF and DjVu layouts are slow to reflow
+FORMAT_WEIGHTS = {
+    'cbc': 0.2,
+    'cbr': 0.2,
+    'cbz': 0.2,
+    'djvu': 3.0,
+    'docx': 1.5,
+    'odt': 1.5,
+    'pdf': 3.0,
+    'rtf': 1.5,
+    'txt': 0.5,
+    'txtz': 0.5,
+}
+
+def estimate_cost(book):
+    try:
+        size = os.path.getsize(book.input_path)
+    except OSError:
+        size = 0
+    input_format = os.path.splitext(book.input_path)[1].lstrip('.').lower()
+    return size * FORMAT_WEIGHTS.get(input_format, 1.0)
+
+class Scheduler(object):
+    '''
+    Hands books to conversion workers.  Books with a higher priority always go first, and the schedule orders books with the same priority.
+    Priorities can be changed while a batch is running, and apply from the next book a worker takes.
+    '''
+    def __init__(self, schedule='fifo'):
+        if schedule not in SCHEDULES:
+            raise ValueError(schedule)
+        self.schedule = schedule
+        self.lock = threading.Lock()
+        # Entries are (negated priority, schedule key, insertion order, book), so books are never compared with each other
+        self.heap = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def get_key(self, book):
+        if self.schedule == 'shortest_first':
+            return estimate_cost(book)
+        elif self.schedule == 'largest_first':
+            return -estimate_cost(book)
+        return 0
+
+    def put(self, book):
+        # The schedule key is worked out before taking the lock, as it may have to look at the file
+        key = self.get_key(book)
+        with self.lock:
+            heapq.heappush(self.heap, (-book.priority, key, next(self.counter), book))
+
+    def get(self):
+        # Returns the next book to convert, or None if there are none left
+        with self.lock:
+            if len(self.heap) == 0:
+                return None
+            return heapq.heappop(self.heap)[-1]
+
+    def set_priority(self, book, priority):
+        # Changes are rare, so the heap is simply rebuilt rather than tracking where each book is in it
+        with self.lock:
+            book.priority = priority
+            self.heap = [(-entry[-1].priority,) + entry[1:] for entry in self.heap]
+            heapq.heapify(self.heap)
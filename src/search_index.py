@@ -0,0 +1,67 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+import bisect
+import re
+import unicodedata
+
+TOKEN_EXPRESSION = re.compile(r'\w+')
+
+def normalise(text):
+    # Compatibility characters are folded first, so that e.g. ligatures and full-width letters match their plain equivalents
+    text = unicodedata.normalize('NFKC', text).casefold()
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+def tokenise(text):
+    return TOKEN_EXPRESSION.findall(normalise(text))
+
+def matches(query_words, *texts):
+    # Checks a single item against a tokenised query in the same way as SearchIndex.search, without an index
+    words = tokenise(' '.join(text for text in texts if text))
+    return all(any(word.startswith(query_word) for word in words) for query_word in query_words)
+
+class SearchIndex(object):
+    '''
+    Finds items whose text contains a word starting with each word of a query, ignoring case and accents.
+    Words are kept sorted, so each query word is a binary search for the range of words it's a prefix of, rather than a scan of every item.
+    '''
+    def __init__(self):
+        # word -> set of item IDs
+        self.postings = {}
+        self.words = []
+        self.words_sorted = True
+
+    def add(self, item_id, *texts):
+        for word in set(tokenise(' '.join(text for text in texts if text))):
+            if word not in self.postings:
+                self.postings[word] = set()
+                self.words_sorted = False
+            self.postings[word].add(item_id)
+
+    def search(self, query):
+        # Returns the set of matching item IDs, or None if the query has no words and so matches everything
+        query_words = set(tokenise(query))
+        if len(query_words) == 0:
+            return None
+        if not self.words_sorted:
+            self.words = sorted(self.postings)
+            self.words_sorted = True
+
+        results = None
+        # Longer words usually match fewer items, so they narrow the results quickest
+        for query_word in sorted(query_words, key=len, reverse=True):
+            matches = set()
+            index = bisect.bisect_left(self.words, query_word)
+            while index < len(self.words) and self.words[index].startswith(query_word):
+                matches.update(self.postings[self.words[index]])
+                index += 1
+            if results is None:
+                results = matches
+            else:
+                results &= matches
+            if len(results) == 0:
+                break
+        return results
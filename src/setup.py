@@ -107,7 +107,9 @@ setup(
     version=application.version,
     packages=find_packages(),
     windows=['codex.pyw'],
+    console=['codex_watch.py', 'codex_cli.py'],
     data_files=[
+        ('', ['calibre_server.py']),
         ('calibre_base', ['calibre_base\\DeDRM_plugin.zip']),
         ('calibre_base\\calibre_config\\metadata_sources', ['calibre_base\\calibre_config\\metadata_sources\\ISBNDB.json']),
         ('calibre_base\\calibre_library', ['calibre_base\\calibre_library\\metadata.db']),
@@ -5,5 +5,10 @@
 from blinker import signal
 
 conversion_started = signal('conversion_started')
+conversion_progress = signal('conversion_progress')
 conversion_error = signal('conversion_error')
 conversion_complete = signal('conversion_complete')
+files_found = signal('files_found')
+scan_complete = signal('scan_complete')
+stage_completed = signal('stage_completed')
+conversion_timing = signal('conversion_timing')
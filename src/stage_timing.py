@@ -0,0 +1,98 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+
+# Measures where a conversion batch spends its time, by stage and by input format, and optionally profiles the Python code which drives it.
+
+import collections
+import cProfile
+import io
+import os.path
+import pstats
+import threading
+
+import application
+
+profile_path = os.path.join(application.config_directory, 'conversion.prof')
+# Number of functions included in the profile summary written to the log
+PROFILE_SUMMARY_LINES = 30
+
+def get_input_format(book):
+    if book is None:
+        return None
+    return os.path.splitext(book.input_path)[1].lstrip('.').lower()
+
+class StageTimes(object):
+    # Totals the time spent in each stage for each input format.  Stages are recorded by several worker threads at once
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (stage, input format) -> [count, seconds]
+        self.totals = collections.defaultdict(lambda: [0, 0.0])
+
+    def add(self, stage, input_format, duration):
+        with self.lock:
+            total = self.totals[(stage, input_format)]
+            total[0] += 1
+            total[1] += duration
+
+    def get_summary(self, elapsed, time_to_first_result=None, schedule=None):
+        '''
+        Returns a dictionary of the time spent in each stage and on each input format, along with the batch's elapsed time, how long it took to produce its first output and the schedule it was converted in.
+        Stages run in parallel across workers, so their totals can add up to more than the elapsed time.
+        '''
+        stages = {}
+        formats = {}
+        with self.lock:
+            for (stage, input_format), (count, seconds) in self.totals.items():
+                stage_total = stages.setdefault(stage, {'count': 0, 'seconds': 0.0})
+                stage_total['count'] += count
+                stage_total['seconds'] += seconds
+                if input_format is not None:
+                    formats[input_format] = formats.get(input_format, 0.0) + seconds
+        return {'elapsed': elapsed, 'time_to_first_result': time_to_first_result, 'schedule': schedule, 'stages': stages, 'formats': formats}
+
+def format_summary(summary):
+    lines = ['Batch completed in {0:.3f} seconds'.format(summary['elapsed'])]
+    if summary.get('schedule') is not None:
+        lines.append('Schedule: {0}'.format(summary['schedule']))
+    if summary.get('time_to_first_result') is not None:
+        lines.append('First file converted after {0:.3f} seconds'.format(summary['time_to_first_result']))
+    for stage, total in sorted(summary['stages'].items(), key=lambda item: item[1]['seconds'], reverse=True):
+        lines.append('{0}: {1:.3f} seconds over {2} runs ({3:.3f} average)'.format(stage, total['seconds'], total['count'], total['seconds'] / total['count']))
+    for input_format, seconds in sorted(summary['formats'].items(), key=lambda item: item[1], reverse=True):
+        lines.append('{0} files: {1:.3f} seconds'.format(input_format, seconds))
+    return '\n'.join(lines)
+
+class Profiler(object):
+    # Collects cProfile data from each thread which runs conversions, as a profile only covers the thread which enabled it
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = []
+
+    def run(self, function, *args):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Some Python versions only allow one profiler to be active at a time
+            application.logger.debug('Unable to profile thread {0}, as another profiler is already active'.format(threading.current_thread().name))
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            with self.lock:
+                self.profiles.append(profile)
+
+    def write(self, path=None):
+        # Saves the combined profile for loading into pstats or a viewer, and logs the most expensive functions
+        with self.lock:
+            if len(self.profiles) == 0:
+                return
+            stream = io.StringIO()
+            stats = pstats.Stats(*self.profiles, stream=stream)
+        path = path or profile_path
+        stats.dump_stats(path)
+        stats.sort_stats('cumulative').print_stats(PROFILE_SUMMARY_LINES)
+        application.logger.info('Conversion profile saved to {0}\n{1}'.format(path, stream.getvalue()))
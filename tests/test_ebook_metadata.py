@@ -0,0 +1,93 @@
+# Codex
+# Copyright (C) 2015 James Scholes
+# This program is free software, licensed under the terms of the GNU General Public License (version 3 or later).
+# See the file LICENSE.txt for more details.
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, 'src')))
+
+import ebook_metadata
+
+
+def build_pdf(objects, trailer):
+    # objects is a list of (number, contents) pairs.  Offsets in the xref table aren't read, so they're left as zero
+    body = b'%PDF-1.4\n'
+    for number, content in objects:
+        body += '{0} 0 obj\n'.format(number).encode('ascii') + content + b'\nendobj\n'
+    return body + b'xref\n0 1\n0000000000 65535 f \ntrailer\n' + trailer + b'\nstartxref\n0\n%%EOF\n'
+
+CONTAINER_XML = '<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles><rootfile full-path="content.opf"/></rootfiles></container>'
+
+
+class PDFMetadataTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_pdf(self, data):
+        path = os.path.join(self.directory, 'book.pdf')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_outline_titles_are_ignored(self):
+        path = self.write_pdf(build_pdf([
+            (1, b'<< /Type /Catalog /Outlines 2 0 R >>'),
+            (2, b'<< /Type /Outlines /First 3 0 R /Last 3 0 R /Count 1 >>'),
+            (3, b'<< /Title (Chapter 1: Beginnings) /Parent 2 0 R >>'),
+            (4, b'<< /Title (The Real Title) /Author (Jane Doe) /Producer (Test <<nested>> \\) string) >>'),
+        ], b'<< /Size 5 /Root 1 0 R /Info 4 0 R >>'))
+        metadata = ebook_metadata.get_metadata(path)
+        self.assertEqual(metadata['title'], 'The Real Title')
+        self.assertEqual(metadata['author'], 'Jane Doe')
+
+    def test_latest_info_revision_wins(self):
+        data = build_pdf([
+            (1, b'<< /Type /Catalog >>'),
+            (2, b'<< /Title (Old Title) >>'),
+        ], b'<< /Size 3 /Root 1 0 R /Info 2 0 R >>')
+        data += b'2 0 obj\n<< /Title (New Title) >>\nendobj\ntrailer\n<< /Size 3 /Root 1 0 R /Info 2 0 R /Prev 0 >>\n%%EOF\n'
+        self.assertEqual(ebook_metadata.get_metadata(self.write_pdf(data))['title'], 'New Title')
+
+    def test_missing_info_dictionary(self):
+        path = self.write_pdf(build_pdf([
+            (1, b'<< /Type /Catalog /Outlines 2 0 R >>'),
+            (2, b'<< /Title (Chapter 1: Beginnings) >>'),
+        ], b'<< /Size 3 /Root 1 0 R >>'))
+        with self.assertRaises(ebook_metadata.EbookMetadataError):
+            ebook_metadata.get_metadata(path)
+
+
+class EPUBMetadataTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_encrypted_member(self):
+        path = os.path.join(self.directory, 'book.epub')
+        with zipfile.ZipFile(path, 'w') as epub:
+            epub.writestr('mimetype', 'application/epub+zip')
+            epub.writestr('META-INF/container.xml', CONTAINER_XML)
+            epub.writestr('content.opf', '<package xmlns="http://www.idpf.org/2007/opf"/>')
+        # zipfile can't write encrypted members, so set the encryption flag in the last member's local and central directory headers
+        with open(path, 'rb') as f:
+            data = bytearray(f.read())
+        data[data.rfind(b'PK\x03\x04') + 6] |= 0x1
+        data[data.rfind(b'PK\x01\x02') + 8] |= 0x1
+        with open(path, 'wb') as f:
+            f.write(data)
+        with self.assertRaises(ebook_metadata.EbookMetadataError):
+            ebook_metadata.get_metadata(path)
+
+if __name__ == '__main__':
+    unittest.main()